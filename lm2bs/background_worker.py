@@ -28,13 +28,14 @@ class WorkerSignals(QObject):
         `object` data returned from processing, anything
 
     progress
-        `int` indicating % progress 
+        `object` progress report, e.g. an `int` indicating % progress or
+        a dict (see progress.ConversionProgress.snapshot)
 
     '''
     finished = pyqtSignal()
     error = pyqtSignal(tuple)
     result = pyqtSignal(object)
-    progress = pyqtSignal(int)
+    progress = pyqtSignal(object)
 
 
 class Worker(QRunnable):
@@ -0,0 +1,205 @@
+# Adaptive limits for the concurrent reads and tile computations of a conversion
+#
+# How many Z planes should be read at once and how many tiles should be
+# pyramided and compressed at once depends on the storage (a local NVMe drive
+# wants few readers, an SMB share many) and the machine. An AdaptiveLimit is
+# a resizable semaphore that measures the throughput of the tasks it admits
+# and moves its limit by hill climbing: it keeps stepping in one direction
+# while throughput improves and turns around when it does not. The limit is
+# only raised while the tasks actually use all slots. The limits with the best
+# measured throughput are printed at the end, so they can be pinned with
+# --read-concurrency and --compute-workers for later runs.
+#
+# License BSD-3
+
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class AdaptiveLimit(object):
+    """a limit on the number of concurrent tasks, adjusted to maximise their throughput
+
+    Use it as a context manager around each task and call record with the
+    number of bytes a task has processed. Every window seconds the
+    throughput of the window is compared with the previous one and the limit
+    is moved by a step of about a quarter of its value, within [minimum, maximum].
+    With minimum == maximum the limit is fixed.
+
+    Parameters
+    ----------
+    name : str
+        used in the log messages
+    initial, minimum, maximum : int
+        the limit at the start and its bounds
+    window : float
+        seconds between adjustments
+    tolerance : float
+        relative improvement of the throughput that counts as better
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        minimum: int = 1,
+        maximum: Optional[int] = None,
+        window: float = 5.0,
+        tolerance: float = 0.05,
+        clock: Callable[[], float] = time.perf_counter,
+    ) -> None:
+        maximum = initial if maximum is None else maximum
+        assert 1 <= minimum <= initial <= maximum, f"{name}: need 1 <= minimum <= initial <= maximum"
+        self.name = name
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.tolerance = tolerance
+        self.clock = clock
+        self.history: List[Tuple[int, float]] = []
+        self._cond = threading.Condition()
+        self._active = 0
+        self._saturated = False
+        self._direction = 1
+        self._last_rate: Optional[float] = None
+        self._amount = 0.0
+        self._t0 = clock()
+
+    @property
+    def adaptive(self) -> bool:
+        return self.minimum < self.maximum
+
+    def __enter__(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+            if self._active >= self.limit:
+                self._saturated = True
+        return self
+
+    def __exit__(self, *args):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def record(self, nbytes: float) -> None:
+        """add the bytes processed by a finished task, adjusts the limit at the end of a window"""
+        with self._cond:
+            self._amount += nbytes
+            now = self.clock()
+            if now - self._t0 < self.window:
+                return
+            rate = self._amount / (now - self._t0)
+            self._amount, self._t0 = 0.0, now
+            if self.adaptive:
+                self._adjust(rate)
+            self._saturated = False
+            self._cond.notify_all()
+
+    def _adjust(self, rate: float) -> None:
+        self.history.append((self.limit, rate))
+        if self._last_rate is not None and rate < self._last_rate * (1 + self.tolerance):
+            self._direction = -self._direction
+        self._last_rate = rate
+        if self._direction > 0 and not self._saturated:
+            # the tasks did not use all slots, more of them would not help
+            return
+        limit = min(self.maximum, max(self.minimum, self.limit + self._direction * max(1, self.limit // 4)))
+        if limit == self.limit:
+            # at a bound
+            self._direction = -self._direction
+            return
+        print(f"{self.name}: {self.limit} -> {limit} ({rate / 1e6:.1f} MB/s)")
+        self.limit = limit
+
+    def best(self) -> Tuple[int, Optional[float]]:
+        """the smallest limit whose mean throughput is within tolerance of the highest, and that throughput"""
+        rates: Dict[int, List[float]] = {}
+        for limit, rate in self.history:
+            rates.setdefault(limit, []).append(rate)
+        if not rates:
+            return self.limit, None
+        mean = {limit: sum(r) / len(r) for limit, r in rates.items()}
+        top = max(mean.values())
+        limit = min(l for l in mean if mean[l] >= top * (1 - self.tolerance))
+        return limit, mean[limit]
+
+
+class ConcurrencyController(object):
+    """the limits of the plane reads (read) and tile computations (compute) of a conversion
+
+    read limits the Z planes read concurrently by all wells, compute the tiles
+    that are pyramided, compressed and written concurrently. Either may be None
+    (no limit beyond read_workers and the number of wells).
+    """
+
+    def __init__(
+        self, read: Optional[AdaptiveLimit] = None, compute: Optional[AdaptiveLimit] = None
+    ) -> None:
+        self.read = read
+        self.compute = compute
+
+    @classmethod
+    def adaptive(
+        cls,
+        read_concurrency: Optional[int] = None,
+        compute_workers: Optional[int] = None,
+        max_read: int = 64,
+        max_compute: Optional[int] = None,
+        window: float = 5.0,
+    ) -> "ConcurrencyController":
+        """limits that adapt between 1 and max_read / max_compute, except for those given"""
+        max_compute = max_compute or os.cpu_count() or 1
+        if read_concurrency is None:
+            read = AdaptiveLimit("read concurrency", min(8, max_read), 1, max_read, window)
+        else:
+            read = AdaptiveLimit("read concurrency", read_concurrency)
+        if compute_workers is None:
+            initial = max(1, max_compute // 2)
+            compute = AdaptiveLimit("compute workers", initial, 1, max_compute, window)
+        else:
+            compute = AdaptiveLimit("compute workers", compute_workers)
+        return cls(read, compute)
+
+    def summary(self) -> str:
+        """the best limits found, as the command line options that pin them"""
+        parts, options = [], []
+        for limit, option in ((self.read, "--read-concurrency"), (self.compute, "--compute-workers")):
+            if limit is None:
+                continue
+            value, rate = limit.best()
+            rate = "" if rate is None else f" ({rate / 1e6:.1f} MB/s)"
+            parts.append(f"{limit.name} {value}{rate}")
+            options.append(f"{option} {value}")
+        return "; ".join(parts) + (f", pin with {' '.join(options)}" if options else "")
+
+
+def test_adaptive_limit():
+    """the limit climbs to the peak of a throughput curve and stays near it"""
+    from contextlib import ExitStack
+
+    now = [0.0]
+    limit = AdaptiveLimit("test", 2, 1, 32, window=1.0, clock=lambda: now[0])
+
+    def throughput(n):
+        # rises up to 12 concurrent tasks, then contention makes it drop
+        return 100e6 * min(n, 12) / (1 + max(0, n - 12) * 0.2)
+
+    for _ in range(40):
+        with ExitStack() as stack:
+            for _ in range(limit.limit):
+                stack.enter_context(limit)
+        now[0] += 1.0
+        limit.record(throughput(limit.limit))
+    assert 9 <= limit.limit <= 16
+    assert 10 <= limit.best()[0] <= 15
+
+    # without saturation the limit is not raised
+    idle = AdaptiveLimit("idle", 2, 1, 32, window=1.0, clock=lambda: now[0])
+    for i in range(10):
+        now[0] += 1.0
+        idle.record(1e6 * (i + 1))
+    assert idle.limit <= 2
+    assert "--read-concurrency 4" in ConcurrencyController(AdaptiveLimit("read", 4)).summary()
@@ -0,0 +1,317 @@
+# Parallel headless Fiji runs of the batch stitching steps
+#
+# fiji_batch_stitching/process_folders_*.py stitch and fuse one dataset.xml
+# folder after the other inside a single interactive Fiji session. This
+# module finds the BigStitcher projects written by lm2bs, writes one ImageJ
+# macro per project with the parameters taken from a JSON config file and
+# runs several headless Fiji processes concurrently, each with its own heap
+# limit, timeout, retries and log file.
+#
+# Any executable accepting the same command line can stand in for Fiji,
+# e.g. a small script that only logs its arguments, see test_run_projects_stub.
+#
+# License BSD-3
+
+import copy
+import json
+import pathlib
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Optional
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# written into each project folder
+MACRO_FILE = "lm2bs_fiji.ijm"
+LOG_FILE = "lm2bs_fiji.log"
+
+# printed by the macro after the last step, a run only counts as successful if
+# it appears in the log (headless Fiji does not always exit with an error code)
+DONE_MARKER = "lm2bs: all steps done"
+
+_ALL = (
+    "process_angle=[All angles] process_channel=[All channels] "
+    "process_illumination=[All illuminations] process_tile=[All tiles] "
+    "process_timepoint=[All Timepoints]"
+)
+
+# the steps of fiji_batch_stitching/process_folders_projected.py
+DEFAULT_CONFIG = {
+    "fiji": "ImageJ-linux64",
+    # {memory}, {macro} and {log} are replaced for each job
+    "arguments": ["--headless", "--mem={memory}", "--console", "-macro", "{macro}"],
+    "workers": 2,
+    "memory": "8g",
+    "timeout": 3600,
+    "retries": 1,
+    "dataset": "dataset.xml",
+    "parameters": {
+        "downsample_xy": 4,
+        "min_r": 0.6,
+        "max_r": 1,
+        "relative": 2.5,
+        "absolute": 3.5,
+        "fused_downsampling": 1,
+    },
+    # pairs of (Fiji command, options). {xml} and {folder} are replaced by the
+    # project paths, all other {names} by the values in "parameters"
+    "steps": [
+        [
+            "Calculate pairwise shifts ...",
+            "select=[{xml}] " + _ALL + " method=[Phase Correlation] "
+            "downsample_in_x={downsample_xy} downsample_in_y={downsample_xy}",
+        ],
+        [
+            "Filter pairwise shifts ...",
+            "select=[{xml}] min_r={min_r} max_r={max_r} max_shift_in_x=0 "
+            "max_shift_in_y=0 max_shift_in_z=0 max_displacement=0",
+        ],
+        [
+            "Optimize globally and apply shifts ...",
+            "select=[{xml}] " + _ALL + " relative={relative} absolute={absolute} "
+            "global_optimization_strategy=[Two-Round using Metadata to align unconnected Tiles] "
+            "fix_group_0-0",
+        ],
+        [
+            "Fuse dataset ...",
+            "select=[{xml}] " + _ALL + " bounding_box=[Currently Selected Views] "
+            "downsampling={fused_downsampling} pixel_type=[16-bit unsigned integer] "
+            "interpolation=[Linear Interpolation] image=[Precompute Image] "
+            "interest_points_for_non_rigid=[-= Disable Non-Rigid =-] blend "
+            "produce=[Each timepoint & channel] "
+            "fused_image=[Save as (compressed) TIFF stacks] output_file_directory=[{folder}]",
+        ],
+    ],
+}
+
+
+def load_config(filename=None) -> dict:
+    """DEFAULT_CONFIG updated with the entries of a JSON file
+
+    "parameters" are merged key by key, all other entries replace the defaults.
+    """
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if filename is None:
+        return config
+    with open(filename) as f:
+        user = json.load(f)
+    config["parameters"].update(user.pop("parameters", {}))
+    config.update(user)
+    return config
+
+
+def save_config(filename, config: Optional[dict] = None) -> None:
+    """write a config (by default DEFAULT_CONFIG) as a starting point for editing"""
+    with open(filename, "w") as f:
+        json.dump(DEFAULT_CONFIG if config is None else config, f, indent=2)
+
+
+def find_projects(base_folder, dataset: str = "dataset.xml") -> List[pathlib.Path]:
+    """all project XML files named dataset below base_folder, sorted
+
+    The partitions of plate projects are skipped, their tiles are stitched
+    as part of the plate project (see plate_project).
+    """
+    from plate_project import PARTITIONS_FOLDER
+
+    base_folder = pathlib.Path(base_folder)
+    return sorted(
+        p
+        for p in base_folder.glob(f"**/{dataset}")
+        if PARTITIONS_FOLDER not in p.relative_to(base_folder).parts[:-1]
+    )
+
+
+def _macro_string(s: str) -> str:
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def make_macro(xml_filename, config: dict) -> str:
+    """ImageJ macro running the configured steps on one project"""
+    xml_filename = pathlib.Path(xml_filename).resolve()
+    values = dict(config["parameters"])
+    # forward slashes work on all platforms and need no escaping in macro strings
+    values.update(xml=xml_filename.as_posix(), folder=xml_filename.parent.as_posix())
+    lines = []
+    for command, options in config["steps"]:
+        lines.append(f'print({_macro_string("lm2bs: " + command)});')
+        lines.append(f"run({_macro_string(command)}, {_macro_string(options.format(**values))});")
+    lines.append(f"print({_macro_string(DONE_MARKER)});")
+    return "\n".join(lines) + "\n"
+
+
+def _command(config: dict, macro: pathlib.Path, log: pathlib.Path) -> List[str]:
+    values = dict(memory=config["memory"], macro=str(macro), log=str(log))
+    return [config["fiji"]] + [a.format(**values) for a in config["arguments"]]
+
+
+def _read_from(filename, offset: int) -> str:
+    """the text of a file after the given byte offset"""
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        return f.read().decode(errors="replace")
+
+
+def run_project(xml_filename, config: dict) -> dict:
+    """run the configured steps on one project in a headless Fiji process
+
+    The macro and the log are written into the project folder. A failed or
+    timed out run is repeated up to config["retries"] times.
+
+    Returns
+    -------
+    dict
+        project, status ("ok", "failed" or "timeout"), attempts, returncode, seconds and log
+    """
+    xml_filename = pathlib.Path(xml_filename)
+    folder = xml_filename.parent
+    macro = folder / MACRO_FILE
+    log = folder / LOG_FILE
+    macro.write_text(make_macro(xml_filename, config))
+    cmd = _command(config, macro, log)
+    result = dict(project=str(xml_filename), status="failed", attempts=0, returncode=None)
+    t0 = time.time()
+    with open(log, "w") as f:
+        for attempt in range(1, config["retries"] + 2):
+            result["attempts"] = attempt
+            f.write(f"=== attempt {attempt}: {subprocess.list2cmdline(cmd)}\n")
+            f.flush()
+            # the marker must come from this attempt, not from one that timed out
+            offset = f.tell()
+            try:
+                proc = subprocess.run(
+                    cmd,
+                    stdout=f,
+                    stderr=subprocess.STDOUT,
+                    stdin=subprocess.DEVNULL,
+                    timeout=config["timeout"],
+                    cwd=str(folder),
+                )
+            except subprocess.TimeoutExpired:
+                f.write(f"\n=== timeout after {config['timeout']} s\n")
+                result.update(status="timeout", returncode=None)
+                continue
+            except OSError as e:
+                # the executable is missing, retrying does not help
+                f.write(f"\n=== could not start {config['fiji']}: {e}\n")
+                result.update(status="failed", returncode=None)
+                break
+            result["returncode"] = proc.returncode
+            f.flush()
+            if proc.returncode == 0 and DONE_MARKER in _read_from(log, offset):
+                result["status"] = "ok"
+                break
+            result["status"] = "failed"
+    result.update(seconds=time.time() - t0, log=str(log))
+    print(f"{xml_filename}: {result['status']} after {result['attempts']} attempt(s)")
+    return result
+
+
+def run_projects(
+    base_folder, config: Optional[dict] = None, workers: Optional[int] = None
+) -> "pd.DataFrame":
+    """run the configured Fiji steps on all projects below base_folder
+
+    Parameters
+    ----------
+    base_folder : str
+        folder searched recursively for config["dataset"], usually the lm2bs output folder
+    config : Optional[dict]
+        as returned by load_config, defaults to DEFAULT_CONFIG
+    workers : Optional[int]
+        number of concurrent Fiji processes, defaults to config["workers"]
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per project as returned by run_project
+    """
+    import pandas as pd
+
+    if config is None:
+        config = load_config()
+    if workers is None:
+        workers = config["workers"]
+    projects = find_projects(base_folder, config["dataset"])
+    print(f"running {len(config['steps'])} Fiji steps on {len(projects)} projects, {workers} at a time")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as p:
+        results = list(p.map(lambda xml: run_project(xml, config), projects))
+    summary = pd.DataFrame(
+        results, columns=["project", "status", "attempts", "returncode", "seconds", "log"]
+    )
+    print(summary.status.value_counts().to_string())
+    return summary
+
+
+def test_run_projects_stub():
+    """run_projects with a Python script standing in for Fiji"""
+    import sys
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        for name in ["chamber_0_0", "chamber_0_1", "chamber_1_0"]:
+            (tmp / "projection" / name).mkdir(parents=True)
+            (tmp / "projection" / name / "dataset.xml").write_text("<SpimData/>")
+        # succeeds for chamber_0_0, fails once for chamber_0_1 and always for chamber_1_0
+        stub = tmp / "fiji_stub.py"
+        stub.write_text(
+            "import pathlib, sys\n"
+            "macro = pathlib.Path(sys.argv[-1])\n"
+            "flag = macro.parent / 'failed_once'\n"
+            "if macro.parent.name == 'chamber_1_0' or (macro.parent.name == 'chamber_0_1' and not flag.exists()):\n"
+            "    flag.touch()\n"
+            "    sys.exit(1)\n"
+            f"print({DONE_MARKER!r})\n"
+        )
+        config = load_config()
+        config.update(fiji=sys.executable, arguments=[str(stub), "{macro}"], retries=1)
+        summary = run_projects(tmp, config, workers=3)
+        assert list(summary.status) == ["ok", "ok", "failed"]
+        assert list(summary.attempts) == [1, 2, 2]
+        macro = (tmp / "projection" / "chamber_0_0" / MACRO_FILE).read_text()
+        assert 'run("Fuse dataset ...",' in macro and "min_r=0.6" in macro
+
+        # prints the marker and hangs, then exits without finishing
+        xml = tmp / "late" / "dataset.xml"
+        xml.parent.mkdir()
+        xml.write_text("<SpimData/>")
+        stub.write_text(
+            "import pathlib, sys, time\n"
+            "flag = pathlib.Path(sys.argv[-1]).parent / 'hung_once'\n"
+            "if not flag.exists():\n"
+            "    flag.touch()\n"
+            f"    print({DONE_MARKER!r}, flush=True)\n"
+            "    time.sleep(30)\n"
+        )
+        config.update(timeout=2)
+        result = run_project(xml, config)
+        assert result["status"] == "failed" and result["attempts"] == 2 and result["returncode"] == 0
+        assert DONE_MARKER in (xml.parent / LOG_FILE).read_text()
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Stitch and fuse the BigStitcher projects below a folder with headless Fiji"
+    )
+    parser.add_argument("folder", nargs="?", help="folder containing the lm2bs projects")
+    parser.add_argument("--config", help="JSON file with settings overriding the defaults")
+    parser.add_argument("--workers", type=int, help="number of concurrent Fiji processes")
+    parser.add_argument(
+        "--write-config", metavar="FILE", help="write the default settings to FILE and exit"
+    )
+    args = parser.parse_args(argv)
+    if args.write_config:
+        save_config(args.write_config)
+        return
+    if args.folder is None:
+        parser.error("folder is required")
+    return run_projects(args.folder, load_config(args.config), args.workers)
+
+
+if __name__ == "__main__":
+    main()
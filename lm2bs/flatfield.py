@@ -0,0 +1,284 @@
+# Flat-field and dark-field correction of the tiles during conversion
+#
+# The illumination of confocal and widefield tiles falls off towards their
+# edges, which shows up as seams after stitching and fusion. The profiles are
+# estimated from the cheap strided samples of the fields that the background
+# detection reads anyway (see tile_filter.sample_field, shared through the
+# tile cache), so estimating them needs no extra full read. For every pixel
+# of the sample grid a running median and a running low quantile across the
+# fields are kept with stochastic approximation, in constant memory however
+# many fields there are. Their difference follows the illumination (the
+# flat-field), what the illumination does not explain of the low quantile is
+# the dark-field. The profiles are smoothed and stored next to each project
+# (flatfield.npz), from where they can be reused for other wells, plates or
+# later conversions.
+# The correction (raw - dark) / flat + mean(dark) keeps the background level
+# and is applied to the tiles before their pyramids are built.
+#
+# License BSD-3
+
+import pathlib
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Collection, Dict, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from tile_cache import TileCache
+
+# written next to dataset.xml
+PROFILE_FILE = "flatfield.npz"
+
+
+class RunningQuantile(object):
+    """per-pixel running estimate of the q-quantile of a stream of images
+
+    Each update moves the estimate up by step * q where the image is above
+    it and down by step * (1 - q) where it is below, so it settles where a
+    fraction q of the images is below. The step of a pixel is its running
+    mean absolute deviation from the estimate, shrinking with n ** 0.75 for
+    n images (faster than the square root, for less noise once settled).
+    """
+
+    def __init__(self, q: float) -> None:
+        assert 0 < q < 1, "q must be in (0, 1)"
+        self.q = q
+        self.n = 0
+        self.estimate: Optional[np.ndarray] = None
+        self._scale: Optional[np.ndarray] = None
+
+    def update(self, image: np.ndarray) -> None:
+        image = np.asarray(image, dtype=np.float32)
+        self.n += 1
+        if self.estimate is None:
+            self.estimate = image.copy()
+            self._scale = np.full_like(image, max(float(image.std()), 1.0))
+            return
+        below = image < self.estimate
+        self._scale += (np.abs(image - self.estimate) - self._scale) / self.n
+        self.estimate += self._scale / self.n ** 0.75 * (self.q - below)
+
+
+class FlatField(object):
+    """flat-field and dark-field profiles on the sample grid of the fields
+
+    Parameters
+    ----------
+    flat : np.ndarray
+        relative illumination with mean 1, at every downsample-th row and column
+    dark : np.ndarray
+        additive offset, on the same grid. It is only defined up to a multiple
+        of flat, which does not change the correction.
+    downsample : int
+        the spacing of the grid in full-resolution pixels
+    nfields : int
+        number of fields the profiles were estimated from
+    """
+
+    def __init__(self, flat: np.ndarray, dark: np.ndarray, downsample: int, nfields: int = 0) -> None:
+        assert flat.shape == dark.shape, "flat and dark must have the same shape"
+        self.flat = np.asarray(flat, dtype=np.float32)
+        self.dark = np.asarray(dark, dtype=np.float32)
+        self.downsample = int(downsample)
+        self.nfields = int(nfields)
+        self._full: Dict[Tuple[int, int], Tuple[np.ndarray, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def save(self, filename) -> None:
+        np.savez(filename, flat=self.flat, dark=self.dark, downsample=self.downsample, nfields=self.nfields)
+
+    @classmethod
+    def load(cls, filename) -> "FlatField":
+        with np.load(filename) as f:
+            return cls(f["flat"], f["dark"], int(f["downsample"]), int(f["nfields"]))
+
+    @classmethod
+    def find(cls, xml_filename) -> Optional["FlatField"]:
+        """the profiles stored next to a project, None if it was not corrected"""
+        filename = pathlib.Path(xml_filename).parent / PROFILE_FILE
+        return cls.load(filename) if filename.exists() else None
+
+    def full_resolution(self, shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+        """(flat, dark) bilinearly interpolated to full-resolution tiles of shape (rows, columns)"""
+        shape = tuple(int(s) for s in shape)
+        with self._lock:
+            if shape not in self._full:
+                self._full[shape] = tuple(_upsample(p, self.downsample, shape) for p in (self.flat, self.dark))
+            return self._full[shape]
+
+    def correct(self, stack: np.ndarray, step: int = 1) -> np.ndarray:
+        """the corrected (z, y, x) uint16 stack
+
+        step is the subsampling of y and x of a strided read (a coarse field),
+        its pixels are corrected with the profiles at their full-resolution
+        positions.
+        """
+        shape = (stack.shape[-2] * step, stack.shape[-1] * step)
+        flat, dark = self.full_resolution(shape)
+        flat = flat[::step, ::step][: stack.shape[-2], : stack.shape[-1]]
+        dark = dark[::step, ::step][: stack.shape[-2], : stack.shape[-1]]
+        offset = float(self.dark.mean())
+        out = np.empty(stack.shape, dtype=np.uint16)
+        # plane by plane, a float copy of a whole volume would double the memory
+        for z in range(len(stack)):
+            plane = (np.asarray(stack[z], dtype=np.float32) - dark) / flat + offset
+            out[z] = np.clip(np.rint(plane), 0, np.iinfo(np.uint16).max)
+        return out
+
+    def __str__(self) -> str:
+        return (
+            f"flat-field from {self.nfields} fields: illumination {self.flat.min():.2f} - {self.flat.max():.2f}, "
+            f"dark-field pattern {np.ptp(self.dark):.0f}"
+        )
+
+
+def setup_profiles(xml_filename, setups: Sequence[int]) -> Dict[int, Optional[FlatField]]:
+    """the profiles each setup of a project was corrected with (None if it was not)
+
+    The setups of a plate project (see plate_project) use those of their partition.
+    """
+    import plate_project
+
+    folder = pathlib.Path(xml_filename).parent
+    if not (folder / plate_project.PARTITIONS_FILE).exists():
+        profile = FlatField.find(xml_filename)
+        return {s: profile for s in setups}
+    table = plate_project.read_partitions(xml_filename)
+    profiles = {p: FlatField.find(folder / p) for p in table.partition.unique()}
+    partition = dict(zip(table.setup, table.partition))
+    return {s: profiles[partition[s]] for s in setups}
+
+
+def _upsample(profile: np.ndarray, factor: int, shape: Tuple[int, int]) -> np.ndarray:
+    """bilinear interpolation of a profile sampled at every factor-th pixel"""
+    out = profile
+    for axis, n in enumerate(shape):
+        position = np.minimum(np.arange(n) / factor, profile.shape[axis] - 1)
+        i0 = np.floor(position).astype(int)
+        i1 = np.minimum(i0 + 1, profile.shape[axis] - 1)
+        w = (position - i0).astype(np.float32)
+        w = w[:, None] if axis == 0 else w[None, :]
+        out = np.take(out, i0, axis=axis) * (1 - w) + np.take(out, i1, axis=axis) * w
+    return out.astype(np.float32)
+
+
+class FlatFieldEstimator(object):
+    """collects the samples of fields and turns them into a FlatField
+
+    update may be called from several threads, but the estimates depend on
+    the order of the samples. Samples of a different shape
+    than the first one (fields of another size) are ignored.
+
+    Parameters
+    ----------
+    downsample : int
+        the spacing of the sample grid, see tile_filter.sample_field
+    dark_quantile : float
+        the quantile across fields that is taken as the dark-field
+    """
+
+    def __init__(self, downsample: int = 8, dark_quantile: float = 0.05) -> None:
+        self.downsample = downsample
+        self.median = RunningQuantile(0.5)
+        self.low = RunningQuantile(dark_quantile)
+        self.ignored = 0
+        self._lock = threading.Lock()
+
+    def update(self, sample: np.ndarray) -> None:
+        with self._lock:
+            if self.median.estimate is not None and sample.shape != self.median.estimate.shape:
+                self.ignored += 1
+                return
+            self.median.update(sample)
+            self.low.update(sample)
+
+    def profile(self, sigma: float = 4.0) -> FlatField:
+        """the smoothed profiles, sigma is in sample grid pixels
+
+        For fields I = flat * S + dark, where the signal S has the same
+        distribution everywhere in the field, the spread median - low quantile
+        is proportional to flat and the dark offset cancels. The dark-field is
+        what remains of the low quantile after the least-squares fit of the
+        illumination.
+        """
+        from scipy.ndimage import gaussian_filter
+
+        if self.median.estimate is None:
+            raise RuntimeError("no samples to estimate a flat-field from")
+        if self.ignored:
+            print(f"flat-field: ignored {self.ignored} fields of a different size")
+        median = gaussian_filter(self.median.estimate, sigma, mode="nearest")
+        low = gaussian_filter(self.low.estimate, sigma, mode="nearest")
+        spread = median - low
+        if spread.mean() < 1:
+            # the fields hardly vary, there is no illumination to estimate
+            return FlatField(np.ones_like(low), low, self.downsample, self.median.n)
+        flat = np.maximum(spread / spread.mean(), 0.05)
+        slope = np.cov(flat.ravel(), low.ravel())[0, 1] / max(float(flat.var()), 1e-12)
+        return FlatField(flat, low - slope * flat, self.downsample, self.median.n)
+
+
+def estimate_profiles(
+    fields: Sequence[str],
+    downsample: int = 8,
+    z_step: int = 4,
+    jobs: Optional[Collection[int]] = None,
+    read_workers: int = 8,
+    local_fields: Optional[Dict[str, str]] = None,
+    cache: Optional["TileCache"] = None,
+    estimator: Optional[FlatFieldEstimator] = None,
+) -> FlatField:
+    """estimate the profiles from the samples of fields
+
+    The arguments are those of tile_filter.evaluate_fields, with the same
+    downsample, z_step and cache the samples are read only once for both.
+    """
+    from tile_filter import sample_field
+
+    estimator = estimator or FlatFieldEstimator(downsample)
+    local_fields = local_fields or {}
+
+    def _sample(field):
+        return sample_field(field, downsample, z_step, jobs, local_fields.get(field), cache)
+
+    with ThreadPoolExecutor(max_workers=read_workers) as p:
+        # in the order of fields, the running estimates depend on it
+        for sample in p.map(_sample, fields):
+            estimator.update(sample)
+    return estimator.profile()
+
+
+def test_flatfield():
+    """a vignetting and an offset are estimated from sparse samples and corrected"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:32, :40]
+    vignetting = 1 - 0.25 * (((y - 16) / 16) ** 2 + ((x - 20) / 20) ** 2)
+    estimator = FlatFieldEstimator(downsample=8)
+    for _ in range(500):
+        signal = rng.normal(500, 100, vignetting.shape)
+        # bright objects in some places of some fields
+        signal[rng.random(signal.shape) < 0.05] += 5000
+        estimator.update(100 + vignetting * signal)
+    ff = estimator.profile(sigma=2.0)
+    assert ff.nfields == 500
+    error = np.abs(ff.flat - vignetting / vignetting.mean())
+    assert error.mean() < 0.03 and error.max() < 0.1
+    assert abs(ff.dark.mean() - 100) < 30
+
+    # full resolution and strided reads see the same profile
+    full = np.full((2, 256, 320), 600, np.uint16)
+    corrected = ff.correct(full)
+    assert corrected.dtype == np.uint16 and corrected.shape == full.shape
+    assert np.array_equal(ff.correct(full[:, ::8, ::8], step=8), corrected[:, ::8, ::8])
+    # a field with the estimated illumination becomes flat
+    flat, dark = ff.full_resolution((256, 320))
+    raw = (dark + 1000 * flat)[None]
+    assert np.ptp(ff.correct(raw)) <= 2
+
+    filename = pathlib.Path(__file__).parent / "_test_flatfield.npz"
+    try:
+        ff.save(filename)
+        loaded = FlatField.load(filename)
+        assert np.array_equal(loaded.flat, ff.flat) and loaded.nfields == 500
+    finally:
+        filename.unlink()
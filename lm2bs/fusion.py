@@ -0,0 +1,297 @@
+# Chunked, parallel fusion of a BigStitcher project into a single image
+#
+# A Python replacement for the "Fuse dataset" step of the Fiji batch
+# scripts. The output grid is split into independent blocks that are
+# computed in a process pool. Each block reads only the parts of the tiles
+# that intersect it, blends them with weights that fall off linearly
+# towards the tile borders, and is written into a BDV hdf5 file (a single
+# view, chunked, with a pyramid), so memory use is bounded by the block size.
+#
+# License BSD-3
+
+import math
+import os
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree as ET
+from typing import List, Optional, Sequence, Tuple
+
+import npy2bdv
+from tile_index import read_project, tile_boxes
+
+# tile coordinates closer than this (in voxels) to a voxel center are snapped to it
+_TOLERANCE = 1e-2
+
+# h5 file of the project being fused, opened once per worker process
+_h5 = None
+
+
+def _init_worker(h5_filename: str) -> None:
+    global _h5
+    _h5 = h5py.File(h5_filename, "r")
+
+
+def default_subsamp(shape: Sequence[int], min_size: int = 64) -> Tuple[Tuple[int, int, int], ...]:
+    """pyramid levels (z,y,x) for a fused image of the given (z,y,x) shape
+
+    x and y are halved until they fall below min_size, z is only halved for
+    stacks with at least 4 times as many planes as the coarser levels
+    """
+    levels = [(1, 1, 1)]
+    fz, fxy = 1, 1
+    while min(shape[1], shape[2]) // (fxy * 2) >= min_size:
+        fxy *= 2
+        if shape[0] // (fz * 2) >= 4 * min_size // fxy and shape[0] > 1 and fxy >= 16:
+            fz *= 2
+        levels.append((fz, fxy, fxy))
+    return tuple(levels)
+
+
+def _voxel_size(xml_filename, setup: int) -> Tuple[Tuple[float, float, float], str]:
+    root = ET.parse(str(xml_filename)).getroot()
+    for vs in root.find("SequenceDescription/ViewSetups").findall("ViewSetup"):
+        if int(vs.find("id").text) == setup:
+            size = tuple(float(v) for v in vs.find("voxelSize/size").text.split())
+            return size, vs.find("voxelSize/unit").text
+    raise RuntimeError(f"setup {setup} not found in {xml_filename}")
+
+
+def _axis_weights(c: np.ndarray, n: int, blend: float) -> np.ndarray:
+    """blending weights along one axis for tile coordinates c of a tile of size n"""
+    width = min(blend, n / 2.0)
+    if width <= 1:
+        return np.ones_like(c)
+    dist = np.minimum(c, n - 1 - c) + 1
+    return np.clip(dist / width, 0.0, 1.0)
+
+
+def fuse_block(
+    start: Sequence[int],
+    shape: Sequence[int],
+    tiles: List[Tuple[str, np.ndarray]],
+    blend: float = 20.0,
+) -> np.ndarray:
+    """fuse one output block (z,y,x) from the tiles intersecting it
+
+    Parameters
+    ----------
+    start, shape : Sequence[int]
+        position and size of the block in the output grid (z,y,x)
+    tiles : List[Tuple[str, np.ndarray]]
+        for each tile, the h5 path of its cells and the (z,y,x) tile coordinate of
+        output voxel (0, 0, 0). Coordinates step by one per output voxel.
+    blend : float
+        width in voxels of the linear blending ramp at the tile borders
+
+    Returns
+    -------
+    np.ndarray
+        the fused block (uint16)
+    """
+    start = np.asarray(start)
+    shape = tuple(int(n) for n in shape)
+    acc = np.zeros(shape, dtype=np.float32)
+    wsum = np.zeros(shape, dtype=np.float32)
+    for path, origin in tiles:
+        cells = _h5[path]
+        c0 = origin + start
+        n_tile = np.asarray(cells.shape)
+        # output voxels within _TOLERANCE of the tile border still count as inside
+        a = np.maximum(0, np.ceil(-c0 - _TOLERANCE)).astype(int)
+        b = np.minimum(shape, np.floor(n_tile - 1 - c0 + _TOLERANCE).astype(int) + 1)
+        if np.any(b <= a):
+            continue
+        first = np.maximum(c0 + a, 0)
+        i0 = np.floor(first + _TOLERANCE).astype(int)
+        frac = np.clip(first - i0, 0.0, 1.0)
+        stop = np.minimum(i0 + (b - a) + 1, n_tile)
+        data = cells[tuple(slice(i, j) for i, j in zip(i0, stop))]
+        data = data.view(np.uint16).astype(np.float32)
+        weight = np.ones(1, dtype=np.float32)
+        for axis in range(3):
+            if data.shape[axis] == b[axis] - a[axis]:
+                # the last voxel lies exactly on the tile border, repeat it
+                edge = np.take(data, [-1], axis=axis)
+                data = np.concatenate([data, edge], axis=axis)
+            lower = np.take(data, range(0, data.shape[axis] - 1), axis=axis)
+            if frac[axis] > _TOLERANCE:
+                upper = np.take(data, range(1, data.shape[axis]), axis=axis)
+                data = lower * (1 - frac[axis]) + upper * frac[axis]
+            else:
+                data = lower
+            c = first[axis] + np.arange(b[axis] - a[axis])
+            w = _axis_weights(c, n_tile[axis], blend).astype(np.float32)
+            weight = np.multiply.outer(weight, w) if axis else w
+        region = tuple(slice(i, j) for i, j in zip(a, b))
+        acc[region] += weight * data
+        wsum[region] += weight
+    out = np.zeros(shape, dtype=np.float32)
+    np.divide(acc, wsum, out=out, where=wsum > 0)
+    return np.clip(np.rint(out), 0, 65535).astype(np.uint16)
+
+
+def _fuse_block_task(args):
+    start, shape, tiles, blend = args
+    return start, fuse_block(start, shape, tiles, blend)
+
+
+def fuse_project(
+    xml_filename,
+    out_filename,
+    level: int = 0,
+    block_shape: Tuple[int, int, int] = (64, 256, 256),
+    blend: float = 20.0,
+    subsamp: Optional[Sequence[Tuple[int, int, int]]] = None,
+    compression: Optional[str] = "gzip",
+    max_workers: Optional[int] = None,
+    timepoint: int = 0,
+) -> Tuple[int, int, int]:
+    """fuse all tiles of a BDV project at a pyramid level into a single-view BDV project
+
+    Parameters
+    ----------
+    xml_filename : str
+        dataset.xml of the project to fuse, including any stitching transforms
+    out_filename : str
+        h5 file to create, the XML is written next to it
+    level : int
+        pyramid level of the input to fuse
+    block_shape : Tuple[int, int, int]
+        (z,y,x) size of the independently fused blocks, also used as h5 chunk size
+    blend : float
+        width in voxels of the linear blending ramp at the tile borders
+    subsamp : Optional[Sequence[Tuple[int, int, int]]]
+        pyramid levels of the output, by default x and y are halved down to 64 pixels
+    max_workers : Optional[int]
+        number of worker processes
+
+    Returns
+    -------
+    Tuple[int, int, int]
+        (z,y,x) shape of the fused image
+    """
+    h5_name, setups, sizes, affines = read_project(xml_filename, timepoint)
+    lo, _ = tile_boxes(setups, sizes, affines)
+    with h5py.File(h5_name, "r") as f:
+        res = {s: f[f"s{s:02d}/resolutions"][level] for s in setups}
+        level_shapes = {s: f[f"t{timepoint:05d}/s{s:02d}/{level}/cells"].shape for s in setups}
+    scale = {s: np.diag(affines[s])[:3] for s in setups}
+    step = scale[setups[0]] * res[setups[0]]
+    for s in setups:
+        assert np.allclose(scale[s] * res[s], step), "all tiles must have the same voxel size"
+    # world position (x,y,z) of output voxel 0, aligned with the level grid of the tiles
+    origin = lo.min(axis=0) + scale[setups[0]] * (res[setups[0]] - 1) / 2
+    extent = np.max(
+        [affines[s][:3, 3] + scale[s] * sizes[s] - origin for s in setups], axis=0
+    )
+    shape = tuple(int(math.ceil(e)) for e in (extent / step)[::-1])
+
+    # tile coordinate (z,y,x) of output voxel 0 for each tile
+    tiles = []
+    for s in setups:
+        tile_coord = ((origin - affines[s][:3, 3]) / scale[s] - (res[s] - 1) / 2) / res[s]
+        path = f"t{timepoint:05d}/s{s:02d}/{level}/cells"
+        tiles.append((path, tile_coord[::-1], np.asarray(level_shapes[s])))
+
+    block_shape = np.minimum(block_shape, shape)
+    if subsamp is None:
+        subsamp = default_subsamp(shape)
+    voxel_size, unit = _voxel_size(xml_filename, setups[0])
+    writer = npy2bdv.BdvWriter(
+        str(out_filename),
+        subsamp=tuple(tuple(int(f) for f in s) for s in subsamp),
+        blockdim=(tuple(int(b) for b in block_shape),),
+        compression=compression,
+    )
+    affine = np.zeros((3, 4))
+    affine[:3, :3] = np.diag(step)
+    affine[:3, 3] = origin
+    writer.append_view(
+        None,
+        time=0,
+        virtual_stack_dim=shape,
+        m_affine=affine,
+        name_affine="fused",
+        voxel_size_xyz=tuple(np.asarray(voxel_size) * res[setups[0]]),
+        voxel_units=unit,
+    )
+
+    def _tasks():
+        nblocks = -(-np.asarray(shape) // block_shape)
+        for index in np.ndindex(*nblocks):
+            start = np.asarray(index) * block_shape
+            bshape = np.minimum(block_shape, np.asarray(shape) - start)
+            # only pass the tiles that intersect this block
+            block_tiles = [
+                (path, coord)
+                for path, coord, n in tiles
+                if np.all(coord + start + bshape > 0) and np.all(coord + start < n)
+            ]
+            yield tuple(start), tuple(bshape), block_tiles, blend
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_worker, initargs=(h5_name,)
+    ) as p:
+        pending = []
+        for task in _tasks():
+            pending.append(p.submit(_fuse_block_task, task))
+            # bound the number of blocks in flight to bound memory
+            if len(pending) >= 2 * max_workers:
+                start, block = pending.pop(0).result()
+                writer.append_substack(block, *start)
+        for future in pending:
+            start, block = future.result()
+            writer.append_substack(block, *start)
+    writer.write_pyramid()
+    writer.write_xml_file(ntimes=1)
+    writer.close()
+    print(f"fused {len(setups)} tiles of {xml_filename} into {out_filename}, shape {shape}")
+    return shape
+
+
+def test_fuse_project():
+    """overlapping tiles cut from one image fuse back into it, constant tiles stay constant"""
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(100, 4000, (1, 60, 100), dtype=np.uint16)
+    # (y, x) offsets of three 40 x 60 tiles, overlapping in x and in y
+    offsets = [(0, 0), (0, 40), (20, 20)]
+    contents = {
+        "image": lambda tile, y, x: image[:, y : y + 40, x : x + 60],
+        "constant": lambda tile, y, x: np.full((1, 40, 60), 1000, dtype=np.uint16),
+        "steps": lambda tile, y, x: np.full((1, 40, 60), 1000 * (tile + 1), dtype=np.uint16),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, content in contents.items():
+            h5_name = os.path.join(tmp, f"{name}.h5")
+            writer = npy2bdv.BdvWriter(h5_name, ntiles=len(offsets), subsamp=((1, 1, 1),), blockdim=((1, 16, 16),))
+            for tile, (y, x) in enumerate(offsets):
+                stack = content(tile, y, x)
+                affine = np.array([[1.0, 0, 0, x], [0, 1, 0, y], [0, 0, 1, 0]])
+                writer.append_view(stack, time=0, tile=tile, m_affine=affine, voxel_size_xyz=(1, 1, 1))
+            writer.write_xml_file()
+            writer.close()
+            fused_name = os.path.join(tmp, f"{name}_fused.h5")
+            shape = fuse_project(h5_name[:-3] + ".xml", fused_name, block_shape=(1, 32, 32), blend=8, max_workers=2)
+            assert shape == (1, 60, 100)
+            with h5py.File(fused_name, "r") as f:
+                fused = f["t00000/s00/0/cells"][()].view(np.uint16)
+            covered = np.zeros(shape, dtype=bool)
+            for y, x in offsets:
+                covered[:, y : y + 40, x : x + 60] = True
+            if name == "image":
+                # identical values in the overlaps blend to themselves
+                assert np.array_equal(fused[covered], image[covered])
+            elif name == "steps":
+                # in the overlaps, a weighted mean of the tiles
+                assert fused[covered].min() >= 1000 and fused[covered].max() <= 3000
+                assert fused[0, 5, 5] == 1000 and fused[0, 5, 95] == 2000 and fused[0, 55, 50] == 3000
+                assert len(np.unique(fused[0, 5, 40:60])) > 2
+            else:
+                # the blending weights sum to 1 everywhere
+                assert np.all(fused[covered] == 1000)
+            assert np.all(fused[~covered] == 0)
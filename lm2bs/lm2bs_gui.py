@@ -10,7 +10,15 @@
 from PyQt5 import QtWidgets, QtCore, QtGui
 from process_matrix_screener_data import Matrix_Mosaic_Processor
 from background_worker import Worker, WorkerSignals
+from concurrency import ConcurrencyController
+from progress import ConversionProgress
+import thumbnails
+import numpy as np
 import pathlib
+import threading
+
+# size in pixels of the well thumbnails in the list
+THUMBNAIL_SIZE = 64
 
 
 class MatrixScreenerToBigStitcherGUI(QtWidgets.QDialog):
@@ -21,6 +29,18 @@ class MatrixScreenerToBigStitcherGUI(QtWidgets.QDialog):
         self.outfolder = ""
         self.threadpool = QtCore.QThreadPool()
         print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
+        # thumbnails are computed in their own pool, so they never delay a conversion
+        self.thumbnail_pool = QtCore.QThreadPool()
+        self.thumbnail_pool.setMaxThreadCount(4)
+        try:
+            self.thumbnail_cache = thumbnails.ThumbnailCache()
+        except OSError:
+            self.thumbnail_cache = None
+        self._thumbnails_pending = set()
+        self._thumbnails_running = 0
+        # incremented for every new root folder, results for older folders are dropped
+        self._thumbnails_generation = 0
+        self._discovery_cancel = None
 
         self.layout = QtWidgets.QVBoxLayout()
 
@@ -34,19 +54,37 @@ class MatrixScreenerToBigStitcherGUI(QtWidgets.QDialog):
         self.checkbox_2D.setChecked(True)
         self.checkbox_3D = QtWidgets.QCheckBox("create 3D BDV file")
         self.checkbox_3D.setChecked(False)
+        self.checkbox_plate = QtWidgets.QCheckBox("write all selected wells into one plate project")
+        self.checkbox_plate.setChecked(False)
         self.lineedit_zspacing = QtWidgets.QLineEdit()
         self.lineedit_zspacing.setText("1.00")
         self.lineedit_zspacing.setValidator(QtGui.QDoubleValidator(0.0, 1000.0, 2))
+        self.lineedit_jobs = QtWidgets.QLineEdit()
+        self.lineedit_jobs.setPlaceholderText("e.g. 9 or 8,9 (empty: job with most planes)")
+        self.lineedit_jobs.setValidator(
+            QtGui.QRegExpValidator(QtCore.QRegExp(r"^\s*(\d+\s*(,\s*\d+\s*)*)?$"))
+        )
         self.listWidget = QtWidgets.QListWidget()
         self.listWidget.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
         self.listWidget.setGeometry(QtCore.QRect(10, 10, 211, 291))
+        self.listWidget.setIconSize(QtCore.QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
         self.startProcessingButton = QtWidgets.QPushButton("Process selected folders")
         self.startProcessingButton.setEnabled(False)
+        self.progress_wells = QtWidgets.QProgressBar()
+        self.progress_wells.setFormat("%v/%m wells")
+        self.progress_tiles = QtWidgets.QProgressBar()
+        self.progress_tiles.setFormat("%v/%m tiles")
+        self.label_throughput = QtWidgets.QLabel("")
+        self.cancelButton = QtWidgets.QPushButton("Cancel")
+        self.cancelButton.setEnabled(False)
+        self.conversion = None
         # Make connections
         self.listWidget.itemSelectionChanged.connect(self._checkProcessingButton)
         self.inputFolderButton.clicked.connect(self.get_root_folder)
         self.outputFolderButton.clicked.connect(self.get_output_folder)
         self.startProcessingButton.clicked.connect(self.process_selected)
+        self.cancelButton.clicked.connect(self.cancel_processing)
+        self.listWidget.verticalScrollBar().valueChanged.connect(self._schedule_thumbnails)
         # Assemble GUI elements into final layout
 
         self.layout.addWidget(self.inputFolderButton)
@@ -57,11 +95,18 @@ class MatrixScreenerToBigStitcherGUI(QtWidgets.QDialog):
         self.layout.addWidget(self.selectedoutput)
         self.layout.addWidget(self.checkbox_2D)
         self.layout.addWidget(self.checkbox_3D)
+        self.layout.addWidget(self.checkbox_plate)
         self.layout.addWidget(QtWidgets.QLabel("Enter Z-Stack spacing in um:"))
         self.layout.addWidget(self.lineedit_zspacing)
+        self.layout.addWidget(QtWidgets.QLabel("Scan jobs (--J) to convert:"))
+        self.layout.addWidget(self.lineedit_jobs)
         self.layout.addWidget(QtWidgets.QLabel("Select the wells to process:"))
         self.layout.addWidget(self.listWidget)
         self.layout.addWidget(self.startProcessingButton)
+        self.layout.addWidget(self.progress_wells)
+        self.layout.addWidget(self.progress_tiles)
+        self.layout.addWidget(self.label_throughput)
+        self.layout.addWidget(self.cancelButton)
 
         self.setLayout(self.layout)
 
@@ -81,19 +126,64 @@ class MatrixScreenerToBigStitcherGUI(QtWidgets.QDialog):
 
     def process_selected(self):
         self.startProcessingButton.setEnabled(False)
+        self.cancelButton.setEnabled(True)
+        self.label_throughput.setText("starting ...")
 
-        worker = Worker(self._process_selected)
-        worker.signals.finished.connect(self._checkProcessingButton)
-        self.threadpool.start(worker)
-
-    def _process_selected(self, *args, **kwargs):
-        self.processor.process_wells(
+        # widgets are read here, on the GUI thread, and passed to the worker
+        worker = Worker(
+            self._process_selected,
             self._get_selected_indices(),
             outfolder_base=pathlib.Path(self.outfolder),
             projected=self.checkbox_2D.isChecked(),
             volume=self.checkbox_3D.isChecked(),
             zspacing=float(self.lineedit_zspacing.text()),
+            jobs=self._get_jobs(),
+            plate=self.checkbox_plate.isChecked(),
+            # reads and tile computations adapt to the storage, up to one tile per thread of the pool
+            concurrency=ConcurrencyController.adaptive(max_compute=self.threadpool.maxThreadCount()),
         )
+        # progress is reported from the conversion threads through the worker's signal
+        self.conversion = ConversionProgress(worker.signals.progress.emit)
+        worker.kwargs["progress"] = self.conversion
+        worker.signals.progress.connect(self._show_progress)
+        worker.signals.finished.connect(self._processing_finished)
+        self.threadpool.start(worker)
+
+    def _process_selected(self, well_indices, progress_callback=None, **kwargs):
+        self.processor.process_wells(well_indices, **kwargs)
+
+    def cancel_processing(self):
+        if self.conversion is not None:
+            self.conversion.cancel()
+        self.cancelButton.setEnabled(False)
+        self.label_throughput.setText("cancelling after the tiles being written ...")
+
+    def _show_progress(self, status):
+        self.progress_wells.setMaximum(max(status["wells_total"], 1))
+        self.progress_wells.setValue(status["wells_done"])
+        self.progress_tiles.setMaximum(max(status["tiles_total"], 1))
+        self.progress_tiles.setValue(status["tiles_done"])
+        if status["cancelled"]:
+            return
+        eta = status["eta_seconds"]
+        eta = "unknown" if eta is None else f"{int(eta) // 60} min {int(eta) % 60:02d} s"
+        self.label_throughput.setText(f"{status['mb_per_s']:.1f} MB/s, time left: {eta}")
+
+    def _processing_finished(self):
+        if self.conversion is not None and self.conversion.cancelled:
+            status = self.conversion.snapshot()
+            self.label_throughput.setText(
+                f"cancelled, {status['wells_done']} of {status['wells_total']} wells finished"
+            )
+        else:
+            self.label_throughput.setText("finished")
+        self.conversion = None
+        self.cancelButton.setEnabled(False)
+        self._checkProcessingButton()
+
+    def _get_jobs(self):
+        jobs = [int(j) for j in self.lineedit_jobs.text().split(",") if j.strip()]
+        return jobs if jobs else None
 
     def _get_selected_indices(self):
         selectedindices = []
@@ -113,30 +203,112 @@ class MatrixScreenerToBigStitcherGUI(QtWidgets.QDialog):
             self.startProcessingButton.setEnabled(False)
 
     def _trigger_update(self):
-        worker = Worker(self.update_wells)
-        # worker.signals.result.connect(self.print_output)
+        # a discovery still running for the previous root folder is stopped
+        if self._discovery_cancel is not None:
+            self._discovery_cancel.set()
+        self._discovery_cancel = threading.Event()
+        self.selectedroot.setText(self.rootfolder)
+        self.listWidget.clear()
+        self._thumbnails_generation += 1
+        self._thumbnails_pending = set()
+        print("initializing Matrix processor")
+        self.processor = Matrix_Mosaic_Processor(self.rootfolder, discover=False)
+        worker = Worker(self.discover_wells, self.processor, self._discovery_cancel)
+        # wells arrive through the worker's signal and are added on the GUI thread
+        worker.signals.progress.connect(self._add_wells)
+        worker.signals.result.connect(self._discovery_finished)
         worker.signals.finished.connect(self._checkProcessingButton)
-        # worker.signals.progress.connect(self.progress_fn)
         print("starting worker")
         self.threadpool.start(worker)
 
-    def update_wells(self, *args, **kwargs):
-        print("in update wells")
-        self.selectedroot.setText(self.rootfolder)
-        self.listWidget.clear()
-        print("initializing Matrix processor")
-        self.processor = Matrix_Mosaic_Processor(self.rootfolder)
-        if self.processor.uvwells == []:
+    def discover_wells(self, processor, cancel, progress_callback, **kwargs):
+        """runs on a worker thread, emits (processor, index, (u,v)) for each new well"""
+        for well in processor.iter_wells():
+            if cancel.is_set():
+                break
+            progress_callback.emit((processor, len(processor.uvwells) - 1, well))
+        return processor
+
+    def _add_wells(self, found):
+        processor, index, (u, v) = found
+        if processor is not self.processor:
+            return
+        # items are appended in discovery order, so item row == index into processor.uvwells
+        assert index == self.listWidget.count()
+        self.listWidget.addItem(f"({u},{v})")
+        self._thumbnails_pending.add(index)
+        self._schedule_thumbnails()
+
+    def _discovery_finished(self, processor):
+        if processor is not self.processor or self._discovery_cancel.is_set():
+            return
+        if processor.uvwells == []:
             msg = QtWidgets.QMessageBox()
             msg.setIcon(QtWidgets.QMessageBox.Warning)
             msg.setWindowTitle("No files")
             msg.setText("No matrix screener datasets found. Correct folder selected?")
             msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
             msg.exec_()
+
+    def _next_thumbnail(self):
+        """the pending well to compute next: visible items first, then the closest to them"""
+        viewport = self.listWidget.viewport().rect()
+        visible = [
+            i
+            for i in self._thumbnails_pending
+            if self.listWidget.visualItemRect(self.listWidget.item(i)).intersects(viewport)
+        ]
+        if visible:
+            return min(visible)
+        item = self.listWidget.itemAt(viewport.topLeft())
+        top = self.listWidget.row(item) if item is not None else 0
+        return min(self._thumbnails_pending, key=lambda i: abs(i - top))
+
+    def _schedule_thumbnails(self, *args):
+        # only fill free slots, so the order follows the scroll position
+        while (
+            self._thumbnails_pending
+            and self._thumbnails_running < self.thumbnail_pool.maxThreadCount()
+        ):
+            index = self._next_thumbnail()
+            self._thumbnails_pending.discard(index)
+            self._thumbnails_running += 1
+            # the processor is passed along, self.processor changes with the root folder
+            worker = Worker(
+                self._make_thumbnail,
+                self.processor,
+                index,
+                self._thumbnails_generation,
+                self._get_jobs(),
+            )
+            worker.signals.result.connect(self._set_thumbnail)
+            worker.signals.finished.connect(self._thumbnail_finished)
+            self.thumbnail_pool.start(worker)
+
+    def _make_thumbnail(self, processor, index, generation, jobs, *args, **kwargs):
+        image = thumbnails.well_thumbnail(
+            processor, index, THUMBNAIL_SIZE, jobs=jobs, cache=self.thumbnail_cache
+        )
+        return processor, generation, index, image
+
+    def _set_thumbnail(self, result):
+        processor, generation, index, image = result
+        if (
+            processor is not self.processor
+            or generation != self._thumbnails_generation
+            or index >= self.listWidget.count()
+        ):
             return
-        items = [f"({w[0]},{w[1]})" for w in self.processor.uvwells]
-        self.listWidget.addItems(items)
-        # self._checkProcessingButton()
+        image = np.ascontiguousarray(image)
+        h, w = image.shape
+        qimage = QtGui.QImage(image.data, w, h, image.strides[0], QtGui.QImage.Format_Grayscale8)
+        # copy, as the QImage does not own the numpy buffer
+        pixmap = QtGui.QPixmap.fromImage(qimage.copy())
+        self.listWidget.item(index).setIcon(QtGui.QIcon(pixmap))
+
+    def _thumbnail_finished(self):
+        self._thumbnails_running -= 1
+        self._schedule_thumbnails()
 
 
 if __name__ == "__main__":
@@ -12,7 +12,6 @@ import os
 import h5py
 import numpy as np
 from xml.etree import ElementTree as ET
-import skimage.transform
 
 
 class BdvWriter:
@@ -20,7 +19,8 @@ class BdvWriter:
                  subsamp=((1, 1, 1),),
                  blockdim=((4, 256, 256),),
                  compression=None,
-                 nilluminations=1, nchannels=1, ntiles=1, nangles=1):
+                 nilluminations=1, nchannels=1, ntiles=1, nangles=1,
+                 background=0):
         """Class for writing multiple numpy 3d-arrays into BigDataViewer/BigStitcher HDF5 file.
 
         Parameters:
@@ -33,6 +33,9 @@ class BdvWriter:
                 (None, 'gzip', 'lzf'), HDF5 compression method. Default is None for high-speed writing.
             nilluminations, nchannels, ntiles, nangles, (int)
                 number of view attributes, default 1.
+            background: int or None
+                chunks whose values are all <= background are not stored, they read as the
+                fill value 0. Default 0 skips empty chunks only, None stores all chunks.
 
         Notes:
         Input stacks and output files are assumed uint16 type.
@@ -70,6 +73,9 @@ class BdvWriter:
         self.exposure_time = {}
         self.exposure_units = {}
         self.compression = compression
+        self.background = background
+        self.chunks_written = 0
+        self.chunks_skipped = 0
         self.filename = filename
         self.file_object = h5py.File(filename, 'a')
         self.write_setups_header()
@@ -87,11 +93,13 @@ class BdvWriter:
     def append_view(self, stack, time, illumination=0, channel=0, tile=0, angle=0,
                     m_affine=None, name_affine='manually defined',
                     voxel_size_xyz=(1, 1, 1), voxel_units='px', calibration=(1, 1, 1),
-                    exposure_time=0, exposure_units='s'):
+                    exposure_time=0, exposure_units='s', virtual_stack_dim=None):
         """Write numpy 3-dimensional array (stack) to h5 file at specified timepint (itime) and setup number (isetup).
         Parameters:
-            stack: numpy array (uint16)
+            stack: numpy array (uint16), or None
                 3-dimensional stack of data in (z,y,x) axis order.
+                If None, empty datasets of shape virtual_stack_dim are created for all levels,
+                to be filled with append_substack() and write_pyramid().
             time: (int)
                 time index, starting from 0.
             illumination, channel, view, angle: (int)
@@ -111,19 +119,36 @@ class BdvWriter:
                 Camera exposure time for this view, default 0.
             exposure_units: str, optional
                 Time units for this view, default "s".
+            virtual_stack_dim: tuple of 3 elements, optional
+                (z,y,x) shape of the view if stack is None.
+        Returns:
+            list of the pyramid levels written (uint16, level 0 is the stack itself),
+            or None if stack is None. Useful to compute statistics without resampling.
         """
-        assert len(stack.shape) == 3, "Stack should be a 3-dimensional numpy array (z,y,x)"
+        if stack is None:
+            assert virtual_stack_dim is not None and len(virtual_stack_dim) == 3, \
+                "virtual_stack_dim (z,y,x) must be given if stack is None"
+            shape = tuple(int(d) for d in virtual_stack_dim)
+        else:
+            assert len(stack.shape) == 3, "Stack should be a 3-dimensional numpy array (z,y,x)"
+            shape = stack.shape
         assert len(calibration) == 3, "Calibration must be a tuple of 3 elements (x, y, z)."
         assert len(voxel_size_xyz) == 3, "Voxel size must be a tuple of 3 elements (x, y, z)."
         fmt = 't{:05d}/s{:02d}/{}'
         nlevels = len(self.subsamp)
         isetup = self.determine_setup_id(illumination, channel, tile, angle)
-        self.stack_shapes[isetup] = stack.shape
+        self.stack_shapes[isetup] = shape
+        levels = None if stack is None else []
         for ilevel in range(nlevels):
             grp = self.file_object.create_group(fmt.format(time, isetup, ilevel))
-            subdata = self.subsample_stack(stack, self.subsamp[ilevel]).astype('int16')
-            grp.create_dataset('cells', data=subdata, chunks=self.chunks[ilevel],
-                               maxshape=(None, None, None), compression=self.compression)
+            level_shape = tuple(-(-np.asarray(shape) // self.subsamp[ilevel]))
+            cells = grp.create_dataset('cells', shape=level_shape, dtype='int16', chunks=self.chunks[ilevel],
+                                       maxshape=(None, None, None), compression=self.compression, fillvalue=0)
+            if stack is None:
+                continue
+            subdata = self.subsample_stack(stack, self.subsamp[ilevel])
+            levels.append(subdata)
+            self._count(write_chunks(cells, subdata, self.background))
         if m_affine is not None:
             self.affine_matrices[isetup] = m_affine
             self.affine_names[isetup] = name_affine
@@ -132,6 +157,71 @@ class BdvWriter:
         self.voxel_units[isetup] = voxel_units
         self.exposure_time[isetup] = exposure_time
         self.exposure_units[isetup] = exposure_units
+        return levels
+
+    def append_substack(self, substack, z_start, y_start=0, x_start=0, time=0,
+                        illumination=0, channel=0, tile=0, angle=0):
+        """Write a (z,y,x) block into the full-resolution level of a view created with stack=None.
+        Parameters:
+            substack: numpy array (uint16)
+                3-dimensional block of data in (z,y,x) axis order.
+            z_start, y_start, x_start: int
+                position of the block in the view.
+            time, illumination, channel, tile, angle: (int)
+                indices of the view.
+        """
+        isetup = self.determine_setup_id(illumination, channel, tile, angle)
+        cells = self.file_object['t{:05d}/s{:02d}/0/cells'.format(time, isetup)]
+        self._count(write_chunks(cells, substack, self.background, (z_start, y_start, x_start)))
+
+    def write_pyramid(self, time=0, illumination=0, channel=0, tile=0, angle=0):
+        """Compute the subsampled levels of a view from its full-resolution level, chunk by chunk.
+        Each level is derived from the previous one, so the subsampling factors of consecutive
+        levels must divide each other. Memory use is bounded by the chunk size.
+        """
+        isetup = self.determine_setup_id(illumination, channel, tile, angle)
+        fmt = 't{:05d}/s{:02d}/{}/cells'
+        for ilevel in range(1, len(self.subsamp)):
+            factor = self.subsamp[ilevel] // self.subsamp[ilevel - 1]
+            assert np.all(factor * self.subsamp[ilevel - 1] == self.subsamp[ilevel]), \
+                "subsampling factors of consecutive levels must divide each other"
+            self._count(downsample_blockwise(self.file_object[fmt.format(time, isetup, ilevel - 1)],
+                                             self.file_object[fmt.format(time, isetup, ilevel)], factor,
+                                             self.background))
+
+    def append_coarse_levels(self, coarse_stack, factor, time=0, illumination=0, channel=0, tile=0, angle=0):
+        """Fill the levels of a view created with stack=None whose subsampling is a multiple of factor.
+        Parameters:
+            coarse_stack: numpy array (uint16)
+                the whole view, already subsampled by factor, in (z,y,x) axis order.
+            factor: array-like with 3 elements
+                (z,y,x) subsampling of coarse_stack relative to the full-resolution level.
+        Returns:
+            indices of the levels written. The finer levels are left empty (they read as 0).
+        """
+        isetup = self.determine_setup_id(illumination, channel, tile, angle)
+        factor = np.asarray(factor)
+        written = []
+        for ilevel, subsamp in enumerate(self.subsamp):
+            if np.any(subsamp % factor):
+                continue
+            data = self.subsample_stack(coarse_stack, subsamp // factor)
+            cells = self.file_object['t{:05d}/s{:02d}/{}/cells'.format(time, isetup, ilevel)]
+            region = tuple(slice(0, min(n, m)) for n, m in zip(data.shape, cells.shape))
+            self._count(write_chunks(cells, data[region], self.background))
+            written.append(ilevel)
+        return written
+
+    def _count(self, counts):
+        self.chunks_written += counts[0]
+        self.chunks_skipped += counts[1]
+
+    def chunk_summary(self):
+        """Number of chunks written and skipped as background so far, as text."""
+        total = self.chunks_written + self.chunks_skipped
+        percent = 100 * self.chunks_skipped / total if total else 0
+        return "{}: {} of {} chunks stored, {} ({:.0f}%) skipped as background".format(
+            self.filename, self.chunks_written, total, self.chunks_skipped, percent)
 
     def compute_chunk_size(self, blockdim):
         """Populate the size of h5 chunks.
@@ -158,6 +248,8 @@ class BdvWriter:
         if all(subsamp_level[:] == 1):
             stack_sub = stack
         else:
+            import skimage.transform  # loads scipy, only needed for the pyramid levels
+
             stack_sub = skimage.transform.downscale_local_mean(stack, tuple(subsamp_level)).astype(np.uint16)
         return stack_sub
 
@@ -329,3 +421,79 @@ class BdvWriter:
         """Close the file object."""
         self.file_object.close()
 
+
+def write_chunks(dst, data, background=0, offset=(0, 0, 0)):
+    """Write the (z,y,x) uint16 array data into the h5 dataset dst at offset, one dst chunk at a time.
+    Chunks whose values are all <= background are not written; in a new dataset they are not
+    allocated and read as the fill value 0. With background=None every chunk is written.
+    Returns:
+        (number of chunks written, number of chunks skipped)
+    """
+    data = np.asarray(data)
+    offset = np.asarray(offset)
+    block = np.asarray(dst.chunks if dst.chunks is not None else dst.shape)
+    # the chunk grid of dst covering data
+    first = offset // block
+    last = -(-(offset + np.asarray(data.shape)) // block)
+    written, skipped = 0, 0
+    for index in np.ndindex(*(last - first)):
+        lo = np.maximum((first + index) * block, offset)
+        hi = np.minimum((first + index + 1) * block, offset + data.shape)
+        chunk = data[tuple(slice(a, b) for a, b in zip(lo - offset, hi - offset))]
+        if chunk.size == 0:
+            continue
+        if background is not None and chunk.max() <= background:
+            skipped += 1
+            continue
+        dst[tuple(slice(a, b) for a, b in zip(lo, hi))] = chunk.astype('int16')
+        written += 1
+    return written, skipped
+
+
+def downsample_blockwise(src, dst, factor, background=0):
+    """Fill the h5 dataset dst with src downsampled by factor (z,y,x), one dst chunk at a time.
+    Parameters:
+        src, dst: h5py datasets (int16, storing uint16 values)
+        factor: array-like with 3 integers
+        background: chunks of dst whose values are all <= background are not written, see write_chunks
+    Returns:
+        (number of chunks written, number of chunks skipped)
+    """
+    import skimage.transform
+
+    factor = np.asarray(factor)
+    block = np.asarray(dst.chunks if dst.chunks is not None else dst.shape)
+    shape = np.asarray(dst.shape)
+    written, skipped = 0, 0
+    for start in np.ndindex(*(-(-shape // block))):
+        lo = np.asarray(start) * block
+        hi = np.minimum(lo + block, shape)
+        src_slices = tuple(slice(a * f, min(b * f, n)) for a, b, f, n in zip(lo, hi, factor, src.shape))
+        data = src[src_slices].view(np.uint16)
+        if data.size == 0:
+            continue
+        sub = skimage.transform.downscale_local_mean(data, tuple(factor)).astype(np.uint16)
+        sub = sub[tuple(slice(0, b - a) for a, b in zip(lo, hi))]
+        if background is not None and sub.max() <= background:
+            skipped += 1
+            continue
+        dst[tuple(slice(a, a + n) for a, n in zip(lo, sub.shape))] = sub.view(np.int16)
+        written += 1
+    return written, skipped
+
+
+
+def test_write_chunks():
+    """background chunks are not allocated and read back as 0"""
+    import tempfile
+
+    stack = np.zeros((1, 64, 64), dtype=np.uint16)
+    stack[0, 40:, 40:] = 40000
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = BdvWriter(os.path.join(tmp, "dataset.h5"), subsamp=((1, 1, 1), (1, 2, 2)), blockdim=((1, 16, 16),))
+        writer.append_view(stack, time=0)
+        assert (writer.chunks_written, writer.chunks_skipped) == (4 + 1, 12 + 3)
+        cells = writer.file_object['t00000/s00/0/cells']
+        assert cells.id.get_num_chunks() == 4
+        assert np.array_equal(cells[()].view(np.uint16), stack)
+        writer.close()
@@ -0,0 +1,286 @@
+# Dry-run planning for Matrix Screener to BigStitcher conversions
+#
+# Estimates the size of the output, the peak memory and the runtime of a
+# conversion from the file catalog of a Matrix_Mosaic_Processor and the
+# header of one tif file per well. No pixel data is read.
+#
+# License BSD-3
+
+import json
+import os
+import numpy as np
+import pandas as pd
+import tifffile
+from typing import Collection, Optional, Sequence, Tuple
+
+# written into the output folder after each conversion, read by the planner
+CALIBRATION_FILE = "lm2bs_calibration.json"
+
+# npy2bdv writes all pyramid levels as int16
+OUTPUT_ITEMSIZE = 2
+
+
+def _mode(projected: bool, volume: bool) -> str:
+    return "+".join(m for m, on in (("projected", projected), ("volume", volume)) if on)
+
+
+def load_calibration(filename) -> dict:
+    """load throughput numbers saved by a previous conversion, {} if there are none"""
+    if filename is None or not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_calibration(
+    filename,
+    projected: bool,
+    volume: bool,
+    raw_bytes: int,
+    output_bytes: int,
+    seconds: float,
+) -> None:
+    """record the throughput of a finished conversion for later dry runs
+
+    Numbers are stored per conversion mode (projected, volume or both), as the
+    output size and the runtime per raw byte differ considerably between them.
+    """
+    if raw_bytes <= 0 or seconds <= 0:
+        return
+    calibration = load_calibration(filename)
+    calibration[_mode(projected, volume)] = {
+        "raw_mb_per_s": raw_bytes / 1e6 / seconds,
+        "output_bytes_per_raw_byte": output_bytes / raw_bytes,
+        "raw_bytes": raw_bytes,
+        "seconds": seconds,
+    }
+    with open(filename, "w") as f:
+        json.dump(calibration, f, indent=2)
+
+
+def pyramid_nbytes(
+    shape: Tuple[int, int, int], subsamp: Sequence[Tuple[int, int, int]]
+) -> int:
+    """number of bytes of all pyramid levels of a (z,y,x) stack, uncompressed"""
+    shape = np.asarray(shape)
+    return int(
+        sum(np.prod(-(-shape // np.asarray(s))) for s in subsamp) * OUTPUT_ITEMSIZE
+    )
+
+
+def _planes_per_field(planes: pd.DataFrame, jobs: Optional[Collection[int]]) -> pd.Series:
+    """number of Z planes that get_field reads for each field in the catalog"""
+    if "j" not in planes:
+        return planes.groupby("field").size()
+    if jobs is not None:
+        return planes[planes.j.isin(jobs)].groupby("field").size()
+    # without explicit jobs, get_field reads the job with the most planes
+    return planes.groupby(["field", "j"]).size().groupby(level=0).max()
+
+
+def _header(filename) -> Tuple[Tuple[int, int], np.dtype]:
+    with tifffile.TiffFile(filename) as tif:
+        page = tif.pages[0]
+        return tuple(page.shape[-2:]), np.dtype(page.dtype)
+
+
+def plan_wells(
+    processor,
+    well_indices: Sequence[int],
+    projected: bool = True,
+    volume: bool = False,
+    *,
+    proj_subsamp,
+    vol_subsamp,
+    jobs: Optional[Collection[int]] = None,
+    read_ahead: int = 1,
+    parallel_wells: Optional[int] = None,
+    calibration: Optional[dict] = None,
+) -> pd.DataFrame:
+    """estimate size, memory and runtime of converting the given wells
+
+    Parameters
+    ----------
+    processor : Matrix_Mosaic_Processor
+        processor holding the file catalog
+    well_indices : Sequence[int]
+        indices into processor.uvwells
+    projected, volume : bool
+        which projects would be written
+    proj_subsamp, vol_subsamp :
+        pyramid levels of the projection and volume projects
+    jobs : Optional[Collection[int]]
+        scan jobs to convert, see get_field
+    read_ahead : int
+        number of fields prefetched while a field is processed
+    parallel_wells : Optional[int]
+        number of wells converted concurrently, defaults to the worker count of
+        a ThreadPoolExecutor
+    calibration : Optional[dict]
+        throughput numbers as written by save_calibration. Without them the
+        runtime is unknown (NaN) and the output size is the uncompressed pyramid size.
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per well and a final "total" row with the columns
+        u, v, tiles, z_min, z_max, raw_bytes, pyramid_bytes,
+        est_output_bytes, est_peak_memory, est_seconds
+    """
+    calib = (calibration or {}).get(_mode(projected, volume), {})
+    per_field = _planes_per_field(processor.planes, jobs)
+    rows = []
+    for wellindex in well_indices:
+        u, v = processor.uvwells[wellindex]
+        fields = processor.df[(processor.df.u == u) & (processor.df.v == v)].field
+        nz = per_field.reindex(fields).dropna()
+        nz = nz[nz > 0]
+        row = dict(u=u, v=v, tiles=len(nz), z_min=0, z_max=0, raw_bytes=0)
+        row.update(pyramid_bytes=0, est_peak_memory=0)
+        if len(nz):
+            first = processor.planes[processor.planes.field == nz.index[0]].file.iloc[0]
+            (ny, nx), dtype = _header(first)
+            field_bytes = nz * ny * nx * dtype.itemsize
+            row.update(z_min=int(nz.min()), z_max=int(nz.max()))
+            row["raw_bytes"] = int(field_bytes.sum())
+            pyramid = 0
+            if projected:
+                pyramid += len(nz) * pyramid_nbytes((1, ny, nx), proj_subsamp)
+            if volume:
+                pyramid += sum(pyramid_nbytes((z, ny, nx), vol_subsamp) for z in nz)
+            row["pyramid_bytes"] = int(pyramid)
+            # prefetched and current stack, plus the int16 copy of the finest
+            # level and the float64 result of downscaling it by 2 in x and y
+            nvox = int(nz.max()) * ny * nx if volume else ny * nx
+            row["est_peak_memory"] = int(
+                field_bytes.max() * (1 + read_ahead) + nvox * (OUTPUT_ITEMSIZE + 2)
+            )
+        if "output_bytes_per_raw_byte" in calib:
+            row["est_output_bytes"] = row["raw_bytes"] * calib["output_bytes_per_raw_byte"]
+        else:
+            row["est_output_bytes"] = row["pyramid_bytes"]
+        if "raw_mb_per_s" in calib:
+            row["est_seconds"] = row["raw_bytes"] / 1e6 / calib["raw_mb_per_s"]
+        else:
+            row["est_seconds"] = np.nan
+        rows.append(row)
+
+    plan = pd.DataFrame(
+        rows,
+        columns=[
+            "u",
+            "v",
+            "tiles",
+            "z_min",
+            "z_max",
+            "raw_bytes",
+            "pyramid_bytes",
+            "est_output_bytes",
+            "est_peak_memory",
+            "est_seconds",
+        ],
+    )
+    if parallel_wells is None:
+        parallel_wells = min(32, (os.cpu_count() or 1) + 4)
+    total = plan.sum(numeric_only=True, min_count=1)
+    total["z_min"], total["z_max"] = plan.z_min.min(), plan.z_max.max()
+    # wells run concurrently, the calibrated throughput already includes that
+    total["est_peak_memory"] = plan.est_peak_memory.nlargest(parallel_wells).sum()
+    plan.index = [f"{u},{v}" for u, v in zip(plan.u, plan.v)]
+    plan.loc["total"] = total
+    plan.loc["total", ["u", "v"]] = np.nan
+    return plan
+
+
+def _format_bytes(nbytes: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(nbytes) < 1000:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1000
+    return f"{nbytes:.1f} TB"
+
+
+def format_plan(plan: pd.DataFrame) -> str:
+    """human readable version of a plan returned by plan_wells"""
+    out = plan.drop(columns=["u", "v"]).copy()
+    for col in ["raw_bytes", "pyramid_bytes", "est_output_bytes", "est_peak_memory"]:
+        out[col] = out[col].map(_format_bytes)
+    out["est_seconds"] = out["est_seconds"].map(
+        lambda s: "unknown" if np.isnan(s) else f"{s / 60:.1f} min"
+    )
+    out = out.rename(
+        columns={"est_seconds": "est_runtime", "raw_bytes": "raw", "pyramid_bytes": "pyramid"}
+    )
+    for col in ["tiles", "z_min", "z_max"]:
+        out[col] = out[col].astype(int)
+    return out.to_string()
+
+
+def test_plan_wells():
+    """estimates of two wells, with and without the calibration of a previous conversion"""
+    import pathlib
+    import tempfile
+    from types import SimpleNamespace
+
+    subsamp = ((1, 1, 1), (1, 2, 2))
+    calibration = {"projected": {"raw_mb_per_s": 0.001, "output_bytes_per_raw_byte": 0.5}}
+    with tempfile.TemporaryDirectory() as tmp:
+        rows = []
+        # field a has 4 planes of the main job and 2 autofocus planes
+        for field, u, j, nz in (("a", 0, 9, 4), ("a", 0, 8, 2), ("b", 0, 9, 3), ("c", 1, 9, 5)):
+            for z in range(nz):
+                filename = pathlib.Path(tmp) / f"{field}--J{j:02d}--Z{z:02d}.ome.tif"
+                tifffile.imwrite(filename, np.zeros((12, 16), np.uint16))
+                rows.append(dict(field=field, file=str(filename), j=j, z=z, u=u))
+        planes = pd.DataFrame(rows)
+        processor = SimpleNamespace(
+            planes=planes,
+            df=planes.drop_duplicates("field")[["field", "u"]].assign(v=0),
+            uvwells=np.array([(0, 0), (1, 0)]),
+        )
+        plan = plan_wells(
+            processor,
+            [0, 1],
+            proj_subsamp=subsamp,
+            vol_subsamp=subsamp,
+            parallel_wells=1,
+            calibration=calibration,
+        )
+        assert list(plan.index) == ["0,0", "1,0", "total"]
+        assert list(plan.tiles) == [2, 1, 3]
+        assert list(plan.z_min) == [3, 5, 3] and list(plan.z_max) == [4, 5, 5]
+        # 12 x 16 uint16 planes of 384 bytes
+        assert list(plan.raw_bytes) == [7 * 384, 5 * 384, 12 * 384]
+        assert list(plan.pyramid_bytes) == [2 * 480, 480, 3 * 480]
+        assert list(plan.est_output_bytes) == [7 * 192, 5 * 192, 12 * 192]
+        assert np.allclose(plan.est_seconds, [2.688, 1.92, 4.608])
+        # the largest field twice (read ahead) and 4 bytes per pixel of a projection
+        assert list(plan.est_peak_memory) == [2 * 1536 + 768, 2 * 1920 + 768, 2 * 1920 + 768]
+        both = plan_wells(processor, [0, 1], proj_subsamp=subsamp, vol_subsamp=subsamp, parallel_wells=2)
+        assert both.loc["total", "est_peak_memory"] == 3840 + 4608
+
+        # the autofocus job alone, no calibration for volumes
+        plan = plan_wells(
+            processor,
+            [0, 1],
+            projected=False,
+            volume=True,
+            proj_subsamp=subsamp,
+            vol_subsamp=subsamp,
+            jobs={8},
+            calibration=calibration,
+        )
+        assert list(plan.tiles) == [1, 0, 1] and list(plan.raw_bytes) == [768, 0, 768]
+        assert list(plan.est_output_bytes) == list(plan.pyramid_bytes) == [2 * 480, 0, 2 * 480]
+        assert plan.est_seconds.isna().all()
+
+        text = format_plan(plan).splitlines()
+        calibrated = format_plan(
+            plan_wells(processor, [0], proj_subsamp=subsamp, vol_subsamp=subsamp, calibration=calibration)
+        )
+    header = ["tiles", "z_min", "z_max", "raw", "pyramid", "est_output_bytes", "est_peak_memory", "est_runtime"]
+    assert text[0].split() == header
+    # a volume needs the stack twice (read ahead) and 4 bytes per voxel: 2 * 768 + 4 * 384 bytes
+    assert text[1].split() == ["0,0", "1", "2", "2", "768.0", "B", "960.0", "B", "960.0", "B", "3.1", "KB", "unknown"]
+    assert text[-1].split()[0] == "total"
+    assert calibrated.splitlines()[1].split()[-2:] == ["0.0", "min"]
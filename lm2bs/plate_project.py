@@ -0,0 +1,265 @@
+# A single BigStitcher project spanning all converted wells of a plate
+#
+# Each well is written as usual, concurrently with the other wells, into
+# its own partition (a complete per-well project below partitions/). The
+# plate project then consists of a small master dataset.h5 whose setups are
+# HDF5 external links into the partitions, and one dataset.xml with all
+# tiles. Wells are encoded as the illumination attribute of the views (named
+# after the well), tiles are numbered across the plate, so BigStitcher never
+# groups tiles of different wells. The tile affines hold stage positions, so
+# wells appear at their plate positions; with layout="grid" an extra "well
+# offset" transform arranges them in a (u, v) grid instead.
+#
+# License BSD-3
+
+import copy
+import os
+import pathlib
+import h5py
+import numpy as np
+import pandas as pd
+from xml.etree import ElementTree as ET
+from typing import Dict, Optional, Tuple
+
+import tile_filter
+import tile_index
+import tile_stats
+
+Well = Tuple[int, int]
+
+# below the output folder: plate/<projection|volume>/dataset.xml
+PLATE_FOLDER = "plate"
+# below the plate project: partitions/chamber_u_v/dataset.xml
+PARTITIONS_FOLDER = "partitions"
+# written next to the plate dataset.xml, maps plate setups to wells and partition setups
+PARTITIONS_FILE = "plate_partitions.csv"
+
+LAYOUTS = ("stage", "grid")
+
+
+def _affine_to_text(m: np.ndarray) -> str:
+    return " ".join(repr(float(c)) for c in m[:3, :].flatten())
+
+
+def well_offsets(
+    partitions: Dict[Well, pathlib.Path], layout: str = "stage", gap: float = 0.1
+) -> Dict[Well, np.ndarray]:
+    """(x, y, z) translation in pixels of each well in the plate project
+
+    layout="stage" keeps the stage positions (all offsets are 0). layout="grid"
+    moves the wells onto a grid with u along x and v along y, whose pitch is the
+    largest well extent plus gap times that extent.
+    """
+    assert layout in LAYOUTS, f"layout must be one of {LAYOUTS}"
+    if layout == "stage":
+        return {well: np.zeros(3) for well in partitions}
+    boxes = {}
+    for well, xml in partitions.items():
+        _, setups, sizes, affines = tile_index.read_project(xml)
+        lo, hi = tile_index.tile_boxes(setups, sizes, affines)
+        boxes[well] = lo.min(axis=0), hi.max(axis=0)
+    pitch = np.max([hi - lo for lo, hi in boxes.values()], axis=0) * (1 + gap)
+    return {
+        (u, v): np.array([u * pitch[0], v * pitch[1], 0.0]) - boxes[(u, v)][0] * [1, 1, 0]
+        for u, v in boxes
+    }
+
+
+def partition_table(partitions: Dict[Well, pathlib.Path], plate_xml) -> pd.DataFrame:
+    """plate setup, well, partition XML (relative to the plate project) and partition setup of all tiles"""
+    folder = pathlib.Path(plate_xml).parent
+    rows = []
+    for well in sorted(partitions):
+        _, setups, _, _ = tile_index.read_project(partitions[well])
+        for local in setups:
+            rows.append(
+                dict(
+                    setup=len(rows),
+                    u=well[0],
+                    v=well[1],
+                    partition=pathlib.Path(os.path.relpath(partitions[well], folder)).as_posix(),
+                    partition_setup=local,
+                )
+            )
+    return pd.DataFrame(rows, columns=["setup", "u", "v", "partition", "partition_setup"])
+
+
+def read_partitions(plate_xml) -> pd.DataFrame:
+    """the partition table stored with a plate project"""
+    return pd.read_csv(pathlib.Path(plate_xml).parent / PARTITIONS_FILE)
+
+
+def write_plate_h5(plate_xml, table: pd.DataFrame) -> pathlib.Path:
+    """(re)write the master h5 of a plate project
+
+    The resolutions and subdivisions of each setup are copied from its
+    partition, the image data are external links to the partition h5.
+    """
+    folder = pathlib.Path(plate_xml).parent
+    h5_filename = pathlib.Path(plate_xml).with_suffix(".h5")
+    with h5py.File(str(h5_filename), "w") as f:
+        for partition, rows in table.groupby("partition", sort=False):
+            part_h5, _, _, _ = tile_index.read_project(folder / partition)
+            # relative links are resolved from the folder of the master file
+            link = pathlib.Path(os.path.relpath(part_h5, folder)).as_posix()
+            with h5py.File(part_h5, "r") as part:
+                timepoints = [t for t in part if t.startswith("t")]
+                for row in rows.itertuples():
+                    setup, local = f"s{row.setup:02d}", f"s{row.partition_setup:02d}"
+                    for name in ("resolutions", "subdivisions"):
+                        f.create_dataset(f"{setup}/{name}", data=part[f"{local}/{name}"][()])
+                    for t in timepoints:
+                        f[f"{t}/{setup}"] = h5py.ExternalLink(link, f"{t}/{local}")
+    return h5_filename
+
+
+def _set_attributes(vs, illumination: int, tile: int) -> None:
+    a = vs.find("attributes")
+    a.find("illumination").text = str(illumination)
+    a.find("tile").text = str(tile)
+
+
+def _attributes(viewsets, name: str, tag: str, names) -> None:
+    attrs = viewsets.find(f"Attributes[@name='{name}']")
+    # npy2bdv writes at least one entry, copies of it keep the indentation
+    template = attrs.find(tag)
+    for child in list(attrs):
+        attrs.remove(child)
+    for index, text in enumerate(names):
+        e = copy.deepcopy(template)
+        e.find("id").text = str(index)
+        e.find("name").text = text
+        e.tail = attrs.text
+        attrs.append(e)
+    e.tail = template.tail
+
+
+def write_plate_xml(
+    plate_xml, table: pd.DataFrame, offsets: Optional[Dict[Well, np.ndarray]] = None
+) -> None:
+    """write the XML of a plate project from the XML files of its partitions
+
+    The ViewSetups and ViewRegistrations (including any registration done on
+    a partition) are copied and renumbered, the well becomes the illumination
+    attribute. offsets (see well_offsets) are prepended as "well offset" transforms.
+    """
+    folder = pathlib.Path(plate_xml).parent
+    wells = sorted({(row.u, row.v) for row in table.itertuples()})
+    roots = {p: ET.parse(str(folder / p)).getroot() for p in table.partition.unique()}
+    root = copy.deepcopy(roots[table.partition.iloc[0]])
+    root.find("SequenceDescription/ImageLoader/hdf5").text = pathlib.Path(plate_xml).with_suffix(".h5").name
+    viewsets = root.find("SequenceDescription/ViewSetups")
+    vregs = root.find("ViewRegistrations")
+    for e in viewsets.findall("ViewSetup") + vregs.findall("ViewRegistration"):
+        (viewsets if e.tag == "ViewSetup" else vregs).remove(e)
+    # ViewSetups come before the Attributes elements
+    for row in table.itertuples():
+        part = roots[row.partition]
+        vs = copy.deepcopy(part.find(f"SequenceDescription/ViewSetups/ViewSetup[id='{row.partition_setup}']"))
+        vs.find("id").text = str(row.setup)
+        vs.find("name").text = f"well {row.u},{row.v} setup {row.partition_setup}"
+        _set_attributes(vs, wells.index((row.u, row.v)), row.setup)
+        viewsets.insert(row.setup, vs)
+        for vreg in part.find("ViewRegistrations").findall(
+            f"ViewRegistration[@setup='{row.partition_setup}']"
+        ):
+            vreg = copy.deepcopy(vreg)
+            vreg.set("setup", str(row.setup))
+            offset = None if offsets is None else offsets[(row.u, row.v)]
+            if offset is not None and np.any(offset):
+                # copy an existing transform so the new one is indented like its siblings
+                vt = copy.deepcopy(vreg.find("ViewTransform"))
+                vt.find("Name").text = f"well {row.u},{row.v} offset"
+                m = np.eye(4)
+                m[:3, 3] = offset
+                vt.find("affine").text = _affine_to_text(m)
+                vreg.insert(0, vt)
+            vregs.append(vreg)
+    _attributes(viewsets, "illumination", "Illumination", [f"well {u},{v}" for u, v in wells])
+    _attributes(viewsets, "tile", "Tile", [f"tile {s}" for s in table.setup])
+    ET.ElementTree(root).write(str(plate_xml), xml_declaration=True, encoding="utf-8", method="xml")
+
+
+def _merge_tables(table: pd.DataFrame, folder: pathlib.Path, name: str) -> Optional[pd.DataFrame]:
+    """concatenate a per-setup csv of the partitions, renumbered to plate setups"""
+    parts = []
+    for partition, rows in table.groupby("partition", sort=False):
+        csv = (folder / partition).parent / name
+        if not csv.exists():
+            continue
+        part = pd.read_csv(csv)
+        setups = dict(zip(rows.partition_setup, rows.setup))
+        part["setup"] = part.setup.map(setups).fillna(-1).astype(int)
+        parts.append(part)
+    return pd.concat(parts, ignore_index=True) if parts else None
+
+
+def merge_partitions(
+    partitions: Dict[Well, pathlib.Path], plate_xml, layout: str = "stage"
+) -> pathlib.Path:
+    """write the plate project plate_xml (and its master h5) from the per-well partitions
+
+    Parameters
+    ----------
+    partitions : Dict[Well, pathlib.Path]
+        the dataset.xml of each well's partition
+    plate_xml : str
+        the XML file of the plate project, usually plate/<kind>/dataset.xml
+    layout : str
+        "stage" or "grid", see well_offsets
+
+    The field, statistics and background tables of the partitions are merged
+    as well, and the overlap graph and display settings are computed for the plate.
+    """
+    plate_xml = pathlib.Path(plate_xml)
+    folder = plate_xml.parent
+    table = partition_table(partitions, plate_xml)
+    table.to_csv(folder / PARTITIONS_FILE, index=False)
+    write_plate_h5(plate_xml, table)
+    write_plate_xml(plate_xml, table, well_offsets(partitions, layout))
+    merged = {}
+    for name in (tile_index.FIELDS_FILE, tile_filter.REPORT_FILE, tile_stats.STATS_FILE):
+        merged[name] = _merge_tables(table, folder, name)
+        if merged[name] is not None:
+            merged[name].to_csv(folder / name, index=False)
+    stats = merged[tile_stats.STATS_FILE]
+    if stats is not None:
+        lo, hi = f"p{tile_stats.PERCENTILES[0]:g}", f"p{tile_stats.PERCENTILES[-1]:g}"
+        tile_stats.write_bdv_settings(
+            plate_xml, list(table.setup), (float(stats[lo].min()), float(stats[hi].max()))
+        )
+    tile_index.write_overlap_graph(plate_xml)
+    print(f"{plate_xml}: plate project with {len(table)} tiles of {len(partitions)} wells")
+    return plate_xml
+
+
+def test_merge_partitions():
+    """two small partitions merged into a plate project that reads back through the links"""
+    import tempfile
+    import npy2bdv
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        partitions = {}
+        for u in range(2):
+            folder = tmp / PARTITIONS_FOLDER / f"chamber_{u}_0"
+            folder.mkdir(parents=True)
+            writer = npy2bdv.BdvWriter(str(folder / "dataset.h5"), ntiles=2, subsamp=((1, 1, 1), (1, 2, 2)))
+            for tile in range(2):
+                affine = np.array([[1.0, 0, 0, 100 * tile + 1000 * u], [0, 1, 0, 0], [0, 0, 1, 0]])
+                stack = np.full((1, 16, 16), 10 * u + tile, dtype=np.uint16)
+                writer.append_view(stack, time=0, tile=tile, m_affine=affine)
+            writer.write_xml_file()
+            writer.close()
+            partitions[(u, 0)] = folder / "dataset.xml"
+        plate_xml = merge_partitions(partitions, tmp / "dataset.xml", layout="grid")
+        h5_name, setups, sizes, affines = tile_index.read_project(plate_xml)
+        assert setups == [0, 1, 2, 3]
+        with h5py.File(h5_name, "r") as f:
+            assert [int(f[f"t00000/s{s:02d}/0/cells"][0, 0, 0]) for s in setups] == [0, 1, 10, 11]
+            assert f["s03/resolutions"].shape == (2, 3)
+        # the grid moves well (1, 0) next to well (0, 0)
+        assert affines[0][0, 3] == 0 and 100 < affines[2][0, 3] < 1000
+        root = ET.parse(str(plate_xml)).getroot()
+        names = [e.text for e in root.iter("name") if e.text.startswith("well ") and "setup" not in e.text]
+        assert names == ["well 0,0", "well 1,0"]
@@ -0,0 +1,227 @@
+# Quick preview mosaics of Matrix Screener wells and plates
+#
+# Tiles are placed at their stage positions (no registration) and pasted
+# into a downsampled 2D mosaic. Only the header of each field and a
+# strided single plane (or a coarse projection over every k-th plane)
+# are read, so a preview of a plate is available within seconds after
+# the acquisition, without converting and stitching.
+#
+# License BSD-3
+
+import math
+import pathlib
+import numpy as np
+import tifffile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Collection, List, Optional, Sequence, Tuple
+
+from process_matrix_screener_data import get_field, get_field_meta, tile_offset
+
+
+def coarse_tile(
+    field,
+    downsample: int,
+    z: Optional[int] = None,
+    z_step: Optional[int] = None,
+    jobs: Optional[Collection[int]] = None,
+) -> np.ndarray:
+    """read a downsampled 2D view of a field
+
+    Parameters
+    ----------
+    field : str
+        field-- folder
+    downsample : int
+        only every downsample-th row and column is read
+    z : Optional[int]
+        plane to read, defaults to the middle plane
+    z_step : Optional[int]
+        if given, the maximum projection over every z_step-th plane is
+        returned instead of a single plane
+    jobs : Optional[Collection[int]]
+        scan jobs to read, see get_field
+
+    Returns
+    -------
+    np.ndarray
+        the downsampled 2D tile
+    """
+    stack, _ = get_field(field, jobs)
+    if z_step is None:
+        z = len(stack) // 2 if z is None else z
+        return np.array(stack[z][::downsample, ::downsample])
+    tile = None
+    for iz in range(0, len(stack), z_step):
+        plane = stack[iz][::downsample, ::downsample]
+        tile = np.array(plane) if tile is None else np.maximum(tile, plane)
+    return tile
+
+
+def field_layout(
+    fields: Sequence[str],
+    jobs: Optional[Collection[int]] = None,
+    direction_x: int = -1,
+    direction_y: int = 1,
+    read_workers: int = 8,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """tile positions and sizes in full-resolution pixels from the field headers
+
+    The headers are read concurrently with read_workers threads, on network
+    storage their latency rather than their size dominates.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        (n, 2) arrays with the (row, column) offset and (rows, columns) size of each tile
+    """
+
+    def _meta(field):
+        return get_field_meta(field, jobs)[0]
+
+    offsets, sizes = [], []
+    with ThreadPoolExecutor(max_workers=max(1, read_workers)) as p:
+        metas = list(p.map(_meta, fields))
+    for meta in metas:
+        offset_x, offset_y = tile_offset(meta, direction_x, direction_y)
+        offsets.append((offset_y, offset_x))
+        sizes.append((meta["Size Y"], meta["Size X"]))
+    return np.array(offsets, dtype=float), np.array(sizes, dtype=int)
+
+
+def mosaic(
+    fields: Sequence[str],
+    downsample: Optional[int] = None,
+    max_size: int = 2048,
+    z: Optional[int] = None,
+    z_step: Optional[int] = None,
+    jobs: Optional[Collection[int]] = None,
+    read_workers: int = 8,
+    direction_x: int = -1,
+    direction_y: int = 1,
+) -> Tuple[np.ndarray, int]:
+    """paste downsampled tiles of the given fields at their stage positions
+
+    Overlapping tiles are combined with a maximum. If downsample is None it is
+    chosen such that the longer side of the mosaic is at most max_size pixels.
+    Headers and tiles are read concurrently with read_workers threads, the
+    tiles are pasted as they arrive.
+
+    Returns
+    -------
+    Tuple[np.ndarray, int]
+        the 2D mosaic and the downsampling factor used
+    """
+    offsets, sizes = field_layout(fields, jobs, direction_x, direction_y, read_workers)
+    offsets -= offsets.min(axis=0)
+    extent = (offsets + sizes).max(axis=0)
+    if downsample is None:
+        downsample = max(1, int(math.ceil(extent.max() / max_size)))
+    positions = np.floor(offsets / downsample).astype(int)
+    tile_sizes = -(-sizes // downsample)
+    canvas = None
+
+    def _read(field):
+        return coarse_tile(field, downsample, z=z, z_step=z_step, jobs=jobs)
+
+    with ThreadPoolExecutor(max_workers=read_workers) as p:
+        for (r, c), tile in zip(positions, p.map(_read, fields)):
+            if canvas is None:
+                shape = (positions + tile_sizes).max(axis=0)
+                canvas = np.zeros(shape, dtype=tile.dtype)
+            region = canvas[r : r + tile.shape[0], c : c + tile.shape[1]]
+            np.maximum(region, tile, out=region)
+    return canvas, downsample
+
+
+def well_mosaic(processor, wellindex: int, **kwargs) -> Tuple[np.ndarray, int]:
+    """preview mosaic of one well of a Matrix_Mosaic_Processor, see mosaic"""
+    u, v = processor.uvwells[wellindex]
+    df = processor.df
+    return mosaic(list(df[(df.u == u) & (df.v == v)].field), **kwargs)
+
+
+def plate_mosaic(
+    processor, well_indices: Optional[List[int]] = None, max_size: int = 4096, **kwargs
+) -> Tuple[np.ndarray, int]:
+    """preview mosaic of several (default: all) wells at their stage positions"""
+    if well_indices is None:
+        well_indices = range(len(processor.uvwells))
+    wells = [processor.uvwells[i] for i in well_indices]
+    df = processor.df
+    fields = [f for u, v in wells for f in df[(df.u == u) & (df.v == v)].field]
+    return mosaic(fields, max_size=max_size, **kwargs)
+
+
+def save_preview(filename, image: np.ndarray, min_size: int = 256) -> None:
+    """save a preview mosaic
+
+    .png files are saved as 8 bit, contrast-stretched between the 0.5 and 99.5
+    percentiles. Any other extension is written as a pyramidal tif with
+    successively 2x downsampled sub-resolutions down to min_size pixels.
+    """
+    filename = pathlib.Path(filename)
+    if filename.suffix.lower() == ".png":
+        import skimage.io
+
+        lo, hi = np.percentile(image, (0.5, 99.5))
+        scaled = np.clip((image.astype(float) - lo) / max(hi - lo, 1), 0, 1)
+        skimage.io.imsave(str(filename), (scaled * 255).astype(np.uint8), check_contrast=False)
+        return
+    levels = [image]
+    while min(levels[-1].shape) // 2 >= min_size:
+        levels.append(levels[-1][::2, ::2])
+    with tifffile.TiffWriter(str(filename)) as tif:
+        tif.write(levels[0], subifds=len(levels) - 1)
+        for level in levels[1:]:
+            tif.write(level, subfiletype=1)
+
+
+def test_preview():
+    """tiles are placed at their stage positions, pyramidal tifs have a sub-resolution per halving"""
+    import tempfile
+    from process_matrix_screener_data import write_test_field
+
+    rng = np.random.default_rng(0)
+    stacks = [rng.integers(1, 4000, (3, 64, 64), dtype=np.uint16) for _ in range(2)]
+    # the second field 20 um further in stage x and 10 um in stage y, at 0.5 um per pixel
+    stage = [(0.0, 0.0), (2e-5, 1e-5)]
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        fields = [write_test_field(tmp, s, p, pixel_size=0.5, x=x) for x, (s, p) in enumerate(zip(stacks, stage))]
+        offsets, sizes = field_layout(fields)
+        assert np.array_equal(field_layout(fields, read_workers=1)[0], offsets)
+        for field, offset in zip(fields, offsets):
+            meta, _ = get_field_meta(field)
+            offset_x, offset_y = tile_offset(meta, -1, 1)
+            assert tuple(offset) == (offset_y, offset_x)
+        assert tuple(offsets[1] - offsets[0]) == (-40, 20) and (sizes == 64).all()
+
+        assert np.array_equal(coarse_tile(fields[0], 2), stacks[0][1, ::2, ::2])
+        assert np.array_equal(coarse_tile(fields[0], 4, z=0), stacks[0][0, ::4, ::4])
+        assert np.array_equal(coarse_tile(fields[0], 2, z_step=2), stacks[0][::2, ::2, ::2].max(axis=0))
+
+        image, downsample = mosaic(fields, downsample=2)
+        # the first field at row 40 / 2, the second at column 20 / 2
+        expected = np.zeros((52, 42), np.uint16)
+        for (r, c), s in zip([(20, 0), (0, 10)], stacks):
+            np.maximum(expected[r : r + 32, c : c + 32], s[1, ::2, ::2], out=expected[r : r + 32, c : c + 32])
+        assert downsample == 2 and np.array_equal(image, expected)
+        # the downsampling follows from max_size
+        image, downsample = mosaic(fields, max_size=30, z_step=1)
+        assert downsample == 4 and image.shape == (26, 21)
+        # below the second field
+        assert np.array_equal(image[16:26, :16], stacks[0][:, ::4, ::4].max(axis=0)[6:])
+
+        filename = tmp / "preview.tif"
+        big = rng.integers(0, 4000, (1024, 2048), dtype=np.uint16)
+        save_preview(filename, big)
+        with tifffile.TiffFile(filename) as tif:
+            assert len(tif.pages) == 1 and len(tif.pages[0].subifds) == 2
+            levels = tif.series[0].levels
+            assert [level.shape for level in levels] == [(1024, 2048), (512, 1024), (256, 512)]
+            assert np.array_equal(levels[2].asarray(), big[::4, ::4])
+        save_preview(filename, big, min_size=1024)
+        with tifffile.TiffFile(filename) as tif:
+            assert not tif.pages[0].subifds and np.array_equal(tif.asarray(), big)
+        save_preview(tmp / "preview.png", big)
+        assert (tmp / "preview.png").stat().st_size > 0
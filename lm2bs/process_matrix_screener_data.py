@@ -5,21 +5,61 @@
 # Sep/Oct 2019
 # License BSD-3
 
+import os
 import pathlib
-import tifffolder
-import pandas as pd
+import shutil
 import numpy as np
-import tifffile
 import re
-import h5py
-from typing import Tuple, Union, List
+import threading
+from typing import TYPE_CHECKING, Iterator, Tuple, Union, List, Optional, Collection
 import time
+from contextlib import nullcontext
 from functools import partial
 from concurrent.futures import ThreadPoolExecutor
-import npy2bdv
+import tile_filter
+from progress import ConversionProgress
+from tiff_planes import (
+    PlaneStack,
+    ReadStats,
+    filename_fields,
+    has_unique_z,
+    list_planes,
+    prefetch,
+    project_stack,
+    read_stack,
+    select_main_job,
+)
 
+# pandas, tifffile, tifffolder and the modules writing and post-processing
+# projects (h5py, scikit-image) are imported in the functions that need them,
+# so the GUI window and --help come up without loading them, see
+# test_startup_imports
+if TYPE_CHECKING:
+    import pandas as pd
+    from concurrency import ConcurrencyController
+    from flatfield import FlatField
+    from roi import Roi
+    from tile_cache import TileCache
 
-def split_pathname(filename: str) -> pd.Series:
+
+# Pyramid levels (z,y,x) and HDF5 chunk sizes of the projection and volume projects
+PROJ_SUBSAMP = ((1, 1, 1), (1, 2, 2), (1, 4, 4), (1, 8, 8), (1, 16, 16))
+PROJ_BLOCKDIM = ((1, 64, 64),)
+VOL_SUBSAMP = ((1, 1, 1), (1, 2, 2), (1, 4, 4), (1, 8, 8), (2, 16, 16), (4, 32, 32))
+VOL_BLOCKDIM = (
+    (64, 64, 64),
+    (64, 64, 64),
+    (64, 64, 64),
+    (64, 64, 64),
+    (32, 32, 32),
+    (16, 16, 16),
+)
+
+# row/column step of the reads of fields judged to be background, see tile_filter
+BACKGROUND_DOWNSAMPLE = 8
+
+
+def split_pathname(filename: str) -> "pd.Series":
     """extracts u,v (well) and x,y (field) coordinates from a matrix screener file name
     
     Parameters
@@ -32,6 +72,8 @@ def split_pathname(filename: str) -> pd.Series:
     pd.Series
         pandas series object with u,v,x,y keys
     """
+    import pandas as pd
+
     regex = ".*--U(?P<u>\d+)--V(?P<v>\d+).*--X(?P<x>\d+)--Y(?P<y>\d+)"
     m = re.match(regex, str(filename))
     if m is None:
@@ -43,6 +85,8 @@ def get_meta_from_matrix_ome_tif(filename):
     """ given an ome tif file produced by Leica Matrix Screener,
     return a dictionary with some of the metadata
     """
+    import tifffile
+
     tfile = tifffile.TiffFile(filename)
     _meta = tfile.ome_metadata
     meta = {}
@@ -77,19 +121,144 @@ def get_meta_from_matrix_ome_tif(filename):
     return meta
 
 
-def get_field(field):
+def tile_offset(meta, direction_x=-1, direction_y=1) -> Tuple[float, float]:
+    """ position of a tile in voxels, as (offset along the image x axis,
+    offset along the image y axis), computed from the metadata returned by
+    get_meta_from_matrix_ome_tif. These are the translations in the first
+    and second row of the BigStitcher affine.
+    """
+    # Explanation for formula below:
+    # Stage position in metadata appears to be in units of metres (m)
+    # PhysicalSize appears to be micrometers per voxel (um/vox)
+    # therefore for the stageposition in voxel coordinates we need to
+    # scale from meters to um (factor 1000000) and then divide by um/vox
+    # the direction vectors should be either 1 or -1 and can be used
+    # to flip the direction of the coordinate axes.
+    offset_y = (
+        meta["Stage X"] * 1_000_000 / meta["PhysicalSize X"] * direction_x
+    )  # -2247191 #-2_000_000
+    offset_x = (
+        meta["Stage Y"] * 1_000_000 / meta["PhysicalSize Y"] * direction_y
+    )  # 2247191 #2_000_000
+    return offset_x, offset_y
+
+
+def _field_planes(field, jobs: Optional[Collection[int]] = None) -> List[str]:
+    planes = list_planes(field, jobs)
+    if jobs is None:
+        planes = select_main_job(planes)
+    return planes
+
+
+def get_field_meta(field, jobs: Optional[Collection[int]] = None):
+    """ metadata of a field folder (see get_meta_from_matrix_ome_tif) and the
+    number of Z planes that get_field would read. Only the header of the
+    first plane is read.
+    """
+    planes = _field_planes(field, jobs)
+    if not planes:
+        raise RuntimeError(f"{field}: no Z planes found")
+    return get_meta_from_matrix_ome_tif(planes[0]), len(planes)
+
+
+def get_field(field, jobs: Optional[Collection[int]] = None):
     """ for a given field folder of the leica matrix screener 
     
     Read the stack and return 
-      * a numpy like object (Tifffolder)
+      * a numpy like object (PlaneStack, which memory-maps uncompressed and
+        contiguous planes, or Tifffolder if the Z planes cannot be told apart)
       * a dictionary with metadata information required for the affine transform matrix
+
+    jobs selects the scan jobs (--J in the file name) whose planes are read.
+    If jobs is None and the folder contains images from several scan jobs
+    (e.g. autofocus images), only the job with the most planes is read.
     """
-    np_like_array = tifffolder.TiffFolder(field, {"z": "--Z{d2}"})
+    planes = _field_planes(field, jobs)
+    if planes and has_unique_z(planes):
+        np_like_array = PlaneStack(planes)
+    elif jobs is None:
+        import tifffolder
+
+        np_like_array = tifffolder.TiffFolder(field, {"z": "--Z{d2}"})
+    else:
+        raise RuntimeError(
+            f"{field}: no unique set of Z planes for scan job(s) {sorted(jobs)}"
+        )
     first_file = np_like_array.files[0]
     meta = get_meta_from_matrix_ome_tif(first_file)
     return np_like_array, meta
 
 
+def read_field(
+    field,
+    read_workers: int = 4,
+    stats: ReadStats = None,
+    jobs: Optional[Collection[int]] = None,
+    limit=None,
+):
+    """ like get_field, but reads the whole stack into memory, with up to
+    read_workers Z planes being read concurrently. The bytes read and the
+    time taken are added to stats. limit (a concurrency.AdaptiveLimit) is
+    shared with other reads, see read_stack.
+    """
+    t0 = time.perf_counter()
+    stack, meta = get_field(field, jobs)
+    stack = read_stack(stack, max_workers=read_workers, limit=limit)
+    if stats is not None:
+        stats.add(stack.nbytes, time.perf_counter() - t0)
+    return stack, meta
+
+
+def read_projection(
+    field,
+    project_func=np.max,
+    read_workers: int = 4,
+    stats: ReadStats = None,
+    jobs: Optional[Collection[int]] = None,
+    limit=None,
+):
+    """ like read_field, but returns the lazy stack, the metadata and the
+    projection of the field. The planes are reduced as they are read (see
+    PlaneStack.project), so the whole stack is never held in memory.
+    """
+    t0 = time.perf_counter()
+    stack, meta = get_field(field, jobs)
+    projection = project_stack(stack, project_func, max_workers=read_workers, limit=limit)
+    if stats is not None:
+        stats.add(stack.nbytes, time.perf_counter() - t0)
+    return stack, meta, projection
+
+
+def read_coarse_field(
+    field, downsample: int, jobs: Optional[Collection[int]] = None, z_step: int = 1
+):
+    """ like read_field, but only reads every downsample-th row and column of
+    every z_step-th Z plane. Returns the (z/z_step, y/downsample, x/downsample)
+    stack and the metadata, in which "Size Z" is the full number of planes.
+    """
+    stack, meta = get_field(field, jobs)
+    coarse = np.stack(
+        [np.array(stack[z][::downsample, ::downsample]) for z in range(0, len(stack), z_step)]
+    )
+    meta["Size Z"] = len(stack)
+    return coarse, meta
+
+
+def preview_levels(subsamp, blockdim, downsample: int):
+    """ the pyramid levels (z,y,x) and chunk sizes of a preview project, i.e. the
+    levels of subsamp that are downsampled at least downsample times in x and y
+    """
+    blockdim = list(blockdim) if len(blockdim) >= len(subsamp) else [blockdim[0]] * len(subsamp)
+    keep = [i for i, s in enumerate(subsamp) if min(s[1], s[2]) >= downsample]
+    if not keep:
+        raise RuntimeError(f"no pyramid level is downsampled {downsample} times in x and y")
+    levels = tuple(subsamp[i] for i in keep)
+    for level in levels:
+        # all levels are computed from the subsampled read of the first one
+        assert not np.any(np.asarray(level) % levels[0]), "preview levels must be multiples of each other"
+    return levels, tuple(blockdim[i] for i in keep)
+
+
 def save_files_for_bigstitcher(
     matrix_screener_fields,
     projected=True,
@@ -101,6 +270,23 @@ def save_files_for_bigstitcher(
     project_func=np.max,
     direction_x=-1,
     direction_y=1,
+    read_workers=4,
+    read_ahead=1,
+    jobs=None,
+    register=False,
+    register_level=2,
+    fuse_level=None,
+    collect_stats=True,
+    skip_background=None,
+    background_mode="exclude",
+    preview_downsample=None,
+    tile_callback=None,
+    cancel=None,
+    local_fields=None,
+    cache: Optional["TileCache"] = None,
+    concurrency: Optional["ConcurrencyController"] = None,
+    chunk_background: Optional[int] = 0,
+    flatfield: Union[None, str, "FlatField"] = None,
 ):
     """
     Save the fields in matrix screener fields as BigStitcher projects
@@ -112,121 +298,474 @@ def save_files_for_bigstitcher(
     project_func is the aggregation function for projections
     direction_* should be either +1 or -1 and can be used to flip coordinate 
     system directions
+    read_workers is the number of Z planes of a field that are read concurrently
+    read_ahead is the number of fields read in the background while the current
+    field is processed. When only projections are written, the projections are
+    prefetched, reduced plane by plane while reading, instead of the stacks.
+    With read_ahead=0 fields are read lazily as before.
+    jobs is a collection of scan job numbers (--J) to convert, see get_field
+    the overlap graph of the tiles is stored next to each project, see tile_index
+    if register is True, the tiles are registered by phase correlation on pyramid
+    level register_level after writing, see registration.register_project
+    if fuse_level is not None, the tiles are fused at that pyramid level into
+    fused.h5/.xml next to each project, see fusion.fuse_project
+    if collect_stats is True, intensity statistics and histograms of each tile
+    are computed from the pyramid levels while they are written and saved next
+    to each project together with BDV display settings, see tile_stats
+    skip_background is a threshold or a predicate (see tile_filter) that is
+    evaluated on a cheap sample of each field before it is read. Fields that
+    fail it are left out of the projects (background_mode="exclude") or only
+    written to the pyramid levels that are at least BACKGROUND_DOWNSAMPLE times
+    coarser than the original (background_mode="coarse"). The decisions are
+    stored next to each project (tile_filter.csv).
+    if preview_downsample is not None, a preview project is written that only
+    contains the pyramid levels downsampled at least that many times in x and y.
+    They are computed from a strided read of each field (and for volumes of
+    every n-th plane, if the first of these levels is subsampled in z). The
+    XML describes the full-resolution tiles, so the project can later be
+    upgraded with upgrade_preview. Statistics are not collected for preview
+    tiles and tiles written at coarse levels only.
+    the field of each setup is stored next to each project (tile_fields.csv)
+    tile_callback is called with the number of bytes read after each tile
+    cancel is a threading.Event. If it is set, no further tile is started, the
+    writers are closed, the incomplete h5 files are removed and the cancelled
+    attribute of the returned ReadStats is set.
+    local_fields maps fields to staged copies (see staging.Staging) that are
+    read instead, the projects refer to the original fields.
+    cache is a tile_cache.TileCache for the projections, the coarse reads and
+    the background samples of the fields. Fields whose projection is cached
+    are not read at all when only projections are written.
+    concurrency is a concurrency.ConcurrencyController whose limits are shared
+    by all wells: read limits the planes read at once (instead of read_workers
+    per field), compute the tiles pyramided and written at once. Both are
+    adjusted to the measured throughput if they are adaptive. They only apply
+    with read_ahead > 0.
+    chunks whose values are all <= chunk_background are not stored in the h5
+    files and read as 0, the counts are printed. The default 0 only skips empty
+    chunks, None stores every chunk.
+    flatfield is a flatfield.FlatField the tiles are corrected with before their
+    pyramids are built, or "well" to estimate it from the samples of the fields
+    (those of skip_background if given, no additional full read). The profiles
+    are stored next to each project (flatfield.npz). Projections are corrected
+    after projecting, which is exact for the maximum and minimum.
+
+    Returns the ReadStats with the read throughput of this call
     """
+    import npy2bdv
+    import tile_index
+    import tile_stats
+
     print(f"Zspacing: {zspacing}")
+    started = time.perf_counter()
+    fields = list(matrix_screener_fields)
+    local_fields = local_fields or {}
+    coarse_fields = set()
+    report = None
+    estimator = None
+    if isinstance(flatfield, str):
+        from flatfield import FlatFieldEstimator
+
+        assert flatfield == "well", 'flatfield must be a FlatField, "well" or None'
+        estimator = FlatFieldEstimator(BACKGROUND_DOWNSAMPLE)
+    if skip_background is not None:
+        assert background_mode in tile_filter.MODES, f"background_mode must be one of {tile_filter.MODES}"
+        report = tile_filter.evaluate_fields(
+            fields,
+            skip_background,
+            downsample=BACKGROUND_DOWNSAMPLE,
+            jobs=jobs,
+            read_workers=read_workers,
+            local_fields=local_fields,
+            cache=cache,
+            on_sample=estimator.update if estimator is not None else None,
+        )
+        print(tile_filter.summary(report, background_mode))
+        if background_mode == "exclude":
+            fields = list(report.field[report.keep])
+        else:
+            coarse_fields = set(report.field[~report.keep])
+        report["setup"] = report.field.map({f: i for i, f in enumerate(fields)}).fillna(-1).astype(int)
+        if not fields:
+            print("No fields with content, nothing written")
+            stats = ReadStats()
+            stats.started, stats.finished = started, time.perf_counter()
+            return stats
+    if estimator is not None:
+        if report is None:
+            from flatfield import estimate_profiles
+
+            estimate_profiles(
+                fields,
+                BACKGROUND_DOWNSAMPLE,
+                jobs=jobs,
+                read_workers=read_workers,
+                local_fields=local_fields,
+                cache=cache,
+                estimator=estimator,
+            )
+        flatfield = estimator.profile()
+    if flatfield is not None:
+        print(flatfield)
+    proj_subsamp, proj_blockdim = PROJ_SUBSAMP, PROJ_BLOCKDIM
+    vol_subsamp, vol_blockdim = VOL_SUBSAMP, VOL_BLOCKDIM
+    # (z,y,x) subsampling of the reads of coarse fields
+    read_factor = (1, BACKGROUND_DOWNSAMPLE, BACKGROUND_DOWNSAMPLE)
+    if preview_downsample is not None:
+        proj_subsamp, proj_blockdim = preview_levels(PROJ_SUBSAMP, PROJ_BLOCKDIM, preview_downsample)
+        vol_subsamp, vol_blockdim = preview_levels(VOL_SUBSAMP, VOL_BLOCKDIM, preview_downsample)
+        if volume and projected and vol_subsamp[0][1:] != proj_subsamp[0][1:]:
+            raise RuntimeError("the first preview levels of volumes and projections differ in x and y")
+        read_factor = vol_subsamp[0] if volume else proj_subsamp[0]
+        coarse_fields = set(fields)
+    writers = []
     if projected:
         assert h5_proj_name is not None, "h5 output file for projections must be provided"
         bdv_proj_writer = npy2bdv.BdvWriter(
             h5_proj_name,
             nchannels=1,
-            ntiles=len(matrix_screener_fields),
-            subsamp=((1, 1, 1), (1, 2, 2), (1, 4, 4), (1, 8, 8), (1, 16, 16)),
-            blockdim=((1, 64, 64),),
+            ntiles=len(fields),
+            subsamp=proj_subsamp,
+            blockdim=proj_blockdim,
             compression="gzip",
+            background=chunk_background,
         )  # , (4,4,1)))
+        writers.append(bdv_proj_writer)
 
     if volume:
         assert h5_vol_name is not None, "h5 output file for volumes must be provided"
         bdv_vol_writer = npy2bdv.BdvWriter(
             h5_vol_name,
             nchannels=1,
-            ntiles=len(matrix_screener_fields),
-            subsamp=(
-                (1, 1, 1),
-                (1, 2, 2),
-                (1, 4, 4),
-                (1, 8, 8),
-                (2, 16, 16),
-                (4, 32, 32),
-            ),
-            blockdim=(
-                (64, 64, 64),
-                (64, 64, 64),
-                (64, 64, 64),
-                (64, 64, 64),
-                (32, 32, 32),
-                (16, 16, 16),
-            ),
+            ntiles=len(fields),
+            subsamp=vol_subsamp,
+            blockdim=vol_blockdim,
             compression="gzip",
+            background=chunk_background,
         )
+        writers.append(bdv_vol_writer)
 
     affine_matrix_template = np.array(
         ((1.0, 0.0, 0.0, 0.0), (0.0, 1.0, 0.0, 0.0), (0.0, 0.0, 1.0, 0.0))
     )
 
-    for tile_nr, field in enumerate(matrix_screener_fields):
-        print(f"Processing {tile_nr+1} out of {len(matrix_screener_fields)}:")
-        print(field)
-        stack, meta = get_field(field)
-        affine = affine_matrix_template.copy()
-        # Explanation for formula below:
-        # Stage position in metadata appears to be in units of metres (m)
-        # PhysicalSize appears to be micrometers per voxel (um/vox)
-        # therefore for the stageposition in voxel coordinates we need to
-        # scale from meters to um (factor 1000000) and then divide by um/vox
-        # the direction vectors should be either 1 or -1 and can be used
-        # to flip the direction of the coordinate axes.
-        affine[1, 3] = (
-            meta["Stage X"] * 1_000_000 / meta["PhysicalSize X"] * direction_x
-        )  # -2247191 #-2_000_000
-        affine[0, 3] = (
-            meta["Stage Y"] * 1_000_000 / meta["PhysicalSize Y"] * direction_y
-        )  # 2247191 #2_000_000
+    proj_stats = tile_stats.TileStatistics()
+    vol_stats = tile_stats.TileStatistics()
+    stats = ReadStats()
+    stats.started = started
+    read_limit = concurrency.read if concurrency is not None else None
+    compute_limit = concurrency.compute if concurrency is not None else None
+    if read_ahead > 0:
+        if read_limit is not None:
+            # the shared limit decides how many planes are read at once
+            read_workers = read_limit.maximum
+        _read = partial(read_field, read_workers=read_workers, stats=stats, jobs=jobs, limit=read_limit)
+    else:
+        _read = partial(get_field, jobs=jobs)
 
-        if volume:
-            _tmp_stack = np.copy(stack)
-            bdv_vol_writer.append_view(
-                _tmp_stack,
-                time=0,
-                channel=0,
-                m_affine=affine,
-                tile=tile_nr,
-                name_affine=f"tile {tile_nr} translation",
-                voxel_size_xyz=(meta["PhysicalSize X"], meta["PhysicalSize Y"], zspacing),
-                voxel_units="um",
-                calibration=(1, 1, zspacing / meta["PhysicalSize X"]),
-            )
-        if projected:
-            outstack = np.expand_dims(project_func(stack, axis=0), axis=0)
-            bdv_proj_writer.append_view(
-                outstack,
-                time=0,
-                channel=0,
-                m_affine=affine,
-                tile=tile_nr,
-                name_affine=f"proj. tile {tile_nr} translation",
-                # Projections are inherently 2D, so we just repeat the X voxel size for Z
-                voxel_size_xyz=(
-                    meta["PhysicalSize X"],
-                    meta["PhysicalSize Y"],
-                    meta["PhysicalSize X"],
-                ),
-                voxel_units="um",
-                # calibration=(1, 1, 1),
+    def _cache_key(field, kind, **params):
+        from tile_cache import source_key
+
+        return source_key(field, kind, jobs=jobs, **params)
+
+    def _projection_key(field):
+        return _cache_key(field, "projection", project=getattr(project_func, "__name__", repr(project_func)))
+
+    def _load(field):
+        """(stack, metadata, projection) of a field, the projection if it is cached"""
+        source = local_fields.get(field, field)
+        if field in coarse_fields:
+            if cache is None:
+                return read_coarse_field(source, read_factor[1], jobs, z_step=read_factor[0]) + (None,)
+            key = _cache_key(field, "coarse", downsample=read_factor[1], z_step=read_factor[0])
+            stack, meta = cache.lookup(key)
+            if stack is None:
+                stack, meta = read_coarse_field(source, read_factor[1], jobs, z_step=read_factor[0])
+                cache.put(key, stack, meta)
+            return stack, meta, None
+        projection = None
+        if cache is not None and projected:
+            projection, meta = cache.lookup(_projection_key(field))
+            if projection is not None and not volume:
+                return None, meta, projection
+        if read_ahead > 0 and not volume:
+            # only the projection is prefetched, not the stack
+            stack, meta, projection = read_projection(
+                source, project_func, read_workers, stats, jobs, limit=read_limit
             )
+            if cache is not None:
+                cache.put(_projection_key(field), projection, meta)
+            return stack, meta, projection
+        return _read(source) + (projection,)
+
+    def _correct(stack, coarse):
+        """the stack corrected with the flat-field, coarse reads are strided in y and x"""
+        if flatfield is None:
+            return stack
+        return flatfield.correct(stack, read_factor[1] if coarse else 1)
+
+    if read_ahead > 0:
+        stacks = prefetch(_load, fields, ahead=read_ahead)
+    else:
+        stacks = map(_load, fields)
+
+    cancelled = False
+    for tile_nr, (field, (stack, meta, projection)) in enumerate(zip(fields, stacks)):
+        if cancel is not None and cancel.is_set():
+            cancelled = True
+            break
+        print(f"Processing {tile_nr+1} out of {len(fields)}:")
+        print(field)
+        tile_bytes = 0
+        with compute_limit if compute_limit is not None else nullcontext():
+            affine = affine_matrix_template.copy()
+            affine[0, 3], affine[1, 3] = tile_offset(meta, direction_x, direction_y)
+            coarse = field in coarse_fields
+
+            if volume:
+                vol_view = dict(
+                    time=0,
+                    channel=0,
+                    m_affine=affine,
+                    tile=tile_nr,
+                    name_affine=f"tile {tile_nr} translation",
+                    voxel_size_xyz=(meta["PhysicalSize X"], meta["PhysicalSize Y"], zspacing),
+                    voxel_units="um",
+                    calibration=(1, 1, zspacing / meta["PhysicalSize X"]),
+                )
+                if coarse:
+                    shape = (meta["Size Z"], meta["Size Y"], meta["Size X"])
+                    bdv_vol_writer.append_view(None, virtual_stack_dim=shape, **vol_view)
+                    bdv_vol_writer.append_coarse_levels(_correct(stack, coarse), read_factor, time=0, tile=tile_nr)
+                    tile_bytes += stack.nbytes
+                else:
+                    # np.asarray reads the planes once, np.copy would copy the result again
+                    _tmp_stack = np.asarray(stack)
+                    tile_bytes += _tmp_stack.nbytes
+                    _tmp_stack = _correct(_tmp_stack, coarse)
+                    levels = bdv_vol_writer.append_view(_tmp_stack, **vol_view)
+                    if collect_stats:
+                        vol_stats.add(tile_nr, levels, field)
+            if projected:
+                if projection is None:
+                    projection = project_stack(stack, project_func)
+                    if cache is not None and not coarse:
+                        cache.put(_projection_key(field), projection, meta)
+                # the cache keeps the uncorrected projection
+                outstack = _correct(np.expand_dims(projection, axis=0), coarse)
+                tile_bytes += outstack.nbytes
+                proj_view = dict(
+                    time=0,
+                    channel=0,
+                    m_affine=affine,
+                    tile=tile_nr,
+                    name_affine=f"proj. tile {tile_nr} translation",
+                    # Projections are inherently 2D, so we just repeat the X voxel size for Z
+                    voxel_size_xyz=(
+                        meta["PhysicalSize X"],
+                        meta["PhysicalSize Y"],
+                        meta["PhysicalSize X"],
+                    ),
+                    voxel_units="um",
+                    # calibration=(1, 1, 1),
+                )
+                if coarse:
+                    shape = (1, meta["Size Y"], meta["Size X"])
+                    bdv_proj_writer.append_view(None, virtual_stack_dim=shape, **proj_view)
+                    factor = (1,) + tuple(read_factor[1:])
+                    bdv_proj_writer.append_coarse_levels(outstack, factor, time=0, tile=tile_nr)
+                else:
+                    levels = bdv_proj_writer.append_view(outstack, **proj_view)
+                    if collect_stats:
+                        proj_stats.add(tile_nr, levels, field)
+        if compute_limit is not None:
+            compute_limit.record(tile_bytes)
+        if tile_callback is not None:
+            tile_callback(getattr(stack, "nbytes", 0))
 
+    if cancelled:
+        if read_ahead > 0:
+            # waits for the read in flight
+            stacks.close()
+        for writer in writers:
+            writer.close()
+            os.remove(writer.filename)
+        print(f"Cancelled, removed the incomplete projects of {len(fields)} fields")
+        stats.cancelled = True
+        return stats
     if projected:
         bdv_proj_writer.write_xml_file(ntimes=1)
         bdv_proj_writer.close()
     if volume:
         bdv_vol_writer.write_xml_file(ntimes=1)
         bdv_vol_writer.close()
+    for writer in writers:
+        print(writer.chunk_summary())
+    stats.finished = time.perf_counter()
+    for h5_name, on, tstats, subsamp in (
+        (h5_proj_name, projected, proj_stats, proj_subsamp),
+        (h5_vol_name, volume, vol_stats, vol_subsamp),
+    ):
+        if on:
+            # preview projects have fewer levels, use the finest one if necessary
+            coarsest = len(subsamp) - 1
+            xml_name = os.path.splitext(h5_name)[0] + ".xml"
+            tile_index.write_tile_fields(xml_name, fields)
+            if report is not None:
+                tile_filter.write_report(report, xml_name)
+            if flatfield is not None:
+                from flatfield import PROFILE_FILE
+
+                flatfield.save(pathlib.Path(xml_name).parent / PROFILE_FILE)
+            if tstats.rows:
+                # tile_stats.csv, tile_histograms.npz and dataset.settings.xml
+                tstats.save(xml_name)
+            # store which tiles overlap with the project (tile_overlaps.csv)
+            tile_index.write_overlap_graph(xml_name)
+            if register:
+                import registration
+
+                registration.register_project(xml_name, level=min(register_level, coarsest))
+            if fuse_level is not None:
+                import fusion
+
+                fused_name = os.path.join(os.path.dirname(h5_name), "fused.h5")
+                fusion.fuse_project(xml_name, fused_name, level=min(fuse_level, coarsest))
+    if stats.nfields:
+        print(stats)
+    return stats
+
+
+def upgrade_preview(xml_filename, read_workers=4, jobs=None, project_func=np.max):
+    """
+    Replace the coarse levels of a preview project (see save_files_for_bigstitcher)
+    with the full pyramid, read from the fields listed in tile_fields.csv.
+
+    The XML, including any registration done on the preview, is kept: tile sizes
+    and positions are given in full-resolution pixels in both cases.
+    jobs and project_func must be the same as for the preview, a flat-field
+    correction of the preview is applied with its stored profiles.
+    """
+    import tile_index
+    import tile_stats
+    from flatfield import FlatField
+
+    xml_filename = pathlib.Path(xml_filename)
+    h5_name, setups, sizes, _ = tile_index.read_project(xml_filename)
+    fields = tile_index.read_tile_fields(xml_filename)
+    projected = all(sizes[s][2] == 1 for s in setups)
+    tmp_folder = xml_filename.parent / "upgrade"
+    tmp_folder.mkdir(exist_ok=True)
+    tmp_h5 = str(tmp_folder / "dataset.h5")
+    save_files_for_bigstitcher(
+        fields,
+        projected=projected,
+        volume=not projected,
+        h5_proj_name=tmp_h5,
+        h5_vol_name=tmp_h5,
+        project_func=project_func,
+        read_workers=read_workers,
+        jobs=jobs,
+        flatfield=FlatField.find(xml_filename),
+    )
+    _, _, new_sizes, _ = tile_index.read_project(tmp_folder / "dataset.xml")
+    if any(np.any(new_sizes[s] != sizes[s]) for s in setups):
+        raise RuntimeError(f"{xml_filename}: the fields do not match the preview project")
+    os.replace(tmp_h5, h5_name)
+    for name in [tile_stats.STATS_FILE, tile_stats.HISTOGRAM_FILE, "dataset.settings.xml"]:
+        if (tmp_folder / name).exists():
+            os.replace(tmp_folder / name, xml_filename.parent / name)
+    shutil.rmtree(tmp_folder)
+    print(f"upgraded {xml_filename} to full resolution")
+
+
+def well_folder(outfolder_base, kind: str, well: Tuple[int, int], plate: bool = False) -> pathlib.Path:
+    """ folder of the project of a well, kind is "projection" or "volume"
+
+    With plate=True, the folder of the well's partition of the plate project
+    (see plate_project).
+    """
+    u, v = well
+    folder = pathlib.Path(outfolder_base) / kind
+    if plate:
+        import plate_project
+
+        folder = pathlib.Path(outfolder_base) / plate_project.PLATE_FOLDER / kind / plate_project.PARTITIONS_FOLDER
+    return folder / f"chamber_{u}_{v}"
+
+
+def iter_chambers(root) -> Iterator[Tuple[pathlib.Path, List[pathlib.Path]]]:
+    """ walk the folder tree below root and yield each folder that contains
+    field-- folders together with those field folders (sorted), as soon as
+    the folder has been listed
+    """
+    folders = [pathlib.Path(root)]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = sorted(os.scandir(folder), key=lambda e: e.name)
+        except OSError:
+            continue
+        fields, subfolders = [], []
+        for entry in entries:
+            if entry.is_dir():
+                path = pathlib.Path(entry.path)
+                (fields if entry.name.startswith("field") else subfolders).append(path)
+        if fields:
+            yield folder, fields
+        # depth first, in name order
+        folders.extend(reversed(subfolders))
+
+
+def _field_df(fields: List[pathlib.Path]) -> "pd.DataFrame":
+    """ catalog of field folders with their chamber folder and u,v,x,y coordinates """
+    import pandas as pd
+
+    df = pd.DataFrame(
+        dict(field=[str(f) for f in fields], chamber=[str(f.parent) for f in fields]),
+        columns=["field", "chamber"],
+    )
+    if df.empty:
+        return pd.DataFrame(columns=["field", "chamber", "u", "v", "x", "y"])
+    df[["u", "v", "x", "y"]] = df["field"].apply(split_pathname)
+    return df.sort_values(["u", "v", "x", "y"])
+
+
+def _merge(parts: List["pd.DataFrame"], by: Optional[List[str]] = None) -> "pd.DataFrame":
+    """ concatenate the parts of a catalog that are not empty (sorted by the columns by) """
+    import pandas as pd
+
+    full = [p for p in parts if not p.empty]
+    if len(full) <= 1:
+        return full[0] if full else parts[0]
+    df = pd.concat(full)
+    return df.sort_values(by, kind="stable") if by is not None else df
 
 
 class Matrix_Mosaic_Processor(object):
     """Holds state and methods to convert files from a Matrix Screener scan for use in BigStitcher 
     """
 
-    def __init__(self, f: Union[str, pathlib.Path]) -> None:
+    def __init__(self, f: Union[str, pathlib.Path], discover: bool = True) -> None:
         """initialiaze a Matrix_Mosaic_Processor at the given Matrix Screener folder Path
         
         Parameters
         ----------
         f : Union[str, pathlib.Path]
             Folder location where the matrix screener output files are.
+        discover : bool
+            if True, all wells are found right away. Otherwise the processor
+            starts without wells and they are added by iterating over iter_wells.
         """
         self.matrix_folder: pathlib.Path = pathlib.Path(f)
-        self.df, self.uvwells = self._populate_file_df()
+        # the catalogs are kept as lists of the parts added by iter_wells and
+        # only concatenated when they are read, see df and planes
+        self._lock = threading.Lock()
+        self._df_parts = [_field_df([])]
+        self._plane_parts = None
+        self._generation = 0
+        self.uvwells = []
+        if discover:
+            self.df, self.uvwells = self._populate_file_df()
 
     def __str__(self) -> str:
         r = "Unique wells:\n"
@@ -234,7 +773,7 @@ class Matrix_Mosaic_Processor(object):
             r += str(i).zfill(3) + f": {well}\n"
         return r
 
-    def _populate_file_df(self) -> Tuple[pd.DataFrame, list]:
+    def _populate_file_df(self) -> Tuple["pd.DataFrame", list]:
         """ populates data frame with all fields of view comprising the matrix scan experiment
         
         Returns
@@ -243,31 +782,99 @@ class Matrix_Mosaic_Processor(object):
             Returns a tuple consisting of a data frame of all fields of view as well 
             as a list of unique (u,v) - well combinations 
         """
-        # find all field-- folders
-        print("finding fields recurively")
-        field_cands = self.matrix_folder.rglob("field*")
-        fields = list(filter(lambda x: x.is_dir(), field_cands))
-        if fields == []:
-            return pd.DataFrame, []
-        # find unique chamber-- folders
-        chambers = set([f.parent for f in fields])
-        # populate data frame
-        df = pd.DataFrame(
-            data=[map(lambda x: str(x), fields), map((lambda x: str(x.parent)), fields)]
-        ).transpose()
-        df.columns = ["field", "chamber"]
-        df[["u", "v", "x", "y"]] = df["field"].apply(split_pathname)
-        df = df.sort_values(["u", "v", "x", "y"])
-        # find unique combinations of u,v
-        # https://stackoverflow.com/questions/35268817/unique-combinations-of-values-in-selected-columns-in-pandas-data-frame-and-count
-
-        uvcombos = (
-            df.groupby(["u", "v"]).size().reset_index().rename(columns={0: "count"})
-        )
-        uvcombos = uvcombos.sort_values(["u", "v"])
-        uvwells = list(zip(uvcombos.u, uvcombos.v))
+        self.df, self.uvwells = _field_df([]), []
+        for _ in self.iter_wells():
+            pass
+        uvwells = sorted(self.uvwells)
         print(uvwells)
-        return df, uvwells
+        return self.df, uvwells
+
+    def iter_wells(self) -> Iterator[Tuple[int, int]]:
+        """ find the fields of the experiment chamber folder by chamber folder
+
+        After each chamber folder has been listed, its fields are added to
+        self.df and each (u,v) well that was not known before is appended to
+        self.uvwells and yielded. Wells keep their index in self.uvwells while
+        the discovery continues, so they can be processed right away.
+        """
+        print("finding fields recurively")
+        known = set(self.uvwells)
+        for _, fields in iter_chambers(self.matrix_folder):
+            part = _field_df(fields)
+            # once the planes have been listed, only the new fields are listed
+            planes = self._populate_plane_df(part) if self._plane_parts is not None else None
+            with self._lock:
+                self._df_parts.append(part)
+                self._generation += 1
+                if self._plane_parts is not None:
+                    if planes is None:
+                        # listed in the meantime, without this part
+                        self._plane_parts = None
+                    else:
+                        self._plane_parts.append(planes)
+            for u, v in part.groupby(["u", "v"]).size().index:
+                well = (u, v)
+                if well not in known:
+                    known.add(well)
+                    self.uvwells.append(well)
+                    yield well
+
+    @property
+    def df(self) -> "pd.DataFrame":
+        """ data frame with one row per field folder and its chamber folder and
+        u, v, x, y coordinates, sorted by u, v, x and y
+        """
+        with self._lock:
+            if len(self._df_parts) > 1:
+                self._df_parts = [_merge(self._df_parts, ["u", "v", "x", "y"])]
+            return self._df_parts[0]
+
+    @df.setter
+    def df(self, df: "pd.DataFrame") -> None:
+        with self._lock:
+            self._df_parts = [df]
+            self._plane_parts = None
+            self._generation += 1
+
+    @property
+    def planes(self) -> "pd.DataFrame":
+        """ data frame with one row per tif file of all fields of view
+
+        Besides the field folder and the file name, the columns hold the
+        numbers of the --<letter> fields of the file name in lower case, e.g.
+        j (scan job), e, o, t, z and c. The folders are only listed on first
+        access, fields found later by iter_wells are added as they are found.
+        """
+        with self._lock:
+            if self._plane_parts is not None:
+                if len(self._plane_parts) > 1:
+                    self._plane_parts = [_merge(self._plane_parts)]
+                return self._plane_parts[0]
+            generation = self._generation
+        df = self.df
+        planes = self._populate_plane_df(df)
+        with self._lock:
+            # the catalog may have grown in the meantime (see iter_wells)
+            if self._generation == generation:
+                self._plane_parts = [planes]
+        return planes
+
+    def _populate_plane_df(self, df: "pd.DataFrame") -> "pd.DataFrame":
+        import pandas as pd
+
+        rows = []
+        for field in df.field if not df.empty else []:
+            for f in list_planes(field):
+                tokens = {k.lower(): v for k, v in filename_fields(f).items()}
+                rows.append(dict(field=field, file=f, **tokens))
+        return pd.DataFrame(rows)
+
+    @property
+    def jobs(self) -> List[int]:
+        """ sorted list of the scan job numbers (--J) found in the experiment """
+        if self.planes.empty or "j" not in self.planes:
+            return []
+        return sorted(int(j) for j in self.planes.j.dropna().unique())
 
     def process_well(
         self,
@@ -276,36 +883,126 @@ class Matrix_Mosaic_Processor(object):
         projected: bool,
         volume: bool,
         zspacing: float,
+        read_workers: int = 4,
+        jobs: Optional[Collection[int]] = None,
+        register: bool = False,
+        fuse_level: Optional[int] = None,
+        skip_background=None,
+        background_mode: str = "exclude",
+        preview_downsample: Optional[int] = None,
+        progress: Optional[ConversionProgress] = None,
+        plate: bool = False,
+        staging=None,
+        cache: Optional["TileCache"] = None,
+        concurrency: Optional["ConcurrencyController"] = None,
+        roi: Optional["Roi"] = None,
+        chunk_background: Optional[int] = 0,
+        flatfield: Union[None, str, "FlatField"] = None,
     ):
 
         u, v = self.uvwells[wellindex]
+        try:
+            return self._process_well(
+                (u, v),
+                self._well_fields(wellindex, jobs, roi),
+                outfolder_base,
+                projected,
+                volume,
+                plate,
+                staging,
+                progress,
+                zspacing=zspacing,
+                read_workers=read_workers,
+                jobs=jobs,
+                register=register,
+                fuse_level=fuse_level,
+                skip_background=skip_background,
+                background_mode=background_mode,
+                preview_downsample=preview_downsample,
+                cache=cache,
+                concurrency=concurrency,
+                chunk_background=chunk_background,
+                flatfield=flatfield,
+            )
+        finally:
+            if staging is not None:
+                staging.release((u, v))
+
+    def _process_well(self, well, fields, outfolder_base, projected, volume, plate, staging, progress, **kwargs):
+        u, v = well
+        if progress is not None and progress.cancelled:
+            return
         h5_proj_name, h5_vol_name = None, None
 
         print("Processing %d,%d" % (u, v))
         if not (projected or volume):
             print("nothing to do")
             return
+        if not len(fields):
+            print(f"no images of scan job(s) {sorted(kwargs['jobs'] or [])} in well {u},{v}")
+            return
+        # with staging, the projects are written to scratch and published when complete
+        folders = {}
+        for kind, on in (("volume", volume), ("projection", projected)):
+            if on:
+                final = well_folder(outfolder_base, kind, well, plate)
+                local = staging.output_folder(final) if staging is not None else final
+                # a staged project creates its final folder when it is published
+                local.mkdir(parents=True, exist_ok=True)
+                folders[kind] = (local, final)
         if volume:
-            outfolder_vol = outfolder_base / "volume" / f"chamber_{u}_{v}"
-            outfolder_vol.mkdir(parents=True, exist_ok=True)
-            outfile_vol = outfolder_vol / "dataset.h5"
-            h5_vol_name = str(outfile_vol)
+            h5_vol_name = str(folders["volume"][0] / "dataset.h5")
         if projected:
-            outfolder_proj = outfolder_base / "projection" / f"chamber_{u}_{v}"
-            outfolder_proj.mkdir(parents=True, exist_ok=True)
-            outfile_proj = outfolder_proj / "dataset.h5"
-            h5_proj_name = str(outfile_proj)
+            h5_proj_name = str(folders["projection"][0] / "dataset.h5")
 
-        subset = self.df[(self.df.u == u) & (self.df.v == v)]
-
-        save_files_for_bigstitcher(
-            subset.field.values,
+        tile_callback, cancel = None, None
+        if progress is not None:
+            tile_callback, cancel = partial(progress.tile_done, well), progress.cancel_event
+        result = save_files_for_bigstitcher(
+            fields,
             projected,
             volume,
             h5_proj_name=h5_proj_name,
             h5_vol_name=h5_vol_name,
-            zspacing=zspacing,
+            tile_callback=tile_callback,
+            cancel=cancel,
+            local_fields=staging.local_fields(well) if staging is not None else None,
+            **kwargs,
         )
+        if result.cancelled:
+            for local, _ in folders.values():
+                if local.exists() and not any(local.iterdir()):
+                    local.rmdir()
+            return result
+        # a well that was complete when the conversion was cancelled is kept
+        if staging is not None:
+            for local, final in folders.values():
+                staging.publish(local, final)
+        if progress is not None:
+            progress.well_done(well)
+        return result
+
+    def _well_fields(
+        self, wellindex: int, jobs: Optional[Collection[int]] = None, roi: Optional["Roi"] = None
+    ):
+        """ field folders of a well, restricted to those containing images of jobs
+        and to those inside roi (see roi.Roi)
+        """
+        u, v = self.uvwells[wellindex]
+        subset = self.df[(self.df.u == u) & (self.df.v == v)]
+        if jobs is not None:
+            planes = self.planes
+            if not planes.empty and "j" not in planes:
+                raise RuntimeError(
+                    f"{self.matrix_folder}: the file names have no scan job (--J), "
+                    f"scan job(s) {sorted(jobs)} cannot be selected"
+                )
+            # only convert fields that contain images of the selected scan jobs
+            job_fields = planes[planes.j.isin(jobs)].field.unique() if not planes.empty else []
+            subset = subset[subset.field.isin(job_fields)]
+        if roi is not None:
+            subset = roi.select(subset, jobs)
+        return subset.field.values
 
     def process_wells(
         self,
@@ -314,16 +1011,231 @@ class Matrix_Mosaic_Processor(object):
         projected: bool = True,
         volume: bool = False,
         zspacing: float = 1.0,
+        read_workers: int = 4,
+        jobs: Optional[Collection[int]] = None,
+        dry_run: bool = False,
+        register: bool = False,
+        fuse_level: Optional[int] = None,
+        skip_background=None,
+        background_mode: str = "exclude",
+        preview_downsample: Optional[int] = None,
+        progress: Optional[ConversionProgress] = None,
+        plate: bool = False,
+        plate_layout: str = "stage",
+        verify: bool = False,
+        verify_sample: int = 0,
+        staging=None,
+        cache: Optional["TileCache"] = None,
+        concurrency: Optional["ConcurrencyController"] = None,
+        roi: Optional["Roi"] = None,
+        chunk_background: Optional[int] = 0,
+        flatfield: Union[None, str, "FlatField"] = None,
     ):
+        """process the given wells concurrently
+
+        With dry_run=True nothing is read or written; instead the plan with the
+        estimated output size, peak memory and runtime is printed and returned
+        (see plan_wells). After a real run the measured throughput is saved in
+        outfolder_base for the runtime estimates of later dry runs.
+        skip_background and background_mode select how fields without content
+        are handled, chunk_background which chunks are not stored, and
+        preview_downsample writes coarse preview projects, see
+        save_files_for_bigstitcher.
+        progress (a ConversionProgress) receives the finished tiles and wells.
+        Cancelling it stops the conversion after the tiles being written; the
+        wells finished until then are kept, the incomplete ones are removed.
+        With plate=True the wells are written as partitions of a single plate
+        project per kind, see write_plate_projects.
+        With verify=True every written project is read back completely and
+        verify_sample tiles of each are compared with the tifs, see verify.verify_project.
+        With a staging.Staging, the tifs of the next wells are copied to local
+        scratch while the current ones are converted, and the projects are
+        written to scratch and published to outfolder_base when complete.
+        With a tile_cache.TileCache, projections and coarse reads of fields
+        converted before are taken from the cache, see save_files_for_bigstitcher.
+        With a concurrency.ConcurrencyController, the reads and tile computations
+        of all wells share its limits; the best limits found are printed at the end.
+        With a roi.Roi, only the fields of each well inside the region are
+        read and converted, at their stage positions.
+        flatfield is a flatfield.FlatField the tiles of all wells are corrected
+        with, or "well" or "plate" to estimate the profiles per well or once
+        from the samples of the fields of all wells, see save_files_for_bigstitcher.
+        """
+        import planner
+
+        calibration_file = pathlib.Path(outfolder_base) / planner.CALIBRATION_FILE
+        if dry_run:
+            plan = self.plan_wells(
+                well_indices,
+                projected,
+                volume,
+                jobs=jobs,
+                calibration=planner.load_calibration(calibration_file),
+            )
+            print(planner.format_plan(plan))
+            return plan
+        if roi is not None:
+            print(roi)
+        well_fields = {tuple(self.uvwells[i]): self._well_fields(i, jobs, roi) for i in well_indices}
+        if flatfield == "plate":
+            from flatfield import estimate_profiles
+
+            flatfield = estimate_profiles(
+                [f for fields in well_fields.values() for f in fields],
+                BACKGROUND_DOWNSAMPLE,
+                jobs=jobs,
+                read_workers=read_workers,
+                cache=cache,
+            )
         _process = partial(
             self.process_well,
             outfolder_base=outfolder_base,
             projected=projected,
             volume=volume,
             zspacing=zspacing,
+            read_workers=read_workers,
+            jobs=jobs,
+            register=register,
+            fuse_level=fuse_level,
+            skip_background=skip_background,
+            background_mode=background_mode,
+            preview_downsample=preview_downsample,
+            progress=progress,
+            plate=plate,
+            staging=staging,
+            cache=cache,
+            concurrency=concurrency,
+            roi=roi,
+            chunk_background=chunk_background,
+            flatfield=flatfield,
         )
+        if progress is not None:
+            progress.set_wells({well: len(fields) for well, fields in well_fields.items()})
+        if staging is not None:
+            # in the order in which the pool below starts the wells
+            staging.stage_wells(list(well_fields.items()))
+        hits = cache.hits if cache is not None else 0
         with ThreadPoolExecutor() as p:
-            return list(p.map(_process, well_indices))
+            results = list(p.map(_process, well_indices))
+        if staging is not None:
+            staging.wait()
+        if cache is not None:
+            print(cache)
+        if concurrency is not None:
+            print(concurrency.summary())
+        if progress is not None and progress.cancelled:
+            print(f"Cancelled: {progress}")
+            return results
+        plate_projects = []
+        if plate:
+            plate_projects = self.write_plate_projects(
+                well_indices, outfolder_base, projected, volume, plate_layout
+            )
+        converted = [
+            (fields, r)
+            for fields, r in zip(well_fields.values(), results)
+            if r is not None and r.finished is not None
+        ]
+        if cache is not None and cache.hits > hits:
+            print("Fields were taken from the tile cache, the calibration is not updated")
+        elif converted and preview_downsample is None:
+            # the size of the source files (close to the pixel bytes the planner
+            # counts), whatever part of them was read. The time is that of the
+            # conversion alone, from the start of the first well to the end of
+            # the last one, registration, fusion and plate projects not included.
+            raw_bytes = sum(
+                os.path.getsize(f) for fields, _ in converted for field in fields for f in _field_planes(field, jobs)
+            )
+            output_bytes = sum(
+                os.path.getsize(f)
+                for f in self._output_files(well_indices, outfolder_base, projected, volume, plate)
+                if os.path.exists(f)
+            )
+            planner.save_calibration(
+                calibration_file,
+                projected,
+                volume,
+                raw_bytes,
+                output_bytes,
+                max(r.finished for _, r in converted) - min(r.started for _, r in converted),
+            )
+        if verify:
+            import verify as _verify
+
+            # the partitions are read through the links of the plate projects
+            projects = plate_projects or [
+                h5.with_suffix(".xml")
+                for h5 in self._output_files(well_indices, outfolder_base, projected, volume)
+                if h5.with_suffix(".xml").exists()
+            ]
+            reports = [_verify.verify_project(xml, sample=verify_sample, jobs=jobs) for xml in projects]
+            print(f"{sum(r['ok'] for r in reports)} of {len(reports)} projects verified ok")
+        return results
+
+    def _output_files(self, well_indices, outfolder_base, projected, volume, plate=False):
+        for wellindex in well_indices:
+            well = self.uvwells[wellindex]
+            for kind, on in (("projection", projected), ("volume", volume)):
+                if on:
+                    yield well_folder(outfolder_base, kind, well, plate) / "dataset.h5"
+
+    def write_plate_projects(
+        self,
+        well_indices: List[int],
+        outfolder_base: pathlib.Path,
+        projected: bool = True,
+        volume: bool = False,
+        layout: str = "stage",
+    ) -> List[pathlib.Path]:
+        """ merge the partitions written by process_wells(plate=True) into
+        plate/<projection|volume>/dataset.xml, see plate_project.merge_partitions.
+        Wells without a project (e.g. only background) are left out.
+        """
+        import plate_project
+
+        written = []
+        for kind, on in (("projection", projected), ("volume", volume)):
+            if not on:
+                continue
+            partitions = {}
+            for wellindex in well_indices:
+                well = tuple(self.uvwells[wellindex])
+                xml = well_folder(outfolder_base, kind, well, plate=True) / "dataset.xml"
+                if xml.exists():
+                    partitions[well] = xml
+            if not partitions:
+                continue
+            plate_xml = pathlib.Path(outfolder_base) / plate_project.PLATE_FOLDER / kind / "dataset.xml"
+            written.append(plate_project.merge_partitions(partitions, plate_xml, layout))
+        return written
+
+    def plan_wells(
+        self,
+        well_indices: List[int],
+        projected: bool = True,
+        volume: bool = False,
+        jobs: Optional[Collection[int]] = None,
+        calibration: Optional[dict] = None,
+    ) -> "pd.DataFrame":
+        """estimate tile count, Z range, raw bytes, output bytes, peak memory and
+        runtime for converting the given wells, per well and in total.
+
+        Only the file catalog and one tif header per well are read. The runtime
+        and compressed output size require calibration numbers from a previous
+        run (see planner.load_calibration).
+        """
+        import planner
+
+        return planner.plan_wells(
+            self,
+            well_indices,
+            projected,
+            volume,
+            proj_subsamp=PROJ_SUBSAMP,
+            vol_subsamp=VOL_SUBSAMP,
+            jobs=jobs,
+            calibration=calibration,
+        )
 
 
 def test_populate_file_df():
@@ -336,3 +1248,444 @@ def test_str():
     mp = Matrix_Mosaic_Processor("c:/Users/Volker/Data/Testset/")
     print(mp)
 
+
+def test_iter_wells():
+    """ the catalogs grow chamber by chamber and equal those of a full discovery """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for u, v, nx in ((1, 0, 2), (0, 0, 3), (0, 1, 1)):
+            chamber = pathlib.Path(tmp) / "experiment" / f"chamber--U{u:02d}--V{v:02d}"
+            for x in range(nx):
+                field = chamber / f"field--X{x:02d}--Y00"
+                field.mkdir(parents=True)
+                for z in range(2):
+                    name = f"image--L0000--S00--U{u:02d}--V{v:02d}--J09--E00--O00--X{x:02d}--Y00--T0000--Z{z:02d}--C00.ome.tif"
+                    (field / name).touch()
+        full = Matrix_Mosaic_Processor(tmp)
+        mp = Matrix_Mosaic_Processor(tmp, discover=False)
+        assert mp.df.empty and mp.planes.empty
+        wells = mp.iter_wells()
+        assert next(wells) == (0, 0)
+        assert len(mp.df) == 3 and len(mp.planes) == 6 and mp.jobs == [9]
+        # the planes are extended with the fields found later
+        assert list(wells) == [(0, 1), (1, 0)]
+        assert mp.uvwells == [(0, 0), (0, 1), (1, 0)] == full.uvwells
+        assert mp.df.equals(full.df)
+        assert sorted(mp.planes.file) == sorted(full.planes.file) and len(mp.planes) == 12
+        assert list(mp._well_fields(2)) == list(full.df.field[full.df.u == 1])
+        assert list(mp._well_fields(0, jobs={9})) == list(mp._well_fields(0)) and not len(mp._well_fields(0, jobs={8}))
+
+
+def test_well_fields_without_jobs():
+    """ scan jobs cannot be selected if the file names have no --J """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        field = pathlib.Path(tmp) / "chamber--U00--V00" / "field--X00--Y00"
+        field.mkdir(parents=True)
+        (field / "image--U00--V00--X00--Y00--Z00.ome.tif").touch()
+        mp = Matrix_Mosaic_Processor(tmp)
+        assert mp.jobs == [] and list(mp._well_fields(0)) == [str(field)]
+        try:
+            mp._well_fields(0, jobs={9})
+        except RuntimeError as e:
+            assert "--J" in str(e)
+        else:
+            raise AssertionError("selecting a scan job without --J must fail")
+
+
+def write_test_field(
+    root, stack: np.ndarray, stage_position=(0.0, 0.0), pixel_size: float = 0.5, u=0, v=0, x=0, y=0, job=9
+) -> str:
+    """ write a (z,y,x) uint16 stack as a matrix screener field folder below root,
+    one OME-TIFF per Z plane with the metadata that get_meta_from_matrix_ome_tif
+    reads. stage_position is the (x, y) stage position in m. Returns the field
+    folder. Used by the tests.
+    """
+    import tifffile
+
+    field = pathlib.Path(root) / f"chamber--U{u:02d}--V{v:02d}" / f"field--X{x:02d}--Y{y:02d}"
+    field.mkdir(parents=True, exist_ok=True)
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06"><Image ID="Image:0">'
+        f'<Pixels ID="Pixels:0" DimensionOrder="XYZCT" Type="uint16" SizeX="{stack.shape[2]}" '
+        f'SizeY="{stack.shape[1]}" SizeZ="1" SizeC="1" SizeT="1" PhysicalSizeX="{pixel_size}" '
+        f'PhysicalSizeY="{pixel_size}"><Plane TheZ="0" TheC="0" TheT="0"><StagePosition '
+        f'PositionX="{stage_position[0]}" PositionY="{stage_position[1]}" PositionZ="0"/></Plane>'
+        "</Pixels></Image></OME>"
+    )
+    for z, plane in enumerate(stack):
+        name = (
+            f"image--L0000--S00--U{u:02d}--V{v:02d}--J{job:02d}--E00--O00"
+            f"--X{x:02d}--Y{y:02d}--T0000--Z{z:02d}--C00.ome.tif"
+        )
+        tifffile.imwrite(field / name, plane, description=xml, metadata=None)
+    return str(field)
+
+
+def test_save_files_cancelled():
+    """ a cancelled conversion removes its incomplete projects """
+    import tempfile
+    import threading
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        fields = [
+            write_test_field(tmp, rng.integers(0, 4000, (3, 64, 64), dtype=np.uint16), (x * 3e-5, 0.0), x=x)
+            for x in range(3)
+        ]
+        meta, nz = get_field_meta(fields[1])
+        assert nz == 3 and meta["Size X"] == meta["Size Y"] == 64 and meta["PhysicalSize X"] == 0.5
+        assert (meta["Stage X"], meta["Stage Y"]) == (3e-5, 0.0)
+        folders = {kind: tmp / kind for kind in ("projection", "volume")}
+        for folder in folders.values():
+            folder.mkdir()
+        names = dict(
+            h5_proj_name=str(folders["projection"] / "dataset.h5"),
+            h5_vol_name=str(folders["volume"] / "dataset.h5"),
+        )
+        # cancelled after the first tile
+        cancel = threading.Event()
+        stats = save_files_for_bigstitcher(
+            fields, True, True, **names, tile_callback=lambda nbytes: cancel.set(), cancel=cancel
+        )
+        assert stats.cancelled and stats.finished is None
+        assert not any(any(folder.iterdir()) for folder in folders.values())
+
+        stats = save_files_for_bigstitcher(fields, True, True, **names, cancel=threading.Event())
+        assert not stats.cancelled and stats.nfields == 3 and stats.finished >= stats.started
+        for folder in folders.values():
+            assert (folder / "dataset.h5").exists() and (folder / "dataset.xml").exists()
+
+
+# modules that must not be loaded before the GUI window or --help appear
+HEAVY_MODULES = ("pandas", "h5py", "tifffile", "tifffolder", "skimage", "scipy")
+
+
+def test_startup_imports():
+    """ the GUI and the --help of the command line tools do not load any of HEAVY_MODULES """
+    import subprocess
+    import sys
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for code in [
+        "import lm2bs_gui",
+        "import process_matrix_screener_data as m; m.main(['--help'])",
+        "import fiji_runner as m; m.main(['--help'])",
+    ]:
+        # the modules loaded after the startup path, --help exits through SystemExit
+        script = (
+            "import sys, time\n"
+            "t0 = time.perf_counter()\n"
+            "try:\n"
+            f"    {code}\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(time.perf_counter() - t0)\n"
+            f"print(' '.join(sorted(m for m in sys.modules if m.split('.')[0] in {HEAVY_MODULES!r})))\n"
+        )
+        proc = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=folder,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        assert proc.returncode == 0, proc.stderr[-2000:]
+        lines = proc.stdout.splitlines()
+        seconds, loaded = float(lines[-2]), lines[-1].split()
+        # for information only, the time depends on the machine and its load
+        print(f"{code}: {seconds:.2f} s, {len(loaded)} heavy modules")
+        assert not loaded, f"{code} imports {loaded[:5]}"
+
+
+def main(argv=None):
+    import argparse
+    from concurrency import AdaptiveLimit, ConcurrencyController
+    from tile_cache import DEFAULT_CACHE_FOLDER, TileCache
+
+    parser = argparse.ArgumentParser(
+        description="Convert Leica Matrix Screener scans into BigStitcher projects"
+    )
+    parser.add_argument("input", help="folder containing the matrix screener scan")
+    parser.add_argument("output", help="folder in which the projects are written")
+    parser.add_argument(
+        "--wells", type=int, nargs="+", help="indices of the wells to process (default: all)"
+    )
+    parser.add_argument(
+        "--no-projected", action="store_true", help="do not create 2D projection projects"
+    )
+    parser.add_argument("--volume", action="store_true", help="create 3D projects")
+    parser.add_argument("--zspacing", type=float, default=1.0, help="Z spacing in um")
+    parser.add_argument("--jobs", type=int, nargs="+", help="scan jobs (--J) to convert")
+    parser.add_argument("--read-workers", type=int, default=4)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the estimated output size, memory and runtime",
+    )
+    parser.add_argument(
+        "--register",
+        action="store_true",
+        help="register the tiles by phase correlation after conversion",
+    )
+    parser.add_argument(
+        "--fuse",
+        type=int,
+        metavar="LEVEL",
+        help="fuse the tiles at this pyramid level into fused.h5 after conversion",
+    )
+    parser.add_argument(
+        "--skip-background",
+        type=float,
+        metavar="THRESHOLD",
+        help="treat fields whose sampled 99.9th percentile is below THRESHOLD as background",
+    )
+    parser.add_argument(
+        "--background-mode",
+        choices=tile_filter.MODES,
+        default="exclude",
+        help="leave background fields out (default) or write them at coarse levels only",
+    )
+    parser.add_argument(
+        "--chunk-background",
+        type=int,
+        default=0,
+        metavar="LEVEL",
+        help="do not store h5 chunks whose values are all <= LEVEL, they read as 0 (default 0: empty chunks only)",
+    )
+    parser.add_argument(
+        "--flatfield",
+        choices=("well", "plate"),
+        help="estimate flat-field and dark-field profiles per well or per plate and correct the tiles",
+    )
+    parser.add_argument(
+        "--flatfield-profile",
+        metavar="FILE",
+        help="correct the tiles with profiles stored before (flatfield.npz next to a project)",
+    )
+    parser.add_argument(
+        "--preview-project",
+        type=int,
+        metavar="DOWNSAMPLE",
+        help="only write the pyramid levels downsampled at least DOWNSAMPLE times in x and y",
+    )
+    parser.add_argument(
+        "--upgrade",
+        action="store_true",
+        help="replace the preview projects in the output folder by full-resolution ones",
+    )
+    parser.add_argument(
+        "--plate",
+        action="store_true",
+        help="write all wells into one plate project per kind (plate/projection, plate/volume)",
+    )
+    parser.add_argument(
+        "--plate-layout",
+        choices=("stage", "grid"),
+        default="stage",
+        help="place the wells of a plate project at their stage positions (default) or on a grid",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="read every written project back completely, the result is saved in lm2bs_verify.json",
+    )
+    parser.add_argument(
+        "--verify-sample",
+        type=int,
+        default=0,
+        metavar="N",
+        help="with --verify, also compare N random tiles of each project with the source tifs",
+    )
+    parser.add_argument(
+        "--scratch",
+        metavar="FOLDER",
+        help="local folder to stage the tifs of the next wells and the projects being written",
+    )
+    parser.add_argument(
+        "--scratch-limit",
+        type=float,
+        default=20.0,
+        metavar="GB",
+        help="maximum size of the tifs staged at a time (default 20 GB)",
+    )
+    parser.add_argument(
+        "--scratch-reserve",
+        type=float,
+        default=10.0,
+        metavar="GB",
+        help="write projects directly to the output folder when scratch has less free space (default 10 GB)",
+    )
+    parser.add_argument(
+        "--scratch-mode",
+        choices=("copy", "fadvise"),
+        default="copy",
+        help="copy the tifs to scratch (default) or only prefetch them into the page cache",
+    )
+    parser.add_argument(
+        "--keep-scratch", action="store_true", help="do not delete the scratch folder at the end"
+    )
+    parser.add_argument(
+        "--roi-box",
+        type=float,
+        nargs=4,
+        metavar=("X0", "Y0", "X1", "Y1"),
+        help="only convert the fields overlapping this stage bounding box (um)",
+    )
+    parser.add_argument(
+        "--roi-fields",
+        type=int,
+        nargs=4,
+        metavar=("X0", "X1", "Y0", "Y1"),
+        help="only convert the fields with --X and --Y indices in these inclusive ranges",
+    )
+    parser.add_argument(
+        "--roi-polygon",
+        action="append",
+        metavar='"X,Y X,Y X,Y ..."',
+        help="only convert the fields overlapping this polygon in stage coordinates (um), may be repeated",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="adjust the concurrent plane reads and tile computations to the measured throughput",
+    )
+    parser.add_argument(
+        "--read-concurrency",
+        type=int,
+        metavar="N",
+        help="read at most N planes at once across all wells (instead of --read-workers per field)",
+    )
+    parser.add_argument(
+        "--compute-workers",
+        type=int,
+        metavar="N",
+        help="pyramid, compress and write at most N tiles at once",
+    )
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=str(DEFAULT_CACHE_FOLDER),
+        metavar="FOLDER",
+        help=f"cache projections and coarse reads of the fields (default folder {DEFAULT_CACHE_FOLDER})",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=20.0,
+        metavar="GB",
+        help="delete the least recently used cache entries above this size (default 20 GB)",
+    )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        help="only write stage-position preview mosaics of the wells and the plate",
+    )
+    args = parser.parse_args(argv)
+    if args.flatfield is not None and args.flatfield_profile is not None:
+        parser.error("--flatfield and --flatfield-profile are mutually exclusive")
+
+    mp = Matrix_Mosaic_Processor(args.input)
+    print(mp)
+    wells = args.wells if args.wells is not None else list(range(len(mp.uvwells)))
+    if args.preview:
+        import preview
+
+        outfolder = pathlib.Path(args.output) / "preview"
+        outfolder.mkdir(parents=True, exist_ok=True)
+        for wellindex in wells:
+            u, v = mp.uvwells[wellindex]
+            image, _ = preview.well_mosaic(mp, wellindex, jobs=args.jobs)
+            preview.save_preview(outfolder / f"chamber_{u}_{v}.png", image)
+        image, _ = preview.plate_mosaic(mp, wells, jobs=args.jobs)
+        preview.save_preview(outfolder / "plate.png", image)
+        return
+    if args.upgrade:
+        projects = mp._output_files(wells, args.output, not args.no_projected, args.volume, args.plate)
+        for h5_name in projects:
+            if h5_name.with_suffix(".xml").exists():
+                upgrade_preview(h5_name.with_suffix(".xml"), args.read_workers, args.jobs)
+        if args.plate:
+            import plate_project
+
+            # the resolutions in the master h5 change, the plate XML is kept
+            for kind in ("projection", "volume"):
+                plate_xml = pathlib.Path(args.output) / plate_project.PLATE_FOLDER / kind / "dataset.xml"
+                if plate_xml.exists():
+                    plate_project.write_plate_h5(plate_xml, plate_project.read_partitions(plate_xml))
+        return
+    staging = None
+    if args.scratch is not None:
+        from staging import Staging
+
+        staging = Staging(
+            args.scratch,
+            max_input_bytes=int(args.scratch_limit * 1e9),
+            min_free_bytes=int(args.scratch_reserve * 1e9),
+            mode=args.scratch_mode,
+            keep=args.keep_scratch,
+        )
+    concurrency = None
+    if args.adaptive:
+        concurrency = ConcurrencyController.adaptive(args.read_concurrency, args.compute_workers)
+    elif args.read_concurrency is not None or args.compute_workers is not None:
+        concurrency = ConcurrencyController(
+            read=args.read_concurrency and AdaptiveLimit("read concurrency", args.read_concurrency),
+            compute=args.compute_workers and AdaptiveLimit("compute workers", args.compute_workers),
+        )
+    roi = None
+    if args.roi_box is not None or args.roi_fields is not None or args.roi_polygon:
+        from roi import Roi, parse_polygon
+
+        fields = args.roi_fields
+        roi = Roi(
+            box=args.roi_box,
+            x_range=None if fields is None else (fields[0], fields[1]),
+            y_range=None if fields is None else (fields[2], fields[3]),
+            polygons=[parse_polygon(p) for p in args.roi_polygon or []],
+        )
+    cache = None
+    if args.cache is not None:
+        cache = TileCache(args.cache, max_bytes=int(args.cache_size * 1e9))
+    flatfield = args.flatfield
+    if args.flatfield_profile is not None:
+        from flatfield import FlatField
+
+        flatfield = FlatField.load(args.flatfield_profile)
+    try:
+        return mp.process_wells(
+            wells,
+            pathlib.Path(args.output),
+            projected=not args.no_projected,
+            volume=args.volume,
+            zspacing=args.zspacing,
+            read_workers=args.read_workers,
+            jobs=args.jobs,
+            dry_run=args.dry_run,
+            register=args.register,
+            fuse_level=args.fuse,
+            skip_background=args.skip_background,
+            background_mode=args.background_mode,
+            preview_downsample=args.preview_project,
+            plate=args.plate,
+            plate_layout=args.plate_layout,
+            verify=args.verify,
+            verify_sample=args.verify_sample,
+            staging=staging,
+            cache=cache,
+            concurrency=concurrency,
+            roi=roi,
+            chunk_background=args.chunk_background,
+            flatfield=flatfield,
+        )
+    finally:
+        if staging is not None:
+            staging.close()
+
+
+if __name__ == "__main__":
+    main()
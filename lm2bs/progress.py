@@ -0,0 +1,137 @@
+# Progress, throughput and cancellation of a running conversion
+#
+# process_wells converts several wells concurrently. ConversionProgress
+# collects the finished tiles and bytes of all of them, computes read
+# throughput and a remaining-time estimate, reports snapshots to a callback
+# (e.g. a Qt signal) and carries the event used to cancel the conversion.
+#
+# License BSD-3
+
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+Well = Tuple[int, int]
+
+
+class ConversionProgress(object):
+    """thread-safe progress of a conversion of several wells
+
+    Parameters
+    ----------
+    callback : Optional[Callable[[dict], None]]
+        called with a snapshot (see snapshot) whenever a tile or well is finished.
+        It is called from the conversion threads.
+    clock : Callable[[], float]
+        the time in seconds the throughput and remaining time are computed with
+    """
+
+    def __init__(
+        self, callback: Optional[Callable[[dict], None]] = None, clock: Callable[[], float] = time.perf_counter
+    ) -> None:
+        self._lock = threading.Lock()
+        self.callback = callback
+        self.clock = clock
+        self.cancel_event = threading.Event()
+        self.tiles: Dict[Well, int] = {}
+        self.done: Dict[Well, int] = {}
+        self.finished = set()
+        self.nbytes = 0
+        self.t0 = self.clock()
+
+    def set_wells(self, tiles: Dict[Well, int]) -> None:
+        """register the wells to convert and their number of tiles"""
+        with self._lock:
+            self.tiles = dict(tiles)
+            self.done = {well: 0 for well in tiles}
+            self.finished = set()
+            self.nbytes = 0
+            self.t0 = self.clock()
+        self._report()
+
+    def tile_done(self, well: Well, nbytes: int) -> None:
+        with self._lock:
+            self.done[well] = self.done.get(well, 0) + 1
+            self.nbytes += nbytes
+        self._report()
+
+    def well_done(self, well: Well) -> None:
+        with self._lock:
+            self.finished.add(well)
+            # wells may write fewer tiles than planned, e.g. when skipping background
+            self.done[well] = self.tiles.get(well, self.done.get(well, 0))
+        self._report()
+
+    def cancel(self) -> None:
+        """stop after the tiles currently being written, see save_files_for_bigstitcher"""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def snapshot(self) -> dict:
+        """wells, tiles and bytes done so far, MB/s read and the estimated seconds left"""
+        with self._lock:
+            tiles_total = sum(self.tiles.values())
+            tiles_done = sum(self.done.values())
+            seconds = self.clock() - self.t0
+            eta = None
+            if tiles_done:
+                eta = seconds * (tiles_total - tiles_done) / tiles_done
+            return dict(
+                wells_total=len(self.tiles),
+                wells_done=len(self.finished),
+                tiles_total=tiles_total,
+                tiles_done=tiles_done,
+                nbytes=self.nbytes,
+                mb_per_s=self.nbytes / 1e6 / seconds if seconds > 0 else 0.0,
+                eta_seconds=eta,
+                cancelled=self.cancel_event.is_set(),
+            )
+
+    def _report(self) -> None:
+        if self.callback is not None:
+            self.callback(self.snapshot())
+
+    def __str__(self) -> str:
+        s = self.snapshot()
+        eta = "unknown" if s["eta_seconds"] is None else f"{s['eta_seconds'] / 60:.1f} min"
+        return (
+            f"{s['wells_done']}/{s['wells_total']} wells, {s['tiles_done']}/{s['tiles_total']} tiles, "
+            f"{s['mb_per_s']:.1f} MB/s, {eta} left"
+        )
+
+
+def test_conversion_progress():
+    """throughput and remaining time with a fake clock, tiles and wells done and cancelling"""
+    now = [100.0]
+    snapshots = []
+    progress = ConversionProgress(snapshots.append, clock=lambda: now[0])
+    progress.set_wells({(0, 0): 4, (1, 0): 2})
+    assert snapshots[-1]["tiles_total"] == 6 and snapshots[-1]["eta_seconds"] is None
+    assert snapshots[-1]["mb_per_s"] == 0.0 and str(progress).endswith("unknown left")
+
+    now[0] += 10
+    progress.tile_done((0, 0), 30_000_000)
+    progress.tile_done((1, 0), 20_000_000)
+    s = progress.snapshot()
+    assert s["tiles_done"] == 2 and s["nbytes"] == 50_000_000 and s["mb_per_s"] == 5.0
+    # 2 tiles in 10 s, 4 tiles left
+    assert s["eta_seconds"] == 20.0 and len(snapshots) == 3
+    assert str(progress) == "0/2 wells, 2/6 tiles, 5.0 MB/s, 0.3 min left"
+
+    # a well that skipped a tile counts as complete
+    now[0] += 10
+    progress.well_done((1, 0))
+    s = snapshots[-1]
+    assert s["wells_done"] == 1 and s["tiles_done"] == 3 and s["mb_per_s"] == 2.5
+    assert s["eta_seconds"] == 20.0 and not s["cancelled"]
+
+    assert not progress.cancelled and not progress.cancel_event.is_set()
+    progress.cancel()
+    assert progress.cancelled and progress.cancel_event.is_set() and progress.snapshot()["cancelled"]
+
+    # registering the wells again starts from scratch
+    progress.set_wells({(2, 0): 1})
+    assert snapshots[-1]["tiles_done"] == 0 and snapshots[-1]["wells_total"] == 1
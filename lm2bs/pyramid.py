@@ -0,0 +1,345 @@
+# Adding and rebuilding the pyramid levels of existing projects
+#
+# A project written with too few pyramid levels (e.g. the five levels of
+# the projections) or with an unsuitable chunk size or compression used to
+# require a new conversion from the tifs. rebuild_project instead rewrites
+# the dataset.h5 from itself: levels that are kept are copied (chunk by chunk
+# without decompression if their chunking and compression do not change),
+# new levels are computed block by block from the full-resolution level (see
+# npy2bdv.downsample_blockwise), so they equal those written by a conversion,
+# and the resolutions and subdivisions of each setup are updated. Tiles that
+# were written at coarse levels only (see tile_filter) have an empty
+# full-resolution level, their new levels are computed from the finest level
+# that is stored. The new h5
+# replaces the old one when complete, or is written as a new project.
+#
+# License BSD-3
+
+import os
+import pathlib
+import shutil
+import h5py
+import numpy as np
+from xml.etree import ElementTree as ET
+from typing import Collection, List, Optional, Sequence, Tuple
+
+import npy2bdv
+import tile_filter
+import tile_index
+
+Level = Tuple[int, int, int]
+
+# compression argument of rebuild_project, "keep" keeps that of each level
+COMPRESSIONS = ("keep", "gzip", "lzf", "none")
+
+# chunk cache of the source h5, so rechunking reads each source chunk once
+SOURCE_CHUNK_CACHE = 256 * 1024 * 1024
+
+
+def parse_levels(text: str) -> Tuple[Level, ...]:
+    """(z,y,x) levels from text like "1,1,1 1,2,2 1,4,4" """
+    levels = tuple(tuple(int(c) for c in level.split(",")) for level in text.split())
+    assert all(len(level) == 3 for level in levels), "levels are given as z,y,x"
+    return levels
+
+
+def extend_levels(subsamp, add: int, volume: bool) -> Tuple[Level, ...]:
+    """subsamp with add coarser levels, each halving y and x of the previous one
+
+    For volumes, z is halved as well once y and x are subsampled at least 8
+    times, as in VOL_SUBSAMP.
+    """
+    levels = [tuple(int(c) for c in level) for level in subsamp]
+    for _ in range(add):
+        z, y, x = levels[-1]
+        levels.append((2 * z if volume and min(y, x) >= 8 else z, 2 * y, 2 * x))
+    return tuple(levels)
+
+
+def _copy_level(src, group, chunks, compression) -> None:
+    """copy the dataset src into group as cells, with the given chunks and compression"""
+    if src.chunks == tuple(chunks) and src.compression == compression:
+        # copies the compressed chunks as they are
+        group.file.copy(src, group, name="cells")
+        return
+    dst = group.create_dataset(
+        "cells",
+        shape=src.shape,
+        dtype=src.dtype,
+        chunks=tuple(chunks),
+        maxshape=(None, None, None),
+        compression=compression,
+    )
+    block = np.asarray(chunks)
+    shape = np.asarray(src.shape)
+    for start in np.ndindex(*(-(-shape // block))):
+        lo = np.asarray(start) * block
+        region = tuple(slice(a, min(a + b, n)) for a, b, n in zip(lo, block, shape))
+        dst[region] = src[region]
+
+
+def coarse_setups(xml_filename) -> List[int]:
+    """the setups of a project that were written at coarse levels only (tile_filter.csv)"""
+    import pandas as pd
+
+    report_file = pathlib.Path(xml_filename).parent / tile_filter.REPORT_FILE
+    if not report_file.exists():
+        return []
+    report = pd.read_csv(report_file)
+    return sorted(int(s) for s in report.setup[~report.keep & (report.setup >= 0)])
+
+
+def _base_level(src, timepoint: str, setup: int, old: Sequence[Level]) -> int:
+    """index of the finest level of a coarse-only setup that holds data"""
+    for i in range(len(old)):
+        if src[f"{timepoint}/s{setup:02d}/{i}/cells"].id.get_num_chunks():
+            return i
+    # nothing is stored, every level reads as 0
+    return 0
+
+
+def _rebuild_h5(
+    src_name,
+    dst_name,
+    levels: Optional[Sequence[Level]],
+    add_levels: int,
+    blockdim,
+    compression: str,
+    rebuild: bool,
+    coarse: Collection[int] = (),
+) -> List[Tuple[int, Tuple[Level, ...]]]:
+    """write dst_name from src_name with the new levels, returns the levels of each setup
+
+    The setups in coarse have data at their coarse levels only, new levels
+    are computed from the finest of those. Levels finer than it stay empty.
+    """
+    result = []
+    with h5py.File(str(src_name), "r", rdcc_nbytes=SOURCE_CHUNK_CACHE) as src, h5py.File(
+        str(dst_name), "w"
+    ) as dst:
+        setups = sorted(int(name[1:]) for name in src if name.startswith("s"))
+        timepoints = sorted(name for name in src if name.startswith("t"))
+        for name in src:
+            # anything lm2bs does not write is copied as it is
+            if not (name.startswith("s") or name.startswith("t")):
+                src.copy(src[name], dst, name=name)
+        for setup in setups:
+            old = [tuple(int(c) for c in level) for level in np.flip(src[f"s{setup:02d}/resolutions"][()], 1)]
+            old_chunks = [tuple(c) for c in np.flip(src[f"s{setup:02d}/subdivisions"][()], 1).astype(int)]
+            first = src[f"{timepoints[0]}/s{setup:02d}/0/cells"]
+            new = tuple(tuple(level) for level in levels) if levels is not None else tuple(old)
+            new = extend_levels(new, add_levels, volume=first.shape[0] > 1)
+            assert new[0] == (1, 1, 1), "the first level must be the full resolution (1,1,1)"
+            if blockdim is None:
+                # new levels get the chunks of the coarsest old level
+                chunks = [old_chunks[old.index(l)] if l in old else old_chunks[-1] for l in new]
+            elif len(blockdim) >= len(new):
+                chunks = [tuple(b) for b in blockdim[: len(new)]]
+            else:
+                chunks = [tuple(blockdim[0])] * len(new)
+            for t in timepoints:
+                base = _base_level(src, t, setup, old) if setup in coarse else 0
+                for i, level in enumerate(new):
+                    group = dst.create_group(f"{t}/s{setup:02d}/{i}")
+                    if compression == "keep":
+                        comp = src[f"{t}/s{setup:02d}/{old.index(level) if level in old else 0}/cells"].compression
+                    else:
+                        comp = None if compression == "none" else compression
+                    if level in old and (old.index(level) <= base or not rebuild):
+                        _copy_level(src[f"{t}/s{setup:02d}/{old.index(level)}/cells"], group, chunks[i], comp)
+                        continue
+                    shape = tuple(-(-np.asarray(first.shape) // level))
+                    cells = group.create_dataset(
+                        "cells",
+                        shape=shape,
+                        dtype="int16",
+                        chunks=chunks[i],
+                        maxshape=(None, None, None),
+                        compression=comp,
+                    )
+                    if base == 0:
+                        # from the full resolution, like npy2bdv.BdvWriter.append_view
+                        npy2bdv.downsample_blockwise(dst[f"{t}/s{setup:02d}/0/cells"], cells, level)
+                        continue
+                    # the finest stored level of a coarse-only tile that divides the new one
+                    sources = [j for j in range(base, len(old)) if not np.any(np.asarray(level) % old[j])]
+                    if sources:
+                        factor = np.asarray(level) // old[sources[0]]
+                        npy2bdv.downsample_blockwise(src[f"{t}/s{setup:02d}/{sources[0]}/cells"], cells, factor)
+            dst.create_dataset(f"s{setup:02d}/resolutions", data=np.flip(np.asarray(new), 1), dtype="<f8")
+            dst.create_dataset(f"s{setup:02d}/subdivisions", data=np.flip(np.asarray(chunks), 1), dtype="<i4")
+            result.append((setup, new))
+    return result
+
+
+def _copy_project_files(xml_filename: pathlib.Path, out_xml: pathlib.Path) -> None:
+    """the XML (referring to the new h5) and the tables next to it, for a new project"""
+    root = ET.parse(str(xml_filename)).getroot()
+    hdf5 = root.find("SequenceDescription/ImageLoader/hdf5")
+    hdf5.set("type", "relative")
+    hdf5.text = out_xml.with_suffix(".h5").name
+    ET.ElementTree(root).write(str(out_xml), xml_declaration=True, encoding="utf-8", method="xml")
+    for f in xml_filename.parent.iterdir():
+        if f.suffix in (".csv", ".npz") or f.name == xml_filename.stem + ".settings.xml":
+            name = f.name.replace(xml_filename.stem, out_xml.stem, 1) if f.name.endswith(".settings.xml") else f.name
+            if not (out_xml.parent / name).exists():
+                shutil.copyfile(f, out_xml.parent / name)
+
+
+def rebuild_project(
+    xml_filename,
+    levels: Optional[Sequence[Level]] = None,
+    add_levels: int = 0,
+    blockdim=None,
+    compression: str = "keep",
+    rebuild: bool = False,
+    out_xml=None,
+) -> pathlib.Path:
+    """add, rebuild, rechunk or recompress the pyramid levels of a project
+
+    Parameters
+    ----------
+    xml_filename : str
+        the project's dataset.xml. For a plate project (see plate_project),
+        all partitions are rebuilt and the master h5 is rewritten.
+    levels : Optional[Sequence[Level]]
+        the new (z,y,x) levels, starting with (1,1,1). Default: the existing ones.
+    add_levels : int
+        number of coarser levels appended to levels, see extend_levels
+    blockdim : Optional[Sequence[Level]]
+        (z,y,x) chunk size of each level, or a single one for all levels.
+        Default: the existing chunks, new levels get those of the coarsest level.
+    compression : str
+        "keep", "gzip", "lzf" or "none"
+    rebuild : bool
+        recompute all levels except the first one, even those that exist
+    out_xml : Optional[str]
+        write a new project instead of replacing the h5 of the existing one
+
+    Returns
+    -------
+    pathlib.Path
+        the XML of the rebuilt project
+    """
+    import plate_project
+    import verify
+
+    assert compression in COMPRESSIONS, f"compression must be one of {COMPRESSIONS}"
+    xml_filename = pathlib.Path(xml_filename)
+    if (xml_filename.parent / plate_project.PARTITIONS_FILE).exists():
+        if out_xml is not None:
+            raise RuntimeError(f"{xml_filename}: plate projects can only be rebuilt in place")
+        table = plate_project.read_partitions(xml_filename)
+        for partition in table.partition.unique():
+            rebuild_project(xml_filename.parent / partition, levels, add_levels, blockdim, compression, rebuild)
+        plate_project.write_plate_h5(xml_filename, table)
+        (xml_filename.parent / verify.VERIFY_FILE).unlink(missing_ok=True)
+        return xml_filename
+    h5_name, _, _, _ = tile_index.read_project(xml_filename)
+    if out_xml is None:
+        dst_name = pathlib.Path(h5_name).with_suffix(".rebuild.h5")
+    else:
+        out_xml = pathlib.Path(out_xml)
+        out_xml.parent.mkdir(parents=True, exist_ok=True)
+        dst_name = out_xml.with_suffix(".h5")
+        assert not dst_name.exists(), f"{dst_name} exists"
+    try:
+        result = _rebuild_h5(
+            h5_name, dst_name, levels, add_levels, blockdim, compression, rebuild, coarse_setups(xml_filename)
+        )
+    except BaseException:
+        dst_name.unlink()
+        raise
+    if out_xml is None:
+        os.replace(dst_name, h5_name)
+        # the checksums of the old h5 no longer apply
+        (xml_filename.parent / verify.VERIFY_FILE).unlink(missing_ok=True)
+        out_xml = xml_filename
+    else:
+        _copy_project_files(xml_filename, out_xml)
+    n = sorted({len(levels) for _, levels in result})
+    print(f"{out_xml}: {len(result)} setups with {'/'.join(map(str, n))} pyramid levels")
+    return out_xml
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Add, rebuild, rechunk or recompress the pyramid levels of existing BigStitcher projects"
+    )
+    parser.add_argument("folder", help="an lm2bs output folder or a single dataset.xml")
+    parser.add_argument("--levels", type=parse_levels, help='the (z,y,x) levels, e.g. "1,1,1 1,2,2 1,4,4"')
+    parser.add_argument("--add-levels", type=int, default=0, metavar="N", help="append N coarser levels")
+    parser.add_argument(
+        "--blockdim", type=parse_levels, help='(z,y,x) chunk size of all levels or of each, e.g. "64,64,64"'
+    )
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="keep")
+    parser.add_argument("--rebuild", action="store_true", help="recompute the existing levels as well")
+    parser.add_argument("--output", help="write a new project with this XML file (only for a single dataset.xml)")
+    args = parser.parse_args(argv)
+    from fiji_runner import find_projects
+
+    folder = pathlib.Path(args.folder)
+    projects = [folder] if folder.suffix == ".xml" else find_projects(folder)
+    if args.output is not None and len(projects) != 1:
+        raise SystemExit("--output needs a single project")
+    return [
+        rebuild_project(
+            xml, args.levels, args.add_levels, args.blockdim, args.compression, args.rebuild, args.output
+        )
+        for xml in projects
+    ]
+
+
+def test_rebuild_project():
+    """levels added to a project match those written by npy2bdv, and rechunking keeps the data"""
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 4000, (1, 96, 80), dtype=np.uint16)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        full = ((1, 1, 1), (1, 2, 2), (1, 4, 4), (1, 8, 8))
+        for name, subsamp in (("small", full[:2]), ("full", full)):
+            (tmp / name).mkdir()
+            writer = npy2bdv.BdvWriter(str(tmp / name / "dataset.h5"), subsamp=subsamp, blockdim=((1, 32, 32),), compression="gzip")
+            writer.append_view(stack, time=0)
+            writer.write_xml_file()
+            writer.close()
+        xml = rebuild_project(tmp / "small" / "dataset.xml", add_levels=2)
+        with h5py.File(tmp / "small" / "dataset.h5", "r") as a, h5py.File(tmp / "full" / "dataset.h5", "r") as b:
+            assert np.array_equal(a["s00/resolutions"][()], b["s00/resolutions"][()])
+            for i in range(4):
+                assert np.array_equal(a[f"t00000/s00/{i}/cells"][()], b[f"t00000/s00/{i}/cells"][()])
+        out = rebuild_project(xml, blockdim=((1, 16, 16),), compression="lzf", out_xml=tmp / "lzf" / "dataset.xml")
+        h5_name, setups, _, _ = tile_index.read_project(out)
+        with h5py.File(h5_name, "r") as f:
+            assert f["t00000/s00/0/cells"].chunks == (1, 16, 16)
+            assert f["t00000/s00/3/cells"].compression == "lzf"
+            assert np.array_equal(f["t00000/s00/0/cells"][()].view(np.uint16), stack)
+            assert f["s00/subdivisions"][0].tolist() == [16, 16, 1]
+
+        # a tile written at the coarse levels only (background_mode="coarse")
+        (tmp / "coarse").mkdir()
+        writer = npy2bdv.BdvWriter(str(tmp / "coarse" / "dataset.h5"), ntiles=2, subsamp=full[:3], blockdim=((1, 32, 32),))
+        writer.append_view(stack, time=0, tile=0)
+        writer.append_view(None, virtual_stack_dim=stack.shape, time=0, tile=1)
+        writer.append_coarse_levels(stack[:, ::4, ::4], (1, 4, 4), time=0, tile=1)
+        writer.write_xml_file()
+        writer.close()
+        with open(tmp / "coarse" / tile_filter.REPORT_FILE, "w") as f:
+            f.write("field,keep,setup\na,True,0\nb,False,1\n")
+        xml = tmp / "coarse" / "dataset.xml"
+        for kwargs in (dict(add_levels=1), dict(rebuild=True)):
+            rebuild_project(xml, **kwargs)
+            with h5py.File(tmp / "coarse" / "dataset.h5", "r") as f:
+                levels = [f[f"t00000/s01/{i}/cells"][()].view(np.uint16) for i in range(4)]
+                assert levels[0].max() == 0 and levels[1].max() == 0
+                assert np.array_equal(levels[2], stack[:, ::4, ::4])
+                expected = npy2bdv.BdvWriter.subsample_stack(None, levels[2], np.array((1, 2, 2)))
+                assert levels[3].max() > 0 and np.array_equal(levels[3], expected)
+
+
+if __name__ == "__main__":
+    main()
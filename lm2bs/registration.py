@@ -0,0 +1,380 @@
+# Pairwise phase-correlation registration of BigStitcher projects
+#
+# A Python replacement for the "Calculate pairwise shifts", "Filter
+# pairwise shifts" and "Optimize globally and apply shifts" steps that
+# fiji_batch_stitching/process_folders_projected.py runs in Fiji.
+# Shifts are computed on a coarse pyramid level of the dataset.h5 that
+# lm2bs has just written, restricted to the overlap of each tile pair,
+# and the refined translations are added to dataset.xml as an extra
+# ViewTransform, so the project opens in BigStitcher already stitched.
+#
+# License BSD-3
+
+import copy
+import shutil
+import h5py
+import numpy as np
+from xml.etree import ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+
+from tile_index import overlap_pairs, read_project, tile_boxes
+
+STITCHING_TRANSFORM_NAME = "Stitching Transform"
+
+
+def _affine_to_text(m: np.ndarray) -> str:
+    return " ".join(repr(float(c)) for c in m[:3, :].flatten())
+
+
+def _correlation(a: np.ndarray, b: np.ndarray, shift: np.ndarray, min_overlap: float):
+    """Pearson correlation of a[q + shift] and b[q] where both are defined"""
+    sa, sb = [], []
+    for d, n in zip(shift, a.shape):
+        sa.append(slice(max(0, d), min(n, n + d)))
+        sb.append(slice(max(0, -d), min(n, n - d)))
+    a, b = a[tuple(sa)], b[tuple(sb)]
+    if a.size < min_overlap or a.size < 2:
+        return 0.0
+    a, b = a - a.mean(), b - b.mean()
+    denom = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denom) if denom > 0 else 0.0
+
+
+def phase_correlation(
+    a: np.ndarray, b: np.ndarray, n_peaks: int = 5, min_overlap_fraction: float = 0.1
+) -> Tuple[np.ndarray, float]:
+    """shift between two equally sized images by phase correlation
+
+    The n_peaks highest peaks of the phase correlation matrix and all their
+    periodic alternatives are checked by cross-correlation, as BigStitcher does.
+    The best shift is refined to subpixel accuracy by fitting a parabola
+    through the peak and its neighbours along each axis.
+
+    Returns
+    -------
+    Tuple[np.ndarray, float]
+        the shift d (array axis order) for which b[q] matches a[q + d],
+        and the cross-correlation r of the overlapping parts at that shift
+    """
+    a = a.astype(np.float32)
+    b = b.astype(np.float32)
+    fa = np.fft.rfftn(a - a.mean())
+    fb = np.fft.rfftn(b - b.mean())
+    cross = fa * np.conj(fb)
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    pcm = np.fft.irfftn(cross, s=a.shape, axes=tuple(range(a.ndim)))
+    peaks = np.argsort(pcm, axis=None)[::-1][:n_peaks]
+    min_overlap = min_overlap_fraction * a.size
+    best_shift, best_r, best_peak = np.zeros(a.ndim, dtype=int), -1.0, None
+    for peak in peaks:
+        peak = np.array(np.unravel_index(peak, a.shape))
+        # each peak position d is ambiguous with d - n along every axis
+        candidates = [[]]
+        for d, n in zip(peak, a.shape):
+            candidates = [c + [d] for c in candidates] + (
+                [c + [d - n] for c in candidates] if d != 0 else []
+            )
+        for shift in candidates:
+            shift = np.array(shift)
+            r = _correlation(a, b, shift, min_overlap)
+            if r > best_r:
+                best_shift, best_r, best_peak = shift, r, peak
+    if best_peak is None:
+        return best_shift.astype(float), best_r
+    return best_shift + _subpixel_offset(pcm, best_peak), best_r
+
+
+def _subpixel_offset(pcm: np.ndarray, peak: np.ndarray) -> np.ndarray:
+    """offset of the maximum of a parabola through the peak and its (periodic) neighbours"""
+    offset = np.zeros(pcm.ndim)
+    c = pcm[tuple(peak)]
+    for axis, n in enumerate(pcm.shape):
+        if n < 3:
+            continue
+        lower, upper = peak.copy(), peak.copy()
+        lower[axis] = (peak[axis] - 1) % n
+        upper[axis] = (peak[axis] + 1) % n
+        l, u = pcm[tuple(lower)], pcm[tuple(upper)]
+        denom = l - 2 * c + u
+        if denom < 0:
+            offset[axis] = np.clip(0.5 * (l - u) / denom, -0.5, 0.5)
+    return offset
+
+
+def _crop(cells, affine: np.ndarray, resolution: np.ndarray, lo, hi) -> Tuple[np.ndarray, np.ndarray]:
+    """read the part of a pyramid level (z,y,x) inside the world box lo..hi (x,y,z)
+
+    The start of the slice is rounded down to whole pixels of the level and
+    clipped to the tile, the world position (x,y,z) of its first pixel is
+    returned with it.
+    """
+    inv = np.linalg.inv(affine)
+    a = (inv[:3, :3] @ lo + inv[:3, 3]) / resolution
+    b = (inv[:3, :3] @ hi + inv[:3, 3]) / resolution
+    start = np.floor(np.minimum(a, b)).astype(int)[::-1]
+    stop = np.ceil(np.maximum(a, b)).astype(int)[::-1]
+    start = np.clip(start, 0, cells.shape)
+    stop = np.clip(stop, start, cells.shape)
+    origin = affine[:3, :3] @ (start[::-1] * resolution) + affine[:3, 3]
+    return cells[tuple(slice(s, e) for s, e in zip(start, stop))], origin
+
+
+def pairwise_shifts(
+    h5_filename,
+    setups: List[int],
+    affines: Dict[int, np.ndarray],
+    pairs,
+    level: int = 2,
+    timepoint: int = 0,
+) -> List[dict]:
+    """phase correlation of the overlap regions of the given tile pairs
+
+    Parameters
+    ----------
+    h5_filename : str
+        BDV hdf5 file
+    setups : List[int]
+        setup ids, the pair indices refer to this list
+    affines : Dict[int, np.ndarray]
+        pixel to world affine of each setup
+    pairs : list
+        (i, j, lower, upper) tuples as returned by tile_index.overlap_pairs
+    level : int
+        pyramid level used for the correlation
+
+    Returns
+    -------
+    List[dict]
+        one dict per pair with keys i, j, shift (world x,y,z, such that the
+        correction of tile j minus the correction of tile i equals shift) and r
+    """
+    links = []
+    with h5py.File(h5_filename, "r") as f:
+        for i, j, lo, hi in pairs:
+            si, sj = setups[i], setups[j]
+            # resolutions are stored in x,y,z order
+            res_i = f[f"s{si:02d}/resolutions"][level]
+            res_j = f[f"s{sj:02d}/resolutions"][level]
+            a, origin_a = _crop(f[f"t{timepoint:05d}/s{si:02d}/{level}/cells"], affines[si], res_i, lo, hi)
+            b, origin_b = _crop(f[f"t{timepoint:05d}/s{sj:02d}/{level}/cells"], affines[sj], res_j, lo, hi)
+            common = tuple(min(n, m) for n, m in zip(a.shape, b.shape))
+            if min(common) == 0:
+                continue
+            a = a[tuple(slice(0, n) for n in common)]
+            b = b[tuple(slice(0, n) for n in common)]
+            shift, r = phase_correlation(a, b)
+            # the crops start at whole pixels of the level, at different world positions
+            world = affines[si][:3, :3] @ (shift[::-1] * res_i) - (origin_b - origin_a)
+            links.append(dict(i=i, j=j, shift=world, r=r))
+    return links
+
+
+def filter_shifts(
+    links: List[dict],
+    min_r: float = 0.6,
+    max_r: float = 1.0,
+    max_shift: Optional[Tuple[float, float, float]] = None,
+) -> List[dict]:
+    """keep links with min_r <= r <= max_r and (optionally) |shift| <= max_shift per axis"""
+    kept = []
+    for link in links:
+        if not (min_r <= link["r"] <= max_r):
+            continue
+        if max_shift is not None and np.any(
+            (np.abs(link["shift"]) > np.asarray(max_shift)) & (np.asarray(max_shift) > 0)
+        ):
+            continue
+        kept.append(link)
+    return kept
+
+
+def _components(n: int, links: List[dict]) -> List[int]:
+    parent = list(range(n))
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for link in links:
+        parent[find(link["i"])] = find(link["j"])
+    return [find(k) for k in range(n)]
+
+
+def optimize_globally(
+    n: int, links: List[dict], relative: float = 2.5, absolute: float = 3.5
+) -> np.ndarray:
+    """least-squares translations of n tiles from pairwise links
+
+    The first tile of each connected group of tiles is fixed; tiles without
+    links keep their metadata position. Like BigStitcher, the link with the
+    largest error is dropped and the optimization repeated as long as that
+    error exceeds both `absolute` and `relative` times the mean error.
+
+    Returns
+    -------
+    np.ndarray
+        (n, 3) world translations (x,y,z) to add to each tile
+    """
+    links = list(links)
+    while True:
+        components = _components(n, links)
+        anchors = {c: k for k, c in reversed(list(enumerate(components)))}
+        rows = len(links) + len(anchors)
+        A = np.zeros((rows, n))
+        rhs = np.zeros((rows, 3))
+        for row, link in enumerate(links):
+            w = np.sqrt(max(link["r"], 1e-3))
+            A[row, link["j"]], A[row, link["i"]] = w, -w
+            rhs[row] = w * np.asarray(link["shift"])
+        for row, k in enumerate(anchors.values(), start=len(links)):
+            A[row, k] = 1e3
+        t = np.linalg.lstsq(A, rhs, rcond=None)[0]
+        if not links:
+            return t
+        errors = np.array(
+            [np.linalg.norm(t[l["j"]] - t[l["i"]] - l["shift"]) for l in links]
+        )
+        worst = int(np.argmax(errors))
+        if errors[worst] > absolute and errors[worst] > relative * errors.mean():
+            del links[worst]
+        else:
+            return t
+
+
+def write_stitching_transforms(
+    xml_filename,
+    setups: List[int],
+    translations: np.ndarray,
+    name: str = STITCHING_TRANSFORM_NAME,
+    backup: bool = True,
+) -> None:
+    """prepend a translation ViewTransform to the registrations of the given setups
+
+    If backup is True, the original file is kept as dataset.xml~1, as BigStitcher does.
+    """
+    xml_filename = str(xml_filename)
+    if backup:
+        shutil.copyfile(xml_filename, xml_filename + "~1")
+    tree = ET.parse(xml_filename)
+    shifts = dict(zip(setups, translations))
+    for vreg in tree.getroot().find("ViewRegistrations").findall("ViewRegistration"):
+        setup = int(vreg.get("setup"))
+        if setup not in shifts:
+            continue
+        # copy an existing transform so the new one is indented like its siblings
+        vt = copy.deepcopy(vreg.find("ViewTransform"))
+        vt.set("type", "affine")
+        vt.find("Name").text = name
+        m = np.eye(4)
+        m[:3, 3] = shifts[setup]
+        vt.find("affine").text = _affine_to_text(m)
+        vreg.insert(0, vt)
+    tree.write(xml_filename, xml_declaration=True, encoding="utf-8", method="xml")
+
+
+def register_project(
+    xml_filename,
+    level: int = 2,
+    min_r: float = 0.6,
+    max_r: float = 1.0,
+    max_shift: Optional[Tuple[float, float, float]] = None,
+    relative: float = 2.5,
+    absolute: float = 3.5,
+    timepoint: int = 0,
+) -> np.ndarray:
+    """calculate pairwise shifts, filter them, optimize globally and write the result
+
+    The equivalent of the Fiji calls in process_folders_projected.py, e.g.
+    min_r=0.6 and relative=2.5, absolute=3.5. Returns the (n, 3) translations.
+    """
+    h5_name, setups, sizes, affines = read_project(xml_filename, timepoint)
+    lo, hi = tile_boxes(setups, sizes, affines)
+    pairs = overlap_pairs(lo, hi)
+    links = pairwise_shifts(h5_name, setups, affines, pairs, level, timepoint)
+    kept = filter_shifts(links, min_r, max_r, max_shift)
+    print(
+        f"{xml_filename}: {len(pairs)} overlapping pairs, "
+        f"{len(kept)} links with {min_r} <= r <= {max_r}"
+    )
+    translations = optimize_globally(len(setups), kept, relative, absolute)
+    write_stitching_transforms(xml_filename, setups, translations)
+    return translations
+
+
+
+def test_registration():
+    """known integer and subpixel shifts are recovered, bad links are filtered or dropped"""
+    from scipy import ndimage
+
+    rng = np.random.default_rng(0)
+    texture = ndimage.gaussian_filter(rng.normal(size=(256, 256)), 1.0)
+    spectrum = np.fft.fftn(texture)
+    a = texture[96:160, 96:160]
+    for shift in [(5.0, -7.0), (-3.0, 11.0), (2.4, -1.7), (-4.6, 3.3)]:
+        # the texture moved by -shift, so b[q] = a[q + shift]
+        moved = np.fft.ifftn(ndimage.fourier_shift(spectrum, (-shift[0], -shift[1]))).real
+        d, r = phase_correlation(a, moved[96:160, 96:160])
+        assert np.allclose(d, shift, atol=0.25), (shift, d)
+        assert np.array_equal(np.round(d), np.round(shift)) and r > 0.9
+
+    links = [
+        dict(i=0, j=1, shift=np.array([10.0, 0, 0]), r=0.9),
+        dict(i=0, j=2, shift=np.array([0.0, 10, 0]), r=0.3),
+        dict(i=0, j=2, shift=np.array([500.0, 10, 0]), r=0.9),
+    ]
+    kept = filter_shifts(links, min_r=0.6, max_shift=(100, 100, 0))
+    assert len(kept) == 1 and kept[0]["j"] == 1
+
+    # a 3x3 grid of tiles linked to their 8 neighbours, off their metadata
+    # positions by truth, with one link wrong by 40 um
+    pos = [(k // 3, k % 3) for k in range(9)]
+    truth = np.zeros((9, 3))
+    truth[1:, :2] = rng.integers(-5, 6, (8, 2))
+    pairs = [(i, j) for i in range(9) for j in range(i + 1, 9) if np.abs(np.subtract(pos[i], pos[j])).max() == 1]
+    links = [dict(i=i, j=j, shift=truth[j] - truth[i] + [*rng.normal(0, 0.3, 2), 0], r=0.9) for i, j in pairs]
+    links[4] = dict(links[4], shift=links[4]["shift"] + [40, 0, 0])
+    assert np.abs(optimize_globally(9, links, relative=2.5, absolute=3.5) - truth).max() < 1
+    # below the absolute threshold the bad link is kept and spoils the result
+    assert np.abs(optimize_globally(9, links, relative=2.5, absolute=100) - truth).max() > 5
+    # tiles without links keep their position
+    t = optimize_globally(3, [dict(i=0, j=1, shift=np.array([3.0, -2, 0]), r=0.9)])
+    assert np.allclose(t, [[0, 0, 0], [3, -2, 0], [0, 0, 0]], atol=1e-6)
+
+
+def test_register_project():
+    """a known misplacement of a tile is recovered from a project whose tiles are not on the level grid"""
+    import pathlib
+    import tempfile
+    import npy2bdv
+    from scipy import ndimage
+
+    rng = np.random.default_rng(1)
+    # a texture that phase correlation can still lock onto at level 2 (4x downsampled)
+    image = ndimage.gaussian_filter(rng.normal(size=(600, 1000)), 2.0)
+    image = (2000 + image / image.std() * 300).astype(np.uint16)
+    # (x, y) where the tiles were acquired and where the metadata puts them,
+    # off by (7, -5) full-resolution pixels and not on the 4 pixel grid of level 2
+    true = [(0, 0), (301, 23)]
+    meta = [(0, 0), (294, 28)]
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_name = pathlib.Path(tmp) / "dataset.xml"
+        subsamp = ((1, 1, 1), (1, 2, 2), (1, 4, 4))
+        writer = npy2bdv.BdvWriter(str(xml_name.with_suffix(".h5")), ntiles=2, subsamp=subsamp, blockdim=((1, 64, 64),))
+        for tile, ((x, y), (mx, my)) in enumerate(zip(true, meta)):
+            affine = np.array(((1.0, 0, 0, mx), (0, 1.0, 0, my), (0, 0, 1.0, 0)))
+            stack = image[None, y : y + 512, x : x + 512]
+            writer.append_view(stack, time=0, tile=tile, m_affine=affine, voxel_size_xyz=(1, 1, 1))
+        writer.write_xml_file()
+        writer.close()
+        original = xml_name.read_text()
+        # at level 2 the overlap crop of tile 0 starts at x = 292, that of tile 1 at 294
+        for level, tolerance in ((1, 0.5), (2, 1.0)):
+            xml_name.write_text(original)
+            translations = register_project(xml_name, level=level)
+            assert np.abs(translations[1] - translations[0] - (7, -5, 0)).max() < tolerance, translations
+        # the original registration is kept as a backup, the stitching transform comes first
+        assert pathlib.Path(str(xml_name) + "~1").exists()
+        names = [vt.findtext("Name") for vt in ET.parse(str(xml_name)).getroot().iter("ViewTransform")]
+        assert names.count(STITCHING_TRANSFORM_NAME) == 2
@@ -0,0 +1,174 @@
+# Conversion of a region of interest of the wells
+#
+# Often only part of a well is of interest. A Roi selects the fields of a
+# well by their X/Y field indices (from the folder names, no file is read),
+# by a bounding box and/or by polygons in stage coordinates. For the latter
+# the footprint of a field is computed from the header of its first plane
+# only (see get_field_meta), so only the fields that intersect the region are
+# ever read. The selected fields keep their stage positions as affines, so
+# projects of different regions can be combined later.
+#
+# License BSD-3
+
+import threading
+import numpy as np
+from typing import TYPE_CHECKING, Collection, Dict, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# (min x, min y, max x, max y) in stage coordinates (um)
+Box = Tuple[float, float, float, float]
+
+
+def parse_polygon(text: str) -> np.ndarray:
+    """(n, 2) stage coordinates (um) from text like "0,0 100,0 100,100" """
+    polygon = np.array([[float(c) for c in point.split(",")] for point in text.split()])
+    assert polygon.ndim == 2 and polygon.shape[1] == 2 and len(polygon) >= 3, "a polygon needs at least 3 x,y points"
+    return polygon
+
+
+def field_footprint(meta: dict, direction_x: int = -1, direction_y: int = 1) -> Box:
+    """the area covered by a field in stage coordinates (um), from its metadata
+
+    This is the inverse of the mapping of tile_offset: image rows run along
+    stage X, image columns along stage Y.
+    """
+    x, y = meta["Stage X"] * 1_000_000, meta["Stage Y"] * 1_000_000
+    x1 = x + meta["Size Y"] * meta["PhysicalSize X"] * direction_x
+    y1 = y + meta["Size X"] * meta["PhysicalSize Y"] * direction_y
+    return min(x, x1), min(y, y1), max(x, x1), max(y, y1)
+
+
+def _point_in_polygon(point, polygon: np.ndarray) -> bool:
+    x, y = point
+    inside = False
+    for (x0, y0), (x1, y1) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+            inside = not inside
+    return inside
+
+
+def _segments_intersect(a, b, c, d) -> bool:
+    def orientation(p, q, r):
+        return np.sign((q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0]))
+
+    return orientation(a, b, c) != orientation(a, b, d) and orientation(c, d, a) != orientation(c, d, b)
+
+
+def box_intersects_polygon(box: Box, polygon: np.ndarray) -> bool:
+    """True if the box and the polygon overlap"""
+    x0, y0, x1, y1 = box
+    corners = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+    if any(x0 <= px <= x1 and y0 <= py <= y1 for px, py in polygon):
+        return True
+    if any(_point_in_polygon(c, polygon) for c in corners):
+        return True
+    edges = list(zip(corners, corners[1:] + corners[:1]))
+    return any(
+        _segments_intersect(a, b, c, d)
+        for a, b in edges
+        for c, d in zip(polygon, np.roll(polygon, -1, axis=0))
+    )
+
+
+def boxes_intersect(a: Box, b: Box) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class Roi(object):
+    """a region of interest, the fields that satisfy all given criteria are selected
+
+    Parameters
+    ----------
+    box : Optional[Box]
+        (min x, min y, max x, max y) in stage coordinates (um)
+    x_range, y_range : Optional[Tuple[int, int]]
+        inclusive ranges of the field indices (--X, --Y of the field folders)
+    polygons : Optional[Sequence[np.ndarray]]
+        (n, 2) polygons in stage coordinates (um), fields intersecting any of them are selected
+    direction_x, direction_y : int
+        as for save_files_for_bigstitcher
+    """
+
+    def __init__(
+        self,
+        box: Optional[Box] = None,
+        x_range: Optional[Tuple[int, int]] = None,
+        y_range: Optional[Tuple[int, int]] = None,
+        polygons: Optional[Sequence[np.ndarray]] = None,
+        direction_x: int = -1,
+        direction_y: int = 1,
+    ) -> None:
+        self.box = None if box is None else tuple(float(c) for c in box)
+        self.x_range = x_range
+        self.y_range = y_range
+        self.polygons = [np.asarray(p, dtype=float) for p in polygons] if polygons else []
+        self.direction_x = direction_x
+        self.direction_y = direction_y
+        # footprints are read once, process_wells selects the fields of a well twice
+        self._footprints: Dict[str, Box] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def needs_metadata(self) -> bool:
+        return self.box is not None or bool(self.polygons)
+
+    def matches_index(self, x: int, y: int) -> bool:
+        return all(
+            r is None or r[0] <= i <= r[1] for i, r in ((x, self.x_range), (y, self.y_range))
+        )
+
+    def matches_footprint(self, footprint: Box) -> bool:
+        if self.box is not None and not boxes_intersect(self.box, footprint):
+            return False
+        return not self.polygons or any(box_intersects_polygon(footprint, p) for p in self.polygons)
+
+    def footprint(self, field: str, jobs: Optional[Collection[int]] = None) -> Box:
+        with self._lock:
+            if field in self._footprints:
+                return self._footprints[field]
+        from process_matrix_screener_data import get_field_meta
+
+        meta, _ = get_field_meta(field, jobs)
+        footprint = field_footprint(meta, self.direction_x, self.direction_y)
+        with self._lock:
+            self._footprints[field] = footprint
+        return footprint
+
+    def select(self, fields: "pd.DataFrame", jobs: Optional[Collection[int]] = None) -> "pd.DataFrame":
+        """the rows of a field catalog (with the columns field, x and y) inside the region"""
+        fields = fields[[self.matches_index(x, y) for x, y in zip(fields.x, fields.y)]]
+        if not self.needs_metadata:
+            return fields
+        return fields[[self.matches_footprint(self.footprint(f, jobs)) for f in fields.field]]
+
+    def __str__(self) -> str:
+        parts = []
+        if self.x_range is not None or self.y_range is not None:
+            parts.append(f"fields X {self.x_range or 'all'}, Y {self.y_range or 'all'}")
+        if self.box is not None:
+            parts.append(f"stage box {self.box} um")
+        if self.polygons:
+            parts.append(f"{len(self.polygons)} polygon(s)")
+        return "ROI: " + ", ".join(parts or ["everything"])
+
+
+def test_roi():
+    """index ranges, boxes and polygons select the expected footprints"""
+    meta = {"Stage X": -5e-6, "Stage Y": 5e-6, "Size X": 128, "Size Y": 100, "PhysicalSize X": 0.5, "PhysicalSize Y": 0.5}
+    assert field_footprint(meta) == (-55.0, 5.0, -5.0, 69.0)
+    roi = Roi(x_range=(1, 2))
+    assert roi.matches_index(1, 5) and not roi.matches_index(0, 5) and not roi.needs_metadata
+    footprint = (0.0, 0.0, 10.0, 10.0)
+    assert Roi(box=(5, 5, 20, 20)).matches_footprint(footprint)
+    assert not Roi(box=(11, 0, 20, 20)).matches_footprint(footprint)
+    triangle = parse_polygon("20,0 40,0 20,-20")
+    # a triangle near, but not touching the footprint
+    assert not Roi(polygons=[triangle]).matches_footprint(footprint)
+    # edges crossing without any vertex inside the other shape
+    cross = parse_polygon("-5,4 15,4 15,6 -5,6")
+    assert Roi(polygons=[cross]).matches_footprint(footprint)
+    # the footprint inside a large polygon, and a small polygon inside the footprint
+    assert Roi(polygons=[parse_polygon("-100,-100 100,-100 0,100")]).matches_footprint(footprint)
+    assert Roi(polygons=[triangle, parse_polygon("2,2 3,2 3,3")]).matches_footprint(footprint)
@@ -0,0 +1,225 @@
+# Staging of inputs and outputs on local scratch space
+#
+# Network shares (e.g. the SMB share the Matrix Screener writes to, or a
+# cluster filesystem for the output) are slow for the many small reads and
+# writes of a conversion. With a Staging, the tifs of the wells are bulk
+# copied to a local scratch folder in the order the wells are processed, so
+# the next wells are copied while the current ones are converted, and the
+# projects are written to scratch and then published to their final folder
+# in the background. Each file is published under a temporary name and
+# renamed, so a dataset.xml in the output folder always refers to a
+# complete dataset.h5 (the XML files are published last).
+#
+# License BSD-3
+
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+Well = Tuple[int, int]
+
+MODES = ("copy", "fadvise")
+
+
+def _folder_files(folder) -> List[pathlib.Path]:
+    return sorted(pathlib.Path(e.path) for e in os.scandir(folder) if e.is_file())
+
+
+def publish_folder(local, final) -> None:
+    """move all files of local into final, each one atomically, XML files last
+
+    On the same filesystem files are renamed, otherwise they are copied to a
+    temporary name next to their destination and then renamed.
+    """
+    local, final = pathlib.Path(local), pathlib.Path(final)
+    final.mkdir(parents=True, exist_ok=True)
+    same_device = os.stat(local).st_dev == os.stat(final).st_dev
+    for f in sorted(_folder_files(local), key=lambda f: (f.suffix == ".xml", f.name)):
+        if same_device:
+            os.replace(f, final / f.name)
+            continue
+        partial = final / f".{f.name}.partial"
+        shutil.copyfile(f, partial)
+        os.replace(partial, final / f.name)
+        f.unlink()
+    shutil.rmtree(local)
+
+
+class Staging(object):
+    """local scratch space for the inputs and outputs of process_wells
+
+    Parameters
+    ----------
+    scratch : str
+        local folder, a temporary folder is created inside it
+    max_input_bytes : int
+        at most this many bytes of tifs are staged at a time. Copying the next
+        well waits until earlier wells have been converted; wells that are
+        larger on their own are read from their original location.
+    min_free_bytes : int
+        projects are only written to scratch while it has this much free space,
+        otherwise they are written directly to their final folder
+    mode : str
+        "copy" copies the tifs, "fadvise" only asks the operating system to
+        read them into the page cache (posix_fadvise, not available on Windows)
+    copy_workers : int
+        number of files copied concurrently
+    keep : bool
+        keep the scratch folder on close, e.g. for debugging
+    """
+
+    def __init__(
+        self,
+        scratch,
+        max_input_bytes: int = 20_000_000_000,
+        min_free_bytes: int = 10_000_000_000,
+        mode: str = "copy",
+        copy_workers: int = 4,
+        keep: bool = False,
+    ) -> None:
+        assert mode in MODES, f"mode must be one of {MODES}"
+        if mode == "fadvise" and not hasattr(os, "posix_fadvise"):
+            raise RuntimeError("posix_fadvise is not available on this platform")
+        pathlib.Path(scratch).mkdir(parents=True, exist_ok=True)
+        self.folder = pathlib.Path(tempfile.mkdtemp(prefix="lm2bs_", dir=str(scratch)))
+        self.max_input_bytes = max_input_bytes
+        self.min_free_bytes = min_free_bytes
+        self.mode = mode
+        self.copy_workers = copy_workers
+        self.keep = keep
+        self._space = threading.Condition()
+        self._staged_bytes = 0
+        self._inputs: Dict[Well, Future] = {}
+        self._sizes: Dict[Well, int] = {}
+        # wells are staged one after the other, in the order they are processed
+        self._stager = ThreadPoolExecutor(max_workers=1)
+        self._publisher = ThreadPoolExecutor(max_workers=1)
+        self._published: List[Future] = []
+
+    def stage_wells(self, wells: Sequence[Tuple[Well, Sequence[str]]]) -> None:
+        """start staging the field folders of the given wells in the background, in order"""
+        for well, fields in wells:
+            self._inputs[well] = self._stager.submit(self._stage, well, list(fields))
+
+    def _stage(self, well: Well, fields: List[str]) -> Dict[str, str]:
+        files = {field: _folder_files(field) for field in fields}
+        if self.mode == "fadvise":
+            for f in (f for fs in files.values() for f in fs):
+                fd = os.open(f, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            return {}
+        size = sum(f.stat().st_size for fs in files.values() for f in fs)
+        if size > self.max_input_bytes:
+            print(f"well {well}: {size / 1e6:.0f} MB do not fit into the scratch space, not staged")
+            return {}
+        with self._space:
+            self._space.wait_for(lambda: self._staged_bytes + size <= self.max_input_bytes)
+            self._staged_bytes += size
+        self._sizes[well] = size
+        local = {}
+        copies = []
+        for field in fields:
+            # chamber and field folder names are kept, they hold the well and field coordinates
+            field = pathlib.Path(field)
+            target = self.folder / "input" / f"{well[0]}_{well[1]}" / field.parent.name / field.name
+            target.mkdir(parents=True, exist_ok=True)
+            local[str(field)] = str(target)
+            copies += [(f, target / f.name) for f in files[str(field)]]
+        with ThreadPoolExecutor(max_workers=self.copy_workers) as p:
+            list(p.map(lambda c: shutil.copyfile(*c), copies))
+        return local
+
+    def local_fields(self, well: Well) -> Dict[str, str]:
+        """the staged copy of each field of a well, waits until the well has been staged
+
+        Fields that were not staged are missing from the result.
+        """
+        if well not in self._inputs:
+            return {}
+        return self._inputs[well].result()
+
+    def release(self, well: Well) -> None:
+        """delete the staged inputs of a well and make room for the next ones"""
+        future = self._inputs.pop(well, None)
+        if future is not None and not future.cancel():
+            # a well released (e.g. cancelled) before its staging started is not staged at all
+            future.exception()
+        shutil.rmtree(self.folder / "input" / f"{well[0]}_{well[1]}", ignore_errors=True)
+        with self._space:
+            self._staged_bytes -= self._sizes.pop(well, 0)
+            self._space.notify_all()
+
+    def output_folder(self, final) -> pathlib.Path:
+        """the folder to write the project for final into, on scratch if it has enough free space"""
+        if shutil.disk_usage(str(self.folder)).free < self.min_free_bytes:
+            return pathlib.Path(final)
+        key = hashlib.sha1(str(pathlib.Path(final).resolve()).encode()).hexdigest()[:16]
+        folder = self.folder / "output" / key
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder
+
+    def publish(self, local, final) -> Optional[Future]:
+        """move the files of a project written to output_folder(final) to final, in the background"""
+        if pathlib.Path(local) == pathlib.Path(final):
+            return None
+        future = self._publisher.submit(publish_folder, local, final)
+        self._published.append(future)
+        return future
+
+    def wait(self) -> None:
+        """wait until all projects have been published, raises the first error of a publish"""
+        for future in self._published:
+            future.result()
+        self._published = []
+
+    def close(self) -> None:
+        """wait for the publishing and remove the scratch folder (unless keep is set)"""
+        try:
+            self.wait()
+        finally:
+            self._stager.shutdown(wait=True)
+            self._publisher.shutdown(wait=True)
+            if not self.keep:
+                shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def test_staging():
+    """inputs are staged within the limit, outputs are published with the XML last"""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        wells = []
+        for u in range(3):
+            field = tmp / "share" / f"chamber--U{u:02d}--V00" / "field--X00--Y00"
+            field.mkdir(parents=True)
+            (field / "image--Z00.ome.tif").write_bytes(b"x" * 1000)
+            wells.append(((u, 0), [str(field)]))
+        with Staging(tmp / "scratch", max_input_bytes=2500, min_free_bytes=0) as staging:
+            staging.stage_wells(wells)
+            for well, (field,) in wells:
+                local = staging.local_fields(well)[field]
+                assert pathlib.Path(local).name == "field--X00--Y00"
+                assert (pathlib.Path(local) / "image--Z00.ome.tif").stat().st_size == 1000
+                assert staging._staged_bytes <= 2500
+                out = staging.output_folder(tmp / "out" / f"chamber_{well[0]}_0")
+                (out / "dataset.h5").write_bytes(b"h5")
+                (out / "dataset.xml").write_text("<SpimData/>")
+                staging.publish(out, tmp / "out" / f"chamber_{well[0]}_0")
+                staging.release(well)
+            staging.wait()
+            folder = staging.folder
+        assert not folder.exists()
+        assert sorted(p.name for p in (tmp / "out" / "chamber_2_0").iterdir()) == ["dataset.h5", "dataset.xml"]
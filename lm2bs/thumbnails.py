@@ -0,0 +1,162 @@
+# Well thumbnails for the GUI, with an on-disk LRU cache
+#
+# A thumbnail is a small 8 bit stage-position mosaic of a well (see
+# preview.well_mosaic). Thumbnails are cached on disk, keyed by the
+# catalog entry of the well (its field folders and their modification
+# times), so revisiting a plate shows them without reading any pixels.
+#
+# License BSD-3
+
+import hashlib
+import os
+import pathlib
+import threading
+import numpy as np
+from typing import Collection, Optional
+
+DEFAULT_CACHE_FOLDER = pathlib.Path.home() / ".cache" / "lm2bs" / "thumbnails"
+
+
+class ThumbnailCache(object):
+    """thread-safe least-recently-used cache of thumbnails in a folder
+
+    Each thumbnail is stored as a .npy file. Reading a thumbnail refreshes
+    its modification time; when the folder grows beyond max_bytes, the
+    least recently used thumbnails are deleted.
+    """
+
+    def __init__(self, folder=DEFAULT_CACHE_FOLDER, max_bytes: int = 200_000_000) -> None:
+        self.folder = pathlib.Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.folder / f"{key}.npy"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self._path(key)
+        try:
+            image = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return image
+
+    def put(self, key: str, image: np.ndarray) -> None:
+        path = self._path(key)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self) -> None:
+        """delete the least recently used thumbnails until the cache fits into max_bytes"""
+        with self._lock:
+            entries = []
+            for path in self.folder.glob("*.npy"):
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda e: e[0]):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                total -= size
+
+
+def well_key(processor, wellindex: int, size: int, jobs: Optional[Collection[int]] = None) -> str:
+    """cache key of a well thumbnail, from the well's field folders and their modification times"""
+    u, v = processor.uvwells[wellindex]
+    df = processor.df
+    fields = sorted(str(f) for f in df[(df.u == u) & (df.v == v)].field)
+    h = hashlib.sha1(f"{u},{v}|{size}|{sorted(jobs) if jobs else None}".encode())
+    for field in fields:
+        try:
+            mtime = os.stat(field).st_mtime_ns
+        except OSError:
+            mtime = 0
+        h.update(f"|{field}|{mtime}".encode())
+    return h.hexdigest()
+
+
+def to_uint8(image: np.ndarray) -> np.ndarray:
+    """contrast-stretch an image between its 0.5 and 99.5 percentiles to 8 bit"""
+    lo, hi = np.percentile(image, (0.5, 99.5))
+    scaled = np.clip((image.astype(np.float32) - lo) / max(hi - lo, 1), 0, 1)
+    return (scaled * 255).astype(np.uint8)
+
+
+def well_thumbnail(
+    processor,
+    wellindex: int,
+    size: int = 96,
+    jobs: Optional[Collection[int]] = None,
+    cache: Optional[ThumbnailCache] = None,
+) -> np.ndarray:
+    """8 bit stage-position mosaic of a well whose longer side is at most size pixels
+
+    The thumbnail is taken from cache if it is there and added to it otherwise.
+    """
+    from preview import well_mosaic
+
+    key = well_key(processor, wellindex, size, jobs) if cache is not None else None
+    if cache is not None:
+        image = cache.get(key)
+        if image is not None:
+            return image
+    mosaic, _ = well_mosaic(processor, wellindex, max_size=size, jobs=jobs, read_workers=2)
+    image = to_uint8(mosaic)
+    if cache is not None:
+        cache.put(key, image)
+    return image
+
+
+def test_thumbnail_cache():
+    """least recently used thumbnails are evicted, keys change with the fields of a well"""
+    import tempfile
+    import pandas as pd
+    from types import SimpleNamespace
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        images = {k: np.full((10, 10), i, np.uint8) for i, k in enumerate("abcd")}
+        nbytes = len(images["a"].tobytes()) + 128  # .npy header
+        cache = ThumbnailCache(tmp / "cache", max_bytes=3 * nbytes)
+        assert cache.get("a") is None
+        for i, k in enumerate("abc"):
+            cache.put(k, images[k])
+            os.utime(cache._path(k), (1000 + i, 1000 + i))
+        # reading a refreshes it, so b is the least recently used
+        assert np.array_equal(cache.get("a"), images["a"])
+        cache.put("d", images["d"])
+        assert sorted(p.stem for p in cache.folder.glob("*.npy")) == ["a", "c", "d"]
+        assert cache.get("b") is None and np.array_equal(cache.get("d"), images["d"])
+        assert not list(cache.folder.glob("*.tmp"))
+
+        fields = [tmp / f"field--X{x:02d}" for x in range(3)]
+        for field in fields:
+            field.mkdir()
+        processor = SimpleNamespace(
+            uvwells=[(0, 0), (1, 0)],
+            df=pd.DataFrame(dict(u=[0, 0, 1], v=[0, 0, 0], field=[str(f) for f in fields])),
+        )
+        key = well_key(processor, 0, 96)
+        assert well_key(processor, 0, 96) == key
+        assert len({key, well_key(processor, 1, 96), well_key(processor, 0, 64), well_key(processor, 0, 96, {9})}) == 4
+        # a field of another well does not matter, a changed field of the well does
+        os.utime(fields[2], ns=(10**18, 10**18))
+        assert well_key(processor, 0, 96) == key
+        os.utime(fields[1], ns=(10**18, 10**18))
+        changed = well_key(processor, 0, 96)
+        assert changed != key
+        # a field that is added to the well
+        processor.df.loc[2, "u"] = 0
+        assert well_key(processor, 0, 96) not in (key, changed)
@@ -0,0 +1,413 @@
+# Reading Leica Matrix Screener Z-stacks that are stored as one
+# .ome.tif file per Z plane.
+#
+# Matrix Screener writes each plane as a single, uncompressed and
+# contiguous strip. Such planes can be memory-mapped straight from
+# disk, which avoids decoding every plane into a new array and lets
+# pyramid building and projections read from page-cache backed views.
+#
+# License BSD-3
+
+import pathlib
+import re
+import threading
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Callable, Collection, Dict, Iterable, Iterator, List, Optional, Sequence
+
+if TYPE_CHECKING:
+    from concurrency import AdaptiveLimit
+
+
+_FILENAME_FIELD = re.compile(r"--([A-Z])(\d+)")
+
+
+def filename_fields(filename) -> Dict[str, int]:
+    """parse the --<letter><number> fields of a matrix screener file name
+
+    e.g. image--L0000--S00--U05--V03--J09--E00--O00--X00--Y00--T0000--Z00--C00.ome.tif
+    gives {"L": 0, "S": 0, "U": 5, "V": 3, "J": 9, "E": 0, "O": 0, ...}
+    """
+    return {k: int(v) for k, v in _FILENAME_FIELD.findall(pathlib.Path(filename).name)}
+
+
+def list_planes(field, jobs: Optional[Collection[int]] = None) -> List[str]:
+    """list the tif files in a field folder, sorted by their --Z index
+
+    Parameters
+    ----------
+    field : str or pathlib.Path
+        field-- folder of a matrix screener scan
+    jobs : Optional[Collection[int]]
+        if given, only files whose --J scan job number is in jobs are listed
+
+    Returns
+    -------
+    List[str]
+        filenames of the individual Z planes
+    """
+    planes = []
+    for f in pathlib.Path(field).iterdir():
+        if not f.name.lower().endswith((".tif", ".tiff")):
+            continue
+        tokens = filename_fields(f)
+        if "Z" not in tokens:
+            continue
+        if jobs is not None and tokens.get("J") not in jobs:
+            continue
+        planes.append((tokens["Z"], str(f)))
+    return [f for _, f in sorted(planes)]
+
+
+def has_unique_z(files: Sequence[str]) -> bool:
+    """check that no two files share the same --Z index (e.g. files from several scan jobs)"""
+    zs = [filename_fields(f)["Z"] for f in files]
+    return len(set(zs)) == len(zs)
+
+
+def select_main_job(files: Sequence[str]) -> List[str]:
+    """keep only the files of the scan job with the most planes
+
+    Autofocus jobs (e.g. --J08) typically acquire a few planes next to the
+    actual acquisition job (e.g. --J09) in the same field-- folder.
+    """
+    by_job: Dict[Optional[int], List[str]] = {}
+    for f in files:
+        by_job.setdefault(filename_fields(f).get("J"), []).append(f)
+    if len(by_job) <= 1:
+        return list(files)
+    return max(by_job.values(), key=len)
+
+
+def memmap_plane(filename: str) -> Optional[np.memmap]:
+    """memory-map the image data of a single-page tif file
+
+    Parameters
+    ----------
+    filename : str
+        tif file containing a single 2D plane
+
+    Returns
+    -------
+    Optional[np.memmap]
+        read-only memory map of the plane, or None if the image data
+        is compressed, tiled or not stored contiguously
+    """
+    import tifffile
+
+    with tifffile.TiffFile(filename) as tif:
+        if len(tif.pages) != 1:
+            return None
+        page = tif.pages[0]
+        if not getattr(page, "is_memmappable", False) or len(page.shape) != 2:
+            return None
+        dtype = np.dtype(page.dtype).newbyteorder(tif.byteorder)
+        offset = page.dataoffsets[0]
+        shape = page.shape
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+def is_memmappable(filename: str) -> bool:
+    """check whether memmap_plane can map the given tif file without decoding"""
+    return memmap_plane(filename) is not None
+
+
+class PlaneStack(object):
+    """numpy-like Z-stack backed by one tif file per plane
+
+    Planes that are stored uncompressed and contiguously are memory-mapped,
+    all other planes are decoded with tifffile. Indexing with an integer
+    returns a single plane without copying, ``np.asarray`` assembles the full
+    (z,y,x) stack with a single copy.
+    """
+
+    def __init__(self, files: Sequence[str]) -> None:
+        assert len(files) > 0, "a PlaneStack needs at least one file"
+        self.files = list(files)
+        first = self.plane(0)
+        self.dtype = first.dtype.newbyteorder("=")
+        self.shape = (len(self.files),) + tuple(first.shape)
+        self.ndim = 3
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def plane(self, z: int) -> np.ndarray:
+        """return plane z, memory-mapped if possible"""
+        mm = memmap_plane(self.files[z])
+        if mm is not None:
+            return mm
+        import tifffile
+
+        return tifffile.imread(self.files[z])
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.plane(int(key) % len(self))
+        return self.asarray()[key]
+
+    def asarray(
+        self,
+        out: Optional[np.ndarray] = None,
+        max_workers: int = 1,
+        limit: Optional["AdaptiveLimit"] = None,
+    ) -> np.ndarray:
+        """read all planes into a single (z,y,x) array
+
+        Parameters
+        ----------
+        out : Optional[np.ndarray]
+            preallocated array of shape self.shape to read into
+        max_workers : int
+            number of planes that are opened and read concurrently.
+            On network shares the per-file latency dominates, so reading
+            several planes at once hides most of it.
+        limit : Optional[AdaptiveLimit]
+            a limit on the planes read concurrently, shared with other
+            reads, see concurrency. Each plane read is recorded with it.
+
+        Returns
+        -------
+        np.ndarray
+            the stack
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+
+        def _read(z):
+            with limit if limit is not None else nullcontext():
+                out[z] = self.plane(z)
+            if limit is not None:
+                limit.record(out[z].nbytes)
+
+        if max_workers > 1 and len(self) > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(self))) as p:
+                list(p.map(_read, range(len(self))))
+        else:
+            for z in range(len(self)):
+                _read(z)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.asarray()
+        if dtype is not None:
+            arr = arr.astype(dtype, copy=False)
+        return arr
+
+    def project(
+        self, project_func=np.max, max_workers: int = 1, limit: Optional["AdaptiveLimit"] = None
+    ) -> np.ndarray:
+        """project the stack along Z
+
+        np.max, np.min and np.sum are reduced plane by plane, so the full stack
+        is never held in memory. Any other project_func is applied to the
+        assembled stack. max_workers planes are read concurrently (each
+        within limit, see asarray) and reduced as they arrive.
+        """
+        reducers = {np.max: np.maximum, np.min: np.minimum, np.sum: np.add}
+        reducer = reducers.get(project_func)
+        if reducer is None:
+            return project_func(self.asarray(max_workers=max_workers, limit=limit), axis=0)
+        acc_dtype = self.dtype
+        if project_func is np.sum:
+            # the widest type of the kind of the planes, as np.sum accumulates
+            acc_dtype = {"u": np.uint64, "f": np.float64, "c": np.complex128}.get(self.dtype.kind, np.int64)
+        if max_workers <= 1 and limit is None:
+            result = np.array(self.plane(0), dtype=acc_dtype)
+            for z in range(1, len(self)):
+                reducer(result, self.plane(z), out=result)
+            return result
+        result = np.zeros(self.shape[1:], dtype=acc_dtype)
+        first = [True]
+        lock = threading.Lock()
+
+        def _read(z):
+            with limit if limit is not None else nullcontext():
+                # np.array reads a memory-mapped plane within the limit
+                plane = np.array(self.plane(z))
+            if limit is not None:
+                limit.record(plane.nbytes)
+            with lock:
+                if first[0]:
+                    result[...] = plane
+                    first[0] = False
+                else:
+                    reducer(result, plane, out=result)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(self)))) as p:
+            list(p.map(_read, range(len(self))))
+        return result
+
+
+def project_stack(
+    stack, project_func=np.max, max_workers: int = 1, limit: Optional["AdaptiveLimit"] = None
+) -> np.ndarray:
+    """project a (z,y,x) stack or PlaneStack along Z using project_func
+
+    max_workers and limit apply to a PlaneStack, see PlaneStack.project.
+    """
+    if isinstance(stack, PlaneStack):
+        return stack.project(project_func, max_workers=max_workers, limit=limit)
+    return project_func(stack, axis=0)
+
+
+class ReadStats(object):
+    """thread-safe accumulator for the bytes and time spent reading fields
+
+    cancelled is set by save_files_for_bigstitcher if it stopped before
+    writing all fields, started and finished are the time.perf_counter()
+    times at which it started and finished the conversion (without
+    registration and fusion).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.nfields = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+        self.cancelled = False
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    def add(self, nbytes: int, seconds: float) -> None:
+        with self._lock:
+            self.nfields += 1
+            self.nbytes += nbytes
+            self.seconds += seconds
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.nbytes / 1e6 / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"read {self.nfields} fields, {self.nbytes / 1e6:.1f} MB in "
+            f"{self.seconds:.2f} s ({self.mb_per_s:.1f} MB/s)"
+        )
+
+
+def read_stack(stack, max_workers: int = 4, limit: Optional["AdaptiveLimit"] = None) -> np.ndarray:
+    """read a stack into memory, reading the planes of a PlaneStack concurrently
+
+    Parameters
+    ----------
+    stack : PlaneStack or numpy-like
+        stack as returned by get_field
+    max_workers : int
+        number of concurrent plane reads
+    limit : Optional[AdaptiveLimit]
+        a limit on the concurrent reads shared with other stacks, see PlaneStack.asarray
+
+    Returns
+    -------
+    np.ndarray
+        the stack in memory
+    """
+    if isinstance(stack, PlaneStack):
+        return stack.asarray(max_workers=max_workers, limit=limit)
+    with limit if limit is not None else nullcontext():
+        stack = np.asarray(stack)
+    if limit is not None:
+        limit.record(stack.nbytes)
+    return stack
+
+
+def prefetch(load: Callable, items: Iterable, ahead: int = 1) -> Iterator:
+    """yield load(item) for each item, loading up to `ahead` items in advance
+
+    Loading happens on a background thread, so the next field is read
+    while the current one is being pyramided and written.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=1) as p:
+        pending = deque(p.submit(load, item) for item in islice(items, ahead + 1))
+        while pending:
+            result = pending.popleft().result()
+            for item in islice(items, 1):
+                pending.append(p.submit(load, item))
+            yield result
+
+
+def test_plane_stack():
+    """planes of a tiny field with an autofocus job, memory-mapped and decoded"""
+    import tempfile
+    import tifffile
+
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 65535, (5, 12, 16), dtype=np.uint16)
+    with tempfile.TemporaryDirectory() as tmp:
+        field = pathlib.Path(tmp) / "field--X00--Y00"
+        field.mkdir()
+        for z, plane in enumerate(stack):
+            name = field / f"image--L0000--S00--U00--V00--J09--E00--O00--X00--Y00--T0000--Z{z:02d}--C00.ome.tif"
+            # one plane compressed, it cannot be memory-mapped
+            tifffile.imwrite(name, plane, compression="zlib" if z == 3 else None, metadata={"axes": "YX"})
+        for z in range(2):
+            name = field / f"image--L0000--S00--U00--V00--J08--E00--O00--X00--Y00--T0000--Z{z:02d}--C00.ome.tif"
+            tifffile.imwrite(name, np.zeros((12, 16), np.uint16), metadata={"axes": "YX"})
+        (field / "metadata").mkdir()
+
+        files = list_planes(field)
+        assert len(files) == 7 and not has_unique_z(files)
+        # the autofocus job is dropped by default
+        main = select_main_job(files)
+        assert main == list_planes(field, jobs={9}) and has_unique_z(main)
+        assert [filename_fields(f)["Z"] for f in main] == list(range(5))
+        assert all(filename_fields(f)["J"] == 9 for f in main)
+        assert len(list_planes(field, jobs={8})) == 2
+        assert select_main_job(main) == main
+
+        for z, f in enumerate(main):
+            assert is_memmappable(f) == (z != 3)
+            if z != 3:
+                mm = memmap_plane(f)
+                assert isinstance(mm, np.memmap) and np.array_equal(mm, tifffile.imread(f))
+        assert memmap_plane(main[3]) is None
+
+        planes = PlaneStack(main)
+        assert planes.shape == stack.shape and planes.dtype == np.uint16 and planes.nbytes == stack.nbytes
+        assert np.array_equal(planes[3], stack[3]) and np.array_equal(planes[-1], stack[-1])
+        assert np.array_equal(planes.asarray(max_workers=3), stack)
+        assert np.array_equal(np.asarray(planes), stack)
+        assert np.array_equal(read_stack(planes, max_workers=2), stack)
+        for func in (np.max, np.min, np.sum):
+            expected = func(stack.astype(np.uint64) if func is np.sum else stack, axis=0)
+            assert np.array_equal(planes.project(func), expected)
+            assert np.array_equal(project_stack(planes, func, max_workers=3), expected)
+        assert np.allclose(project_stack(planes, np.mean), stack.mean(axis=0))
+        assert np.array_equal(project_stack(stack, np.max), np.max(stack, axis=0))
+
+        # sums of signed and float planes, which an unsigned accumulator cannot take
+        for dtype in (np.int16, np.float32):
+            signed = (rng.normal(0, 1000, (4, 12, 16))).astype(dtype)
+            folder = pathlib.Path(tmp) / f"field--X01--Y00--{np.dtype(dtype).name}"
+            folder.mkdir()
+            for z, plane in enumerate(signed):
+                tifffile.imwrite(folder / f"image--J09--Z{z:02d}.ome.tif", plane, metadata={"axes": "YX"})
+            planes = PlaneStack(list_planes(folder))
+            assert planes.dtype == dtype
+            for workers in (1, 3):
+                total = planes.project(np.sum, max_workers=workers)
+                assert total.dtype.kind == ("i" if dtype is np.int16 else "f")
+                assert np.allclose(total, signed.sum(axis=0, dtype=np.float64))
+                assert np.array_equal(planes.project(np.min, max_workers=workers), signed.min(axis=0))
+
+    # prefetch keeps the order and loads at most ahead + 1 items before the first is used
+    loaded = []
+
+    def _load(i):
+        loaded.append(i)
+        return i * i
+
+    results = prefetch(_load, range(6), ahead=2)
+    assert next(results) == 0 and len(loaded) <= 4
+    assert list(results) == [1, 4, 9, 16, 25] and sorted(loaded) == list(range(6))
+    assert list(prefetch(_load, [], ahead=2)) == []
@@ -0,0 +1,175 @@
+# On-disk cache of per-field intermediates
+#
+# Converting the same plate again (e.g. projections first, volumes later,
+# or with different pyramid settings) would reread and reproject every
+# tif. The projection of each field and the coarse reads of background and
+# preview tiles are therefore cached, together with the field metadata,
+# keyed by the identity of the source files (names, sizes and modification
+# times) and the processing parameters. The cache is a folder of compressed
+# .npz files with least-recently-used eviction above a size cap.
+#
+# License BSD-3
+
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import numpy as np
+from typing import Optional, Tuple
+
+DEFAULT_CACHE_FOLDER = pathlib.Path.home() / ".cache" / "lm2bs" / "tiles"
+
+
+class ArrayCache(object):
+    """thread-safe least-recently-used cache of arrays (with optional metadata) in a folder
+
+    Each entry is stored as a .npz file. Reading an entry refreshes its
+    modification time; when the folder grows beyond max_bytes, the least
+    recently used entries are deleted until it is below low_water * max_bytes.
+    """
+
+    def __init__(
+        self, folder, max_bytes: int, compress: bool = True, low_water: float = 0.9
+    ) -> None:
+        self.folder = pathlib.Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        # the folder is only listed again when the running total exceeds max_bytes
+        self._total = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.folder / f"{key}.npz"
+
+    def _entries(self):
+        entries = []
+        for path in self.folder.glob("*.npz"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def get_with_meta(self, key: str) -> Tuple[Optional[np.ndarray], Optional[dict]]:
+        """the array and metadata stored under key, (None, None) if there is no entry"""
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                data = f["data"]
+                meta = json.loads(str(f["meta"])) if "meta" in f.files else None
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None, None
+        return data, meta
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        return self.get_with_meta(key)[0]
+
+    def put(self, key: str, data: np.ndarray, meta: Optional[dict] = None) -> None:
+        path = self._path(key)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        arrays = dict(data=data)
+        if meta is not None:
+            arrays["meta"] = np.array(json.dumps(meta))
+        with open(tmp, "wb") as f:
+            (np.savez_compressed if self.compress else np.savez)(f, **arrays)
+        size = tmp.stat().st_size
+        os.replace(tmp, path)
+        with self._lock:
+            self._total += size
+            over = self._total > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self) -> None:
+        """delete the least recently used entries until the cache is below low_water * max_bytes"""
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda e: e[0]):
+                if total <= self.low_water * self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                total -= size
+            self._total = total
+
+
+def _jsonable(o):
+    # e.g. sets of scan jobs
+    return sorted(o) if isinstance(o, (set, frozenset)) else str(o)
+
+
+def source_key(field, kind: str, **params) -> str:
+    """cache key of an intermediate of a field
+
+    The key is computed from the path of the field folder, the names, sizes
+    and modification times of all files in it, kind (e.g. "projection") and
+    the parameters, so any change to the source files or the processing
+    gives a new key.
+    """
+    params = json.dumps(params, sort_keys=True, default=_jsonable)
+    h = hashlib.sha1(f"{pathlib.Path(field).resolve()}|{kind}|{params}".encode())
+    for entry in sorted(os.scandir(field), key=lambda e: e.name):
+        if entry.is_file():
+            st = entry.stat()
+            h.update(f"|{entry.name}|{st.st_size}|{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+class TileCache(ArrayCache):
+    """cache of per-field intermediates, see save_files_for_bigstitcher"""
+
+    def __init__(self, folder=DEFAULT_CACHE_FOLDER, max_bytes: int = 20_000_000_000) -> None:
+        super(TileCache, self).__init__(folder, max_bytes, compress=True)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: str) -> Tuple[Optional[np.ndarray], Optional[dict]]:
+        data, meta = self.get_with_meta(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data, meta
+
+    def __str__(self) -> str:
+        return f"tile cache {self.folder}: {self.hits} hits, {self.misses} misses"
+
+
+def test_tile_cache():
+    """entries are found by source identity and parameters and evicted least recently used first"""
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        field = tmp / "field--X00--Y00"
+        field.mkdir()
+        (field / "image--Z00.ome.tif").write_bytes(b"x" * 100)
+        cache = TileCache(tmp / "cache", max_bytes=10_000)
+        key = source_key(field, "projection", project="amax", jobs=None)
+        assert cache.lookup(key) == (None, None)
+        image = np.arange(100, dtype=np.uint16).reshape(10, 10)
+        cache.put(key, image, {"Stage X": 0.5})
+        data, meta = cache.lookup(key)
+        assert np.array_equal(data, image) and meta == {"Stage X": 0.5}
+        assert source_key(field, "projection", project="amax", jobs={9}) != key
+        time.sleep(0.01)
+        (field / "image--Z00.ome.tif").write_bytes(b"y" * 101)
+        assert source_key(field, "projection", project="amax", jobs=None) != key
+
+        rng = np.random.default_rng(0)
+        for i in range(20):
+            cache.put(f"noise{i}", rng.integers(0, 65535, 500, dtype=np.uint16))
+            time.sleep(0.01)
+        files = sorted(p.stem for p in (tmp / "cache").glob("*.npz"))
+        assert sum(p.stat().st_size for p in (tmp / "cache").glob("*.npz")) <= 10_000
+        assert "noise19" in files and "noise0" not in files
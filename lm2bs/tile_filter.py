@@ -0,0 +1,219 @@
+# Detection of empty (background-only) fields before conversion
+#
+# Sparse samples leave many fields that contain nothing but background.
+# Each field is judged on a cheap sample (a strided maximum projection over
+# every few planes, see preview.coarse_tile) before its full stack is read,
+# so background fields can be left out of the project or written at coarse
+# pyramid levels only.
+#
+# License BSD-3
+
+import pathlib
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Collection, Dict, Optional, Sequence, Union
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from tile_cache import TileCache
+
+# written next to dataset.xml
+REPORT_FILE = "tile_filter.csv"
+
+# what happens to fields that fail the criterion
+MODES = ("exclude", "coarse")
+
+Criterion = Union[float, Callable[[np.ndarray], bool]]
+
+
+def threshold_predicate(threshold: float, percentile: float = 99.9) -> Callable[[np.ndarray], bool]:
+    """predicate that keeps a field if the given percentile of its sample exceeds threshold
+
+    A high percentile rather than the maximum makes the test robust against
+    a few hot pixels.
+    """
+
+    def has_content(sample: np.ndarray) -> bool:
+        return bool(np.percentile(sample, percentile) > threshold)
+
+    has_content.__name__ = f"p{percentile:g} > {threshold:g}"
+    return has_content
+
+
+def as_predicate(criterion: Criterion) -> Callable[[np.ndarray], bool]:
+    """a threshold is turned into threshold_predicate(threshold), callables are returned as they are"""
+    if callable(criterion):
+        return criterion
+    return threshold_predicate(float(criterion))
+
+
+def sample_field(
+    field: str,
+    downsample: int = 8,
+    z_step: int = 4,
+    jobs: Optional[Collection[int]] = None,
+    source: Optional[str] = None,
+    cache: Optional["TileCache"] = None,
+) -> np.ndarray:
+    """the strided maximum projection of a field that its decisions are based on
+
+    source is a staged copy that is read instead of field, the samples are
+    looked up in and added to cache under the original field.
+    """
+    from preview import coarse_tile
+
+    source = source or field
+    if cache is None:
+        return coarse_tile(source, downsample, z_step=z_step, jobs=jobs)
+    from tile_cache import source_key
+
+    key = source_key(field, "sample", downsample=downsample, z_step=z_step, jobs=jobs)
+    sample, _ = cache.lookup(key)
+    if sample is None:
+        sample = coarse_tile(source, downsample, z_step=z_step, jobs=jobs)
+        cache.put(key, sample)
+    return sample
+
+
+def evaluate_fields(
+    fields: Sequence[str],
+    criterion: Criterion,
+    downsample: int = 8,
+    z_step: int = 4,
+    jobs: Optional[Collection[int]] = None,
+    read_workers: int = 8,
+    local_fields: Optional[Dict[str, str]] = None,
+    cache: Optional["TileCache"] = None,
+    on_sample: Optional[Callable[[np.ndarray], None]] = None,
+) -> "pd.DataFrame":
+    """decide for each field whether it has content, from a cheap sample
+
+    Parameters
+    ----------
+    fields : Sequence[str]
+        field-- folders
+    criterion : float or Callable[[np.ndarray], bool]
+        a threshold for threshold_predicate, or a predicate that receives the
+        2D sample of a field and returns True if the field is to be kept
+    downsample : int
+        only every downsample-th row and column is sampled
+    z_step : int
+        only every z_step-th plane is sampled
+    jobs : Optional[Collection[int]]
+        scan jobs to read, see get_field
+    read_workers : int
+        number of fields sampled concurrently
+    local_fields : Optional[Dict[str, str]]
+        staged copies of the fields that are read instead, see staging.Staging
+    cache : Optional[TileCache]
+        the samples are looked up in and added to this cache, see tile_cache
+    on_sample : Optional[Callable[[np.ndarray], None]]
+        called with each sample in the order of fields, e.g. to estimate a
+        flat-field from the same reads, see flatfield
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per field with the columns field, keep, max, p99 (of the sample) and seconds
+    """
+    import pandas as pd
+
+    predicate = as_predicate(criterion)
+    local_fields = local_fields or {}
+
+    def _evaluate(field):
+        t0 = time.perf_counter()
+        sample = sample_field(field, downsample, z_step, jobs, local_fields.get(field), cache)
+        row = dict(
+            field=field,
+            keep=bool(predicate(sample)),
+            max=int(sample.max()),
+            p99=float(np.percentile(sample, 99)),
+            seconds=time.perf_counter() - t0,
+        )
+        return row, sample
+
+    with ThreadPoolExecutor(max_workers=read_workers) as p:
+        rows = []
+        for row, sample in p.map(_evaluate, fields):
+            rows.append(row)
+            if on_sample is not None:
+                on_sample(sample)
+    report = pd.DataFrame(rows, columns=["field", "keep", "max", "p99", "seconds"])
+    report["criterion"] = getattr(predicate, "__name__", str(predicate))
+    return report
+
+
+def write_report(report: "pd.DataFrame", xml_filename) -> None:
+    """store the decisions next to a project"""
+    report.to_csv(pathlib.Path(xml_filename).parent / REPORT_FILE, index=False)
+
+
+def summary(report: "pd.DataFrame", mode: str) -> str:
+    n = int((~report.keep).sum())
+    action = "left out" if mode == "exclude" else "written at coarse levels only"
+    return f"{n} of {len(report)} fields without content, {action}"
+
+
+def test_tile_filter():
+    """a constant background field is left out or written coarse, a field with content is kept"""
+    import tempfile
+    import h5py
+    import pandas as pd
+    import tile_index
+    from process_matrix_screener_data import save_files_for_bigstitcher, write_test_field
+
+    keep = threshold_predicate(500)
+    assert keep.__name__ == "p99.9 > 500" and as_predicate(keep) is keep
+    assert as_predicate(500).__name__ == keep.__name__
+    background = np.full((64, 64), 100, np.uint16)
+    assert not keep(background) and keep(background + 1000)
+    # a few hot pixels are not content, a bright region is
+    hot = background.copy()
+    hot[0, :3] = 60000
+    assert not keep(hot) and threshold_predicate(500, 100)(hot)
+    bright = background.copy()
+    bright[:8, :8] = 3000
+    assert keep(bright)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        stack = np.full((3, 64, 64), 100, np.uint16)
+        fields = [write_test_field(tmp, stack, x=0)]
+        stack = stack.copy()
+        stack[0, 16:32, 16:32] = 3000
+        fields.append(write_test_field(tmp, stack, (3e-5, 0.0), x=1))
+
+        samples = []
+        report = evaluate_fields(fields, 500, downsample=4, z_step=1, read_workers=2, on_sample=samples.append)
+        assert list(report.columns) == ["field", "keep", "max", "p99", "seconds", "criterion"]
+        assert list(report.field) == fields and list(report.keep) == [False, True]
+        assert list(report["max"]) == [100, 3000] and report.p99[0] == 100 and report.p99[1] == 3000
+        assert (report.criterion == "p99.9 > 500").all()
+        # the samples are strided maximum projections, passed on in the order of the fields
+        assert [s.shape for s in samples] == [(16, 16), (16, 16)] and samples[1].max() == 3000
+        assert np.array_equal(samples[0], sample_field(fields[0], 4, 1))
+        assert summary(report, "exclude") == "1 of 2 fields without content, left out"
+        assert summary(report, "coarse") == "1 of 2 fields without content, written at coarse levels only"
+
+        for mode in MODES:
+            h5_name = tmp / mode / "dataset.h5"
+            h5_name.parent.mkdir()
+            save_files_for_bigstitcher(
+                fields, True, False, h5_proj_name=str(h5_name), skip_background=500, background_mode=mode
+            )
+            xml_name = h5_name.with_suffix(".xml")
+            written = pd.read_csv(xml_name.parent / REPORT_FILE)
+            assert list(written.field) == fields and list(written.keep) == [False, True]
+            _, setups, _, _ = tile_index.read_project(xml_name)
+            if mode == "exclude":
+                assert list(written.setup) == [-1, 0] and list(setups) == [0]
+                assert tile_index.read_tile_fields(xml_name) == fields[1:]
+            else:
+                assert list(written.setup) == [0, 1] and list(setups) == [0, 1]
+                with h5py.File(h5_name, "r") as f:
+                    # the background field only has the levels at least as coarse as its read
+                    assert [f[f"t00000/s00/{level}/cells"].id.get_num_chunks() for level in range(4)] == [0, 0, 0, 1]
+                    assert (f["t00000/s00/3/cells"][...] == 100).all()
+                    assert f["t00000/s01/0/cells"].id.get_num_chunks() > 0
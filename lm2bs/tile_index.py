@@ -0,0 +1,199 @@
+# Spatial index of tile extents and the resulting overlap graph
+#
+# Tiles are axis-aligned boxes given by their stage position, pixel size
+# and tile size (i.e. by the affines lm2bs writes). Overlapping pairs are
+# found by sort-and-sweep along x, so the work scales with the number of
+# neighbours of each tile rather than with the square of the tile count.
+#
+# License BSD-3
+
+import pathlib
+import numpy as np
+import pandas as pd
+from xml.etree import ElementTree as ET
+from typing import Dict, List, Tuple
+
+# written next to dataset.xml
+OVERLAP_FILE = "tile_overlaps.csv"
+FIELDS_FILE = "tile_fields.csv"
+
+_COLUMNS = ["setup_i", "setup_j", "x0", "y0", "z0", "x1", "y1", "z1"]
+
+
+def _affine_from_text(text: str) -> np.ndarray:
+    """4x4 matrix from the 12 row-major coefficients of a BDV affine"""
+    m = np.eye(4)
+    m[:3, :] = np.array(text.split(), dtype=float).reshape(3, 4)
+    return m
+
+
+def read_project(
+    xml_filename, timepoint: int = 0
+) -> Tuple[str, List[int], Dict[int, np.ndarray], Dict[int, np.ndarray]]:
+    """read the setups of a BDV project
+
+    Returns
+    -------
+    Tuple[str, List[int], Dict[int, np.ndarray], Dict[int, np.ndarray]]
+        the h5 file name, the setup ids, the size (x,y,z) of each setup and
+        the composed 4x4 affine (pixel to world) of each setup at timepoint
+    """
+    root = ET.parse(str(xml_filename)).getroot()
+    seqdesc = root.find("SequenceDescription")
+    h5_name = seqdesc.find("ImageLoader/hdf5").text
+    if seqdesc.find("ImageLoader/hdf5").get("type") == "relative":
+        h5_name = str(pathlib.Path(xml_filename).parent / h5_name)
+    sizes = {}
+    for vs in seqdesc.find("ViewSetups").findall("ViewSetup"):
+        sizes[int(vs.find("id").text)] = np.array(vs.find("size").text.split(), dtype=int)
+    affines = {}
+    for vreg in root.find("ViewRegistrations").findall("ViewRegistration"):
+        if int(vreg.get("timepoint")) != timepoint:
+            continue
+        m = np.eye(4)
+        for vt in vreg.findall("ViewTransform"):
+            m = m @ _affine_from_text(vt.find("affine").text)
+        affines[int(vreg.get("setup"))] = m
+    setups = sorted(sizes)
+    return h5_name, setups, sizes, affines
+
+
+def tile_boxes(
+    setups: List[int], sizes: Dict[int, np.ndarray], affines: Dict[int, np.ndarray]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """world bounding boxes (x,y,z) of all setups, as (n, 3) arrays of lower and upper corners
+
+    Only the translation and scaling part of the affines is taken into account,
+    which is all lm2bs writes.
+    """
+    lo, hi = [], []
+    for s in setups:
+        a, b = affines[s][:3, 3], affines[s][:3, 3] + affines[s][:3, :3] @ sizes[s]
+        lo.append(np.minimum(a, b))
+        hi.append(np.maximum(a, b))
+    return np.array(lo), np.array(hi)
+
+
+def overlap_pairs(
+    lo: np.ndarray, hi: np.ndarray
+) -> List[Tuple[int, int, np.ndarray, np.ndarray]]:
+    """all pairs of overlapping boxes, with their overlap box
+
+    Parameters
+    ----------
+    lo, hi : np.ndarray
+        (n, ndim) arrays with the lower and upper corners of n boxes
+
+    Returns
+    -------
+    List[Tuple[int, int, np.ndarray, np.ndarray]]
+        (i, j, lower, upper) for each overlapping pair with i < j, sorted by (i, j)
+    """
+    lo, hi = np.asarray(lo, dtype=float), np.asarray(hi, dtype=float)
+    pairs = []
+    active: List[int] = []
+    for k in np.argsort(lo[:, 0], kind="stable"):
+        # drop boxes that end before this one starts along the sweep axis
+        active = [a for a in active if hi[a, 0] > lo[k, 0]]
+        for a in active:
+            olo, ohi = np.maximum(lo[a], lo[k]), np.minimum(hi[a], hi[k])
+            if np.all(ohi > olo):
+                i, j = min(a, k), max(a, k)
+                pairs.append((int(i), int(j), olo, ohi))
+        active.append(k)
+    return sorted(pairs, key=lambda p: (p[0], p[1]))
+
+
+def project_overlap_graph(xml_filename, timepoint: int = 0) -> pd.DataFrame:
+    """overlap graph of the tiles of a BDV project, from the affines in its XML
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per overlapping pair of setups with the overlap box in world
+        coordinates (x0, y0, z0) - (x1, y1, z1)
+    """
+    _, setups, sizes, affines = read_project(xml_filename, timepoint)
+    lo, hi = tile_boxes(setups, sizes, affines)
+    rows = [
+        [setups[i], setups[j]] + list(olo) + list(ohi)
+        for i, j, olo, ohi in overlap_pairs(lo, hi)
+    ]
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+def write_overlap_graph(xml_filename) -> pd.DataFrame:
+    """compute the overlap graph of a project and store it next to its XML file"""
+    graph = project_overlap_graph(xml_filename)
+    graph.to_csv(pathlib.Path(xml_filename).parent / OVERLAP_FILE, index=False)
+    return graph
+
+
+def read_overlap_graph(xml_filename) -> pd.DataFrame:
+    """load the overlap graph stored with a project, computing it if it is missing"""
+    csv = pathlib.Path(xml_filename).parent / OVERLAP_FILE
+    if not csv.exists():
+        return write_overlap_graph(xml_filename)
+    return pd.read_csv(csv)
+
+
+def neighbours(graph: pd.DataFrame, setup: int) -> List[int]:
+    """setups overlapping the given setup"""
+    a = graph[graph.setup_i == setup].setup_j
+    b = graph[graph.setup_j == setup].setup_i
+    return sorted(int(s) for s in pd.concat([a, b]))
+
+
+def write_tile_fields(xml_filename, fields: List[str]) -> None:
+    """store the field-- folder that each setup of a project was converted from"""
+    table = pd.DataFrame(dict(setup=range(len(fields)), field=[str(f) for f in fields]))
+    table.to_csv(pathlib.Path(xml_filename).parent / FIELDS_FILE, index=False)
+
+
+def read_tile_fields(xml_filename) -> List[str]:
+    """the field-- folders of the setups of a project, in setup order"""
+    table = pd.read_csv(pathlib.Path(xml_filename).parent / FIELDS_FILE)
+    return list(table.sort_values("setup").field)
+
+
+def test_overlap_pairs():
+    """sort-and-sweep finds the same pairs and overlap boxes as checking all pairs"""
+    rng = np.random.default_rng(0)
+    for ndim in (2, 3):
+        # integer corners, so that many boxes only touch (which is not an overlap)
+        lo = rng.integers(0, 100, (200, ndim)).astype(float)
+        hi = lo + rng.integers(1, 15, (200, ndim))
+        expected = []
+        for i in range(len(lo)):
+            for j in range(i + 1, len(lo)):
+                olo, ohi = np.maximum(lo[i], lo[j]), np.minimum(hi[i], hi[j])
+                if np.all(ohi > olo):
+                    expected.append((i, j, olo, ohi))
+        pairs = overlap_pairs(lo, hi)
+        assert [(i, j) for i, j, _, _ in pairs] == [(i, j) for i, j, _, _ in expected]
+        assert all(np.array_equal(p[2], e[2]) and np.array_equal(p[3], e[3]) for p, e in zip(pairs, expected))
+    assert overlap_pairs(np.zeros((0, 3)), np.zeros((0, 3))) == []
+
+
+def test_overlap_graph():
+    """the overlap graph of a project survives the round trip through tile_overlaps.csv"""
+    import tempfile
+    import npy2bdv
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xml = pathlib.Path(tmp) / "dataset.xml"
+        writer = npy2bdv.BdvWriter(str(xml.with_suffix(".h5")), ntiles=3, subsamp=((1, 1, 1),))
+        # tiles 0 and 1 overlap by 10 pixels of 2 um, tile 2 is apart
+        for tile, x in enumerate([0.0, 40.0, 200.0]):
+            affine = np.array([[2.0, 0, 0, x], [0, 2, 0, 0], [0, 0, 1, 0]])
+            writer.append_view(np.zeros((1, 16, 25), np.uint16), time=0, tile=tile, m_affine=affine)
+        writer.write_xml_file()
+        writer.close()
+        # computed on demand
+        graph = read_overlap_graph(xml)
+        assert (pathlib.Path(tmp) / OVERLAP_FILE).exists()
+        assert graph[["setup_i", "setup_j"]].values.tolist() == [[0, 1]]
+        assert graph[["x0", "x1", "y0", "y1"]].values.tolist() == [[40.0, 50.0, 0.0, 32.0]]
+        stored = read_overlap_graph(xml)
+        pd.testing.assert_frame_equal(stored, write_overlap_graph(xml), check_dtype=False)
+        assert neighbours(stored, 1) == [0] and neighbours(stored, 2) == []
@@ -0,0 +1,248 @@
+# Per-tile intensity statistics collected while a project is written
+#
+# Minimum, maximum, mean and standard deviation are computed on the
+# full-resolution tile, which is in memory anyway while it is written, one
+# plane at a time so no float copy of the whole tile is made.
+# Percentiles and histograms are computed on a coarse pyramid level that the
+# writer has already computed, so the statistics cost no extra read.
+# They are stored next to the project and used to write display ranges
+# that Big Data Viewer picks up when the project is opened.
+#
+# License BSD-3
+
+import pathlib
+import threading
+import numpy as np
+import pandas as pd
+from xml.etree import ElementTree as ET
+from typing import Sequence, Tuple
+
+# written next to dataset.xml
+STATS_FILE = "tile_stats.csv"
+HISTOGRAM_FILE = "tile_histograms.npz"
+
+PERCENTILES = (0.1, 1, 50, 99, 99.9)
+
+# the coarsest pyramid level with at least this many voxels is used for
+# percentiles and histograms
+MIN_VOXELS = 1 << 16
+
+
+def stats_level(levels: Sequence[np.ndarray], min_voxels: int = MIN_VOXELS) -> int:
+    """index of the coarsest level with at least min_voxels voxels (0 if there is none)"""
+    best = 0
+    for ilevel, level in enumerate(levels):
+        if level.size >= min_voxels:
+            best = ilevel
+    return best
+
+
+def _moments(stack: np.ndarray) -> Tuple[int, int, float, float]:
+    """min, max, mean and standard deviation of a (z,y,x) stack, reduced plane by plane
+
+    Only one plane at a time is converted to float, the partial means and
+    squared deviations of the planes are combined as in Chan et al.
+    """
+    lo, hi = None, None
+    n, mean, m2 = 0, 0.0, 0.0
+    for plane in stack.reshape((-1,) + stack.shape[-2:]):
+        lo = plane.min() if lo is None else min(lo, plane.min())
+        hi = plane.max() if hi is None else max(hi, plane.max())
+        values = plane.astype(np.float64)
+        k = values.size
+        plane_mean = float(values.mean())
+        values -= plane_mean
+        plane_m2 = float(np.dot(values.ravel(), values.ravel()))
+        delta = plane_mean - mean
+        mean += delta * k / (n + k)
+        m2 += plane_m2 + delta * delta * n * k / (n + k)
+        n += k
+    return int(lo), int(hi), mean, float(np.sqrt(m2 / n))
+
+
+class TileStatistics(object):
+    """thread-safe accumulator for the intensity statistics of the tiles of a project
+
+    Parameters
+    ----------
+    percentiles : Sequence[float]
+        percentiles stored for each tile
+    bins : int
+        number of histogram bins, all tiles share the same bins over hist_range
+    hist_range : Tuple[int, int]
+        range of the histograms, the full uint16 range by default
+    """
+
+    def __init__(
+        self,
+        percentiles: Sequence[float] = PERCENTILES,
+        bins: int = 1024,
+        hist_range: Tuple[int, int] = (0, 65536),
+    ) -> None:
+        self._lock = threading.Lock()
+        self.percentiles = tuple(percentiles)
+        self.edges = np.linspace(hist_range[0], hist_range[1], bins + 1)
+        self.rows = []
+        self.histograms = []
+
+    def add(self, setup: int, levels: Sequence[np.ndarray], field: str = "") -> dict:
+        """add the statistics of one tile from its pyramid levels (as returned by append_view)"""
+        ilevel = stats_level(levels)
+        coarse = np.asarray(levels[ilevel]).ravel()
+        # without a float copy of the full-resolution tile
+        lo, hi, mean, std = _moments(np.asarray(levels[0]))
+        row = dict(setup=setup, field=str(field), min=lo, max=hi, mean=mean, std=std, level=ilevel)
+        for p, value in zip(self.percentiles, np.percentile(coarse, self.percentiles)):
+            row[f"p{p:g}"] = float(value)
+        hist, _ = np.histogram(coarse, bins=self.edges)
+        with self._lock:
+            self.rows.append(row)
+            self.histograms.append((setup, hist))
+        return row
+
+    def table(self) -> pd.DataFrame:
+        """one row per tile, sorted by setup"""
+        return pd.DataFrame(self.rows).sort_values("setup").reset_index(drop=True)
+
+    def display_range(self) -> Tuple[float, float]:
+        """a display range common to all tiles, from the lowest and highest percentile"""
+        table = self.table()
+        lo, hi = f"p{self.percentiles[0]:g}", f"p{self.percentiles[-1]:g}"
+        return float(table[lo].min()), float(table[hi].max())
+
+    def save(self, xml_filename) -> None:
+        """write the table, the histograms and the BDV display settings next to a project"""
+        folder = pathlib.Path(xml_filename).parent
+        self.table().to_csv(folder / STATS_FILE, index=False)
+        histograms = sorted(self.histograms, key=lambda h: h[0])
+        np.savez_compressed(
+            folder / HISTOGRAM_FILE,
+            setups=np.array([s for s, _ in histograms]),
+            counts=np.array([h for _, h in histograms]),
+            edges=self.edges,
+        )
+        write_bdv_settings(xml_filename, [s for s, _ in histograms], self.display_range())
+
+
+def read_tile_stats(xml_filename) -> pd.DataFrame:
+    """load the statistics stored with a project"""
+    return pd.read_csv(pathlib.Path(xml_filename).parent / STATS_FILE)
+
+
+def read_histograms(xml_filename) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """load the histograms stored with a project as (setups, counts, edges)"""
+    with np.load(pathlib.Path(xml_filename).parent / HISTOGRAM_FILE) as f:
+        return f["setups"], f["counts"], f["edges"]
+
+
+def _text(parent, tag: str, value) -> None:
+    ET.SubElement(parent, tag).text = str(value)
+
+
+def write_bdv_settings(
+    xml_filename, setups: Sequence[int], display_range: Tuple[float, float]
+) -> pathlib.Path:
+    """write dataset.settings.xml with the given display range for all setups
+
+    Big Data Viewer (and BigStitcher) read <project>.settings.xml when the
+    project is opened. All setups are put into one min/max group, so tiles
+    are shown with the same contrast.
+    """
+    n = len(setups)
+    lo, hi = display_range
+    root = ET.Element("Settings")
+    viewer = ET.SubElement(root, "ViewerState")
+    sources = ET.SubElement(viewer, "Sources")
+    for _ in range(n):
+        _text(ET.SubElement(sources, "Source"), "active", "true")
+    groups = ET.SubElement(viewer, "SourceGroups")
+    group = ET.SubElement(groups, "SourceGroup")
+    _text(group, "active", "true")
+    _text(group, "name", "tiles")
+    for index in range(n):
+        _text(group, "id", index)
+    _text(viewer, "DisplayMode", "fs")
+    _text(viewer, "Interpolation", "nearestneighbor")
+    _text(viewer, "CurrentSource", 0)
+    _text(viewer, "CurrentGroup", 0)
+    _text(viewer, "CurrentTimePoint", 0)
+
+    assignments = ET.SubElement(root, "SetupAssignments")
+    converters = ET.SubElement(assignments, "ConverterSetups")
+    for setup in setups:
+        converter = ET.SubElement(converters, "ConverterSetup")
+        _text(converter, "id", setup)
+        _text(converter, "min", lo)
+        _text(converter, "max", hi)
+        _text(converter, "color", -1)
+        _text(converter, "groupId", 0)
+    minmax = ET.SubElement(ET.SubElement(assignments, "MinMaxGroups"), "MinMaxGroup")
+    _text(minmax, "id", 0)
+    _text(minmax, "fullRangeMin", -2147483648.0)
+    _text(minmax, "fullRangeMax", 2147483647.0)
+    _text(minmax, "rangeMin", 0.0)
+    _text(minmax, "rangeMax", 65535.0)
+    _text(minmax, "currentMin", lo)
+    _text(minmax, "currentMax", hi)
+
+    transforms = ET.SubElement(root, "ManualSourceTransforms")
+    for _ in range(n):
+        transform = ET.SubElement(transforms, "SourceTransform", type="affine")
+        _text(transform, "affine", "1.0 0.0 0.0 0.0 0.0 1.0 0.0 0.0 0.0 0.0 1.0 0.0")
+    ET.SubElement(root, "Bookmarks")
+
+    filename = pathlib.Path(xml_filename).with_suffix(".settings.xml")
+    ET.ElementTree(root).write(str(filename), xml_declaration=True, encoding="utf-8")
+    return filename
+
+
+def test_tile_statistics():
+    """statistics of the full tile, percentiles of the coarsest level with enough voxels"""
+    import tempfile
+
+    full = np.zeros((8, 256, 256), np.uint16)
+    full[0, 0, 0], full[-1, -1, -1] = 3, 60000
+    # 131072 voxels with 128 of each value 0 - 1023, a level of 16384 voxels that is constant
+    levels = [
+        full,
+        (np.arange(8 * 128 * 128) % 1024).astype(np.uint16).reshape(8, 128, 128),
+        np.full((4, 64, 64), 7, np.uint16),
+    ]
+    assert stats_level(levels) == 1
+    assert stats_level(levels, min_voxels=1 << 20) == 0
+    assert stats_level(levels, min_voxels=1) == 2
+
+    # the plane-wise moments equal those of the whole stack
+    rng = np.random.default_rng(0)
+    for stack in (rng.integers(0, 65535, (7, 33, 20), dtype=np.uint16), rng.integers(1000, 1010, (3, 50, 50))):
+        lo, hi, mean, std = _moments(stack)
+        assert (lo, hi) == (stack.min(), stack.max())
+        assert np.isclose(mean, stack.mean(), rtol=1e-12) and np.isclose(std, stack.std(), rtol=1e-9)
+
+    stats = TileStatistics(bins=1024, hist_range=(0, 1024))
+    row = stats.add(1, levels, field="b")
+    assert row["level"] == 1 and row["field"] == "b"
+    assert row["min"] == 0 and row["max"] == 60000
+    assert np.isclose(row["mean"], (3 + 60000) / full.size) and np.isclose(row["std"], full.std())
+    assert row["p50"] == 511.5 and row["p0.1"] == 1 and row["p99.9"] == 1022
+    stats.add(0, [levels[1] + 100, levels[2]], field="a")
+    table = stats.table()
+    assert list(table.setup) == [0, 1] and list(table.field) == ["a", "b"]
+    assert stats.display_range() == (1, 1122)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_filename = pathlib.Path(tmp) / "dataset.xml"
+        stats.save(xml_filename)
+        pd.testing.assert_frame_equal(read_tile_stats(xml_filename), table, check_dtype=False)
+        setups, counts, edges = read_histograms(xml_filename)
+        assert list(setups) == [0, 1] and len(edges) == 1025
+        # every value of the stats level is counted, those of setup 0 above 1024 are not
+        assert np.all(counts[1] == 128)
+        assert counts[0].sum() == 925 * 128
+
+        root = ET.parse(str(xml_filename.with_suffix(".settings.xml"))).getroot()
+        converters = root.findall("SetupAssignments/ConverterSetups/ConverterSetup")
+        assert [c.findtext("id") for c in converters] == ["0", "1"]
+        assert all(float(c.findtext("min")) == 1 and float(c.findtext("max")) == 1122 for c in converters)
+        assert len(root.findall("ViewerState/Sources/Source")) == 2
+        assert float(root.findtext("SetupAssignments/MinMaxGroups/MinMaxGroup/currentMax")) == 1122
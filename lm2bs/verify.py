@@ -0,0 +1,339 @@
+# Read-back verification of written BigStitcher projects
+#
+# A truncated or corrupted dataset.h5 (a full disk, a killed job, a storage
+# hiccup) usually only shows up when BigStitcher fails to read it. The
+# verifier checks that the XML and the h5 agree (setups, pyramid levels,
+# shapes, chunking), decompresses every chunk of every level in a process
+# pool, stores a checksum of each dataset and optionally compares a sample
+# of tiles against the source tifs. The result is written next to the project.
+#
+# License BSD-3
+
+import hashlib
+import json
+import os
+import pathlib
+import time
+import zlib
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree as ET
+from typing import Callable, Collection, List, Optional, Tuple
+
+import tile_index
+
+# written next to dataset.xml
+VERIFY_FILE = "lm2bs_verify.json"
+
+# number of chunks read by one task
+CHUNKS_PER_TASK = 64
+
+# h5 file of the project being verified, opened once per worker process
+_h5 = None
+
+
+def _init_worker(h5_filename: str) -> None:
+    global _h5
+    _h5 = h5py.File(h5_filename, "r")
+
+
+def _chunk_grid(shape, chunks) -> List[Tuple[int, ...]]:
+    return list(np.ndindex(*(-(-np.asarray(shape) // np.asarray(chunks)))))
+
+
+def _read_chunks_task(args) -> Tuple[str, int, List[int], int, List[str]]:
+    """decompress the given chunks of a dataset, returns (path, first, crc32s, bytes, errors)"""
+    path, first, indices = args
+    crcs, nbytes, errors = [], 0, []
+    cells = _h5[path]
+    chunks = np.asarray(cells.chunks or cells.shape)
+    for index in indices:
+        start = np.asarray(index) * chunks
+        try:
+            data = cells[tuple(slice(a, a + c) for a, c in zip(start, chunks))]
+        except Exception as e:
+            # h5py raises OSError for failing filters, but any error means the chunk is unreadable
+            errors.append(f"{path}: chunk {index} cannot be read ({e})")
+            crcs.append(0)
+            continue
+        crcs.append(zlib.crc32(np.ascontiguousarray(data).tobytes()))
+        nbytes += data.nbytes
+    return path, first, crcs, nbytes, errors
+
+
+def _timepoints(xml_filename) -> List[int]:
+    root = ET.parse(str(xml_filename)).getroot()
+    tp = root.find("SequenceDescription/Timepoints")
+    if tp is None or tp.get("type") != "range":
+        return [0]
+    return list(range(int(tp.find("first").text), int(tp.find("last").text) + 1))
+
+
+def check_structure(xml_filename) -> Tuple[List[str], List[str]]:
+    """compare the setups in the XML with the h5 groups
+
+    Returns
+    -------
+    Tuple[List[str], List[str]]
+        the problems found and the paths of all cells datasets to read
+    """
+    h5_name, setups, sizes, _ = tile_index.read_project(xml_filename)
+    problems, paths = [], []
+    if not os.path.exists(h5_name):
+        return [f"{h5_name} does not exist"], []
+    try:
+        f = h5py.File(h5_name, "r")
+    except OSError as e:
+        return [f"{h5_name} cannot be opened ({e})"], []
+    with f:
+        for s in setups:
+            try:
+                resolutions = f[f"s{s:02d}/resolutions"][()]
+                subdivisions = f[f"s{s:02d}/subdivisions"][()]
+            except (KeyError, OSError) as e:
+                problems.append(f"setup {s}: no resolutions/subdivisions ({e})")
+                continue
+            for t in _timepoints(xml_filename):
+                for level, (res, sub) in enumerate(zip(resolutions, subdivisions)):
+                    path = f"t{t:05d}/s{s:02d}/{level}/cells"
+                    try:
+                        cells = f[path]
+                    except (KeyError, OSError) as e:
+                        problems.append(f"{path} is missing ({e})")
+                        continue
+                    # sizes, resolutions and subdivisions are (x,y,z), the cells (z,y,x)
+                    expected = tuple(int(n) for n in -(-sizes[s][::-1] // res[::-1].astype(int)))
+                    if cells.shape != expected:
+                        problems.append(f"{path}: shape {cells.shape} instead of {expected}")
+                    if cells.chunks is not None and tuple(cells.chunks) != tuple(sub[::-1]):
+                        problems.append(f"{path}: chunks {cells.chunks} instead of {tuple(sub[::-1])}")
+                    paths.append(path)
+    return problems, paths
+
+
+def _source_tiles(xml_filename, setups: List[int]) -> dict:
+    """field of each setup that holds the full data (not a coarse-only background tile)"""
+    import pandas as pd
+    import tile_filter
+
+    folder = pathlib.Path(xml_filename).parent
+    if not (folder / tile_index.FIELDS_FILE).exists():
+        return {}
+    fields = pd.read_csv(folder / tile_index.FIELDS_FILE).set_index("setup").field.to_dict()
+    if (folder / tile_filter.REPORT_FILE).exists():
+        report = pd.read_csv(folder / tile_filter.REPORT_FILE)
+        for s in report.setup[~report.keep]:
+            fields.pop(s, None)
+    return {s: fields[s] for s in setups if s in fields}
+
+
+def compare_sources(
+    xml_filename,
+    sample: int,
+    planes: int = 2,
+    jobs: Optional[Collection[int]] = None,
+    project_func: Callable = np.max,
+    seed: int = 0,
+) -> List[dict]:
+    """compare the full-resolution level of sample random tiles with their source tifs
+
+    For volumes, planes random Z planes of each tile are compared, projections
+    are recomputed with project_func from the whole field. jobs and project_func
+    must be those of the conversion. Preview projects have no full-resolution
+    level and are not compared. Projects corrected with a flat-field are
+    compared with the tifs corrected with the stored profiles.
+    """
+    from flatfield import setup_profiles
+    from process_matrix_screener_data import get_field
+    from tiff_planes import project_stack, read_stack
+
+    h5_name, setups, sizes, _ = tile_index.read_project(xml_filename)
+    sources = _source_tiles(xml_filename, setups)
+    profiles = setup_profiles(xml_filename, setups)
+    rng = np.random.default_rng(seed)
+    chosen = sorted(rng.choice(sorted(sources), min(sample, len(sources)), replace=False)) if sources else []
+    results = []
+    with h5py.File(h5_name, "r") as f:
+        for s in chosen:
+            if np.any(f[f"s{s:02d}/resolutions"][0] != 1):
+                break
+            cells = f[f"t00000/s{s:02d}/0/cells"]
+            stack, _ = get_field(sources[s], jobs)
+            if sizes[s][2] == 1 and len(stack) > 1:
+                zs = [0]
+                expected = [project_stack(read_stack(stack), project_func)]
+            else:
+                zs = sorted(rng.choice(len(stack), min(planes, len(stack)), replace=False))
+                expected = [np.asarray(stack[int(z)]) for z in zs]
+            if profiles[s] is not None:
+                expected = [profiles[s].correct(e[None])[0] for e in expected]
+            match = all(
+                np.array_equal(cells[int(z)].view(np.uint16), e.astype(np.uint16)) for z, e in zip(zs, expected)
+            )
+            results.append(dict(setup=int(s), field=str(sources[s]), planes=[int(z) for z in zs], match=match))
+    return results
+
+
+def verify_project(
+    xml_filename,
+    max_workers: Optional[int] = None,
+    sample: int = 0,
+    jobs: Optional[Collection[int]] = None,
+    project_func: Callable = np.max,
+    compare_checksums: bool = True,
+) -> dict:
+    """check that a project can be read back completely and store the result next to it
+
+    Parameters
+    ----------
+    xml_filename : str
+        dataset.xml of the project
+    max_workers : Optional[int]
+        number of worker processes decompressing chunks
+    sample : int
+        number of random tiles compared with the source tifs, see compare_sources
+    jobs, project_func :
+        as used for the conversion, only needed for sample > 0
+    compare_checksums : bool
+        if the previous verification was successful, report datasets whose checksum changed since
+
+    Returns
+    -------
+    dict
+        ok, the problems found, the number of datasets, chunks and bytes read,
+        the checksum of each dataset, the sampled comparisons and the seconds taken
+    """
+    t0 = time.perf_counter()
+    xml_filename = pathlib.Path(xml_filename)
+    report_file = xml_filename.parent / VERIFY_FILE
+    previous = {}
+    if compare_checksums and report_file.exists():
+        with open(report_file) as f:
+            last = json.load(f)
+        # only a successful verification is a reference
+        previous = last.get("checksums", {}) if last.get("ok") else {}
+    problems, paths = check_structure(xml_filename)
+    h5_name, _, _, _ = tile_index.read_project(xml_filename)
+
+    tasks = []
+    if paths:
+        with h5py.File(h5_name, "r") as f:
+            for path in paths:
+                cells = f[path]
+                grid = _chunk_grid(cells.shape, cells.chunks or cells.shape)
+                for first in range(0, len(grid), CHUNKS_PER_TASK):
+                    tasks.append((path, first, grid[first : first + CHUNKS_PER_TASK]))
+    crcs = {path: {} for path in paths}
+    nbytes = 0
+    if tasks:
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker, initargs=(h5_name,)
+        ) as p:
+            for path, first, chunk_crcs, n, errors in p.map(_read_chunks_task, tasks, chunksize=4):
+                crcs[path][first] = chunk_crcs
+                nbytes += n
+                problems += errors
+    checksums = {}
+    for path, parts in crcs.items():
+        h = hashlib.sha1()
+        for first in sorted(parts):
+            h.update(np.asarray(parts[first], dtype=np.uint32).tobytes())
+        checksums[path] = h.hexdigest()
+        if path in previous and previous[path] != checksums[path]:
+            problems.append(f"{path}: checksum differs from the previous verification")
+
+    sampled = compare_sources(xml_filename, sample, jobs=jobs, project_func=project_func) if sample else []
+    problems += [f"setup {r['setup']}: differs from {r['field']}" for r in sampled if not r["match"]]
+    report = dict(
+        xml=str(xml_filename),
+        h5=str(h5_name),
+        ok=not problems,
+        problems=problems,
+        datasets=len(paths),
+        chunks=sum(len(t[2]) for t in tasks),
+        bytes=nbytes,
+        seconds=time.perf_counter() - t0,
+        checksums=checksums,
+        sampled=sampled,
+        verified=time.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    status = "ok" if report["ok"] else f"{len(problems)} problem(s)"
+    print(
+        f"{xml_filename}: {status}, {report['chunks']} chunks of {len(paths)} datasets "
+        f"({nbytes / 1e6:.1f} MB) read in {report['seconds']:.1f} s"
+    )
+    for problem in problems[:10]:
+        print(f"  {problem}")
+    return report
+
+
+def read_verification(xml_filename) -> dict:
+    """the result of the last verification of a project"""
+    with open(pathlib.Path(xml_filename).parent / VERIFY_FILE) as f:
+        return json.load(f)
+
+
+def test_verify_project():
+    """a written project verifies, a truncated copy and a missing level do not"""
+    import tempfile
+    import npy2bdv
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        h5 = tmp / "dataset.h5"
+        writer = npy2bdv.BdvWriter(
+            str(h5), ntiles=2, subsamp=((1, 1, 1), (1, 2, 2)), blockdim=((4, 32, 32),), compression="gzip"
+        )
+        rng = np.random.default_rng(1)
+        for tile in range(2):
+            writer.append_view(rng.integers(0, 4000, (8, 100, 90), dtype=np.uint16), time=0, tile=tile)
+        writer.write_xml_file()
+        writer.close()
+        report = verify_project(tmp / "dataset.xml", max_workers=2)
+        assert report["ok"] and report["datasets"] == 4 and report["chunks"] == 2 * (2 * 4 * 3 + 2 * 2 * 2)
+        # the same data verify with the same checksums
+        assert verify_project(tmp / "dataset.xml", max_workers=2)["ok"]
+
+        with h5py.File(h5, "a") as f:
+            del f["t00000/s01/1"]
+        report = verify_project(tmp / "dataset.xml", max_workers=2)
+        assert not report["ok"] and any("t00000/s01/1/cells is missing" in p for p in report["problems"])
+
+        with open(h5, "r+b") as f:
+            f.truncate(os.path.getsize(h5) // 2)
+        report = verify_project(tmp / "dataset.xml", max_workers=2, compare_checksums=False)
+        assert not report["ok"]
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Check that the BigStitcher projects below a folder can be read back completely"
+    )
+    parser.add_argument("folder", help="an lm2bs output folder or a single dataset.xml")
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument(
+        "--sample", type=int, default=0, help="number of tiles per project to compare with the source tifs"
+    )
+    parser.add_argument("--jobs", type=int, nargs="+", help="scan jobs (--J) used for the conversion")
+    args = parser.parse_args(argv)
+    from fiji_runner import find_projects
+
+    folder = pathlib.Path(args.folder)
+    projects = [folder] if folder.suffix == ".xml" else find_projects(folder)
+    reports = [verify_project(xml, args.workers, args.sample, args.jobs) for xml in projects]
+    failed = [r["xml"] for r in reports if not r["ok"]]
+    print(f"{len(reports) - len(failed)} of {len(reports)} projects ok")
+    if failed:
+        raise SystemExit(1)
+    return reports
+
+
+if __name__ == "__main__":
+    main()